@@ -14,11 +14,12 @@ from torch.utils.model_zoo import load_url
 from torch.utils.tensorboard import SummaryWriter
 from torchvision import transforms
 
-from src.networks.imageretrievalnet import init_network, extract_vectors
+from src.networks.imageretrievalnet import init_network, extract_vectors, extract_vectors_to_store
 from src.datasets.testdataset import configdataset
 from src.utils.download import download_distractors
 from src.utils.evaluate import compute_map_and_print
 from src.utils.general import get_data_root, htime
+from src.utils.featurestore import feature_store_dir
 from src.utils.networks import load_network
 
 
@@ -35,6 +36,8 @@ parser.add_argument('--soa', action='store_true',
                     help='use soa blocks')
 parser.add_argument('--soa-layers', type=str, default='45',
                     help='config soa blocks for second-order attention')
+parser.add_argument('--chunk-size', dest='chunk_size', default=1000, type=int, metavar='N',
+                    help="number of descriptors written to disk at a time (default: 1000)")
 
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
@@ -92,10 +95,12 @@ def main():
     except:
         bbxs = None  # for holidaysmanrot and copydays
 
-    # extract database and query vectors
+    # extract database vectors chunk by chunk into the feature store
+    # an interrupted extraction continues after the last complete chunk when the script is run again
     print('>> {}: database images...'.format(dataset))
-    vecs = extract_vectors(net, images, args.image_size, transform, ms=ms, mode='test')
-    torch.save(vecs, args.network + '_vecs_' + dataset + '.pt')
+    images_r_path = [os.path.relpath(path, get_data_root()) for path in images]
+    extract_vectors_to_store(net, images, images_r_path, feature_store_dir(dataset), args.image_size, transform,
+                             ms=ms, chunk_size=args.chunk_size, network=args.network, mode='test')
 
     print('>> {}: elapsed time: {}'.format(dataset, htime(time.time()-start)))
 
@@ -1,6 +1,9 @@
 import os
+import hashlib
 from tqdm import tqdm
 
+import numpy as np
+
 import torch
 import torch.nn as nn
 import torch.utils.model_zoo as model_zoo
@@ -10,7 +13,10 @@ import torchvision
 from src.layers.pooling import MAC, SPoC, GeM, GeMmp, RMAC, Rpool
 from src.layers.normalization import L2N, PowerLaw
 from src.datasets.genericdataset import ImagesFromList
-from src.utils.general import get_data_root, path_all_jpg, save_path_feature
+from src.utils.general import get_data_root
+from src.utils.imagelist import IMAGE_EXTENSIONS, build_image_list
+from src.utils.featurestore import FeatureStore, FeatureStoreWriter, MANIFEST_FILE, feature_store_dir, fingerprint_files, \
+                                   hash_files, read_progress, save_feature_store, update_feature_store
 from src.datasets.datahelpers import pil_loader, imresize
 from src.networks.networks import ResNetSOAs
 
@@ -383,6 +389,64 @@ def extract_vectors(net, images, image_size, transform, bbxs=None, ms=[1], msp=1
 
     return vecs
 
+def extract_vectors_to_store(net, images, img_r_path, directory, image_size, transform, bbxs=None, ms=[1], msp=1,
+                             chunk_size=1000, network=None, fingerprints=None, mode='test'):
+    '''
+        Streaming version of extract_vectors for large image lists.
+        The descriptors are written in chunks of chunk_size rows directly into the feature store
+        in directory, and after every chunk progress.json records how many rows are complete.
+        If a previous run on the same image list was interrupted, extraction resumes after
+        its last complete chunk. Memory use is one chunk instead of the full D x N matrix.
+        Inputs:
+            images: absolute paths of the images, img_r_path: the paths stored in the feature store
+            fingerprints: optional fingerprints of the image files, stored with the features
+        Outputs:
+            manifest of the feature store
+    '''
+    # moving network to gpu and eval mode
+    net.cuda()
+    net.eval()
+
+    # the key makes sure that only an interrupted run on the same images is resumed
+    key = hashlib.sha256('\n'.join(img_r_path).encode('utf-8')).hexdigest()
+    outputdim = net.meta['outputdim']
+    progress = read_progress(directory)
+    if progress is not None and progress.get('key') == key and progress.get('ms') == ms:
+        writer = FeatureStoreWriter(directory, outputdim, resume=True)
+        print('>> Resuming extraction after {} of {} images'.format(writer.count, len(images)))
+    else:
+        writer = FeatureStoreWriter(directory, outputdim)
+    done = writer.count
+
+    # creating dataset loader for the remaining images
+    loader = torch.utils.data.DataLoader(
+            ImagesFromList(root='', images=images[done:], imsize=image_size,
+                           bbxs=bbxs[done:] if bbxs is not None else None, transform=transform, mode=mode),
+            batch_size=1, shuffle=False, num_workers=8, pin_memory=True
+        )
+
+    # extracting vectors
+    chunk = np.zeros((chunk_size, outputdim), dtype=np.float32)
+    n_chunk = 0
+    with torch.no_grad():
+        with tqdm(total=len(images), initial=done) as pbar:
+            for i, _input in enumerate(loader, done):
+                _input = _input.cuda()
+
+                if len(ms) == 1 and ms[0] == 1:
+                    chunk[n_chunk] = extract_ss(net, _input).numpy()
+                else:
+                    chunk[n_chunk] = extract_ms(net, _input, ms, msp).numpy()
+                n_chunk += 1
+
+                if n_chunk == chunk_size or (i+1) == len(images):
+                    writer.write(chunk[:n_chunk], img_r_path[i+1-n_chunk:i+1])
+                    writer.checkpoint(key=key, ms=ms)
+                    pbar.update(n_chunk)
+                    n_chunk = 0
+
+    return writer.close(network=network, multiscale=ms, fingerprints=fingerprints)
+
 def extract_vectors_single(net, image, image_size, transform, bbxs=None, ms=[1], msp=1):
     # moving network to gpu and eval mode
     net.cuda()
@@ -404,7 +468,8 @@ def extract_vectors_single(net, image, image_size, transform, bbxs=None, ms=[1],
 
     return vec
 
-def extr_selfmade_dataset(net, selfmadedataset, image_size, transform, ms=[1], msp=1):
+def selfmade_dataset_images(selfmadedataset, extensions=IMAGE_EXTENSIONS):
+    # absolute and relative paths of the images of a dataset
     if selfmadedataset == 'GLM/test':
         path_head = '/home/yuanyuanyao/data/test/GLM/'
         df = pd.read_csv(path_head + 'retrieval_solution_v2.1.csv', usecols= ['id','images'])
@@ -414,13 +479,82 @@ def extr_selfmade_dataset(net, selfmadedataset, image_size, transform, ms=[1], m
         img_r_path = [os.path.relpath(path, "/home/yuanyuanyao/data/") for path in images]
     else:
         folder_path = os.path.join('/home/yuanyuanyao/data/test', selfmadedataset)
-        images, img_r_path = path_all_jpg(folder_path, start="/home/yuanyuanyao/data")
-    # extract database vectors
+        # directories that did not change since the last scan are not listed again, the images
+        # are read back from the image list written to outputs/images/<dataset>.txt
+        img_r_path = build_image_list(selfmadedataset, folder_path, start="/home/yuanyuanyao/data", extensions=extensions)
+        images = [os.path.join("/home/yuanyuanyao/data", path) for path in img_r_path]
+    return images, img_r_path
+
+def extr_selfmade_dataset(net, selfmadedataset, image_size, transform, ms=[1], msp=1, network=None, incremental=False, use_hash=False,
+                          extensions=IMAGE_EXTENSIONS):
+    '''
+        Extract the descriptors of a dataset and save them in its feature store.
+        With incremental=True only images that are new or changed since the last run
+        (according to size and mtime, and sha256 if use_hash) are extracted, descriptors of
+        deleted images are dropped and the rest of the store is kept.
+    '''
+    images, img_r_path = selfmade_dataset_images(selfmadedataset, extensions=extensions)
+    store_dir = feature_store_dir(selfmadedataset)
+    if incremental and os.path.exists(os.path.join(store_dir, MANIFEST_FILE)):
+        return ingest_selfmade_dataset(net, selfmadedataset, images, img_r_path, image_size, transform,
+                                       ms=ms, msp=msp, network=network, use_hash=use_hash)
+    fingerprints = fingerprint_files(images, use_hash=use_hash)
+    # extract database vectors straight into the feature store, an interrupted run is resumed
     print('>> {}: images...'.format(selfmadedataset))
-    vecs = extract_vectors(net, images, image_size, transform, ms=ms, msp=msp)
-    # convert to numpy
-    vecs = vecs.numpy()
-    save_path_feature(selfmadedataset, vecs, img_r_path)
+    extract_vectors_to_store(net, images, img_r_path, store_dir, image_size, transform, ms=ms, msp=msp,
+                             network=network, fingerprints=fingerprints)
+
+def ingest_selfmade_dataset(net, selfmadedataset, images, img_r_path, image_size, transform, ms=[1], msp=1, network=None, use_hash=False):
+    store_dir = feature_store_dir(selfmadedataset)
+    store = FeatureStore(store_dir)
+    old_fingerprints = store.fingerprints
+    if old_fingerprints is None or store.manifest['network'] != network or store.manifest['multiscale'] != ms:
+        print('>> {}: existing features can not be reused, extracting all images...'.format(selfmadedataset))
+        print('>> {}: images...'.format(selfmadedataset))
+        return extract_vectors_to_store(net, images, img_r_path, store_dir, image_size, transform, ms=ms, msp=msp,
+                                        network=network, fingerprints=fingerprint_files(images, use_hash=use_hash))
+    fingerprints = fingerprint_files(images)
+    old_row = {path: i for i, path in enumerate(store.paths)}
+
+    # classify the current images: unchanged ones keep their row, the others are (re-)extracted
+    keep, keep_new, extract_new = [], [], []
+    for i, path in enumerate(img_r_path):
+        j = old_row.get(path)
+        if j is not None:
+            old = old_fingerprints[j]
+            unchanged = old['size'] == fingerprints[i]['size'] and old['mtime_ns'] == fingerprints[i]['mtime_ns']
+            if not unchanged and use_hash and old['sha256'] and old['size'] == fingerprints[i]['size']:
+                # only touched or copied: compare the contents
+                hash_files(images, fingerprints, [i])
+                unchanged = old['sha256'] == fingerprints[i]['sha256']
+            if unchanged:
+                if use_hash and not fingerprints[i]['sha256']:
+                    fingerprints[i]['sha256'] = old['sha256']
+                keep.append(j)
+                keep_new.append(i)
+                continue
+        extract_new.append(i)
+    n_modified = sum(img_r_path[i] in old_row for i in extract_new)
+    n_deleted = store.count - len(keep) - n_modified
+    print('>> {}: {} unchanged, {} new, {} modified, {} deleted images'.format(
+        selfmadedataset, len(keep), len(extract_new) - n_modified, n_modified, n_deleted))
+    if len(extract_new) == 0 and n_deleted == 0:
+        return
+
+    if use_hash:
+        hash_files(images, fingerprints, [i for i in extract_new if not fingerprints[i]['sha256']])
+    # rows of the store must stay in increasing order
+    order = np.argsort(keep, kind='stable')
+    keep = np.asarray(keep, dtype=np.int64)[order]
+    keep_new = np.asarray(keep_new, dtype=np.int64)[order]
+    new_images = [images[i] for i in extract_new]
+    if len(new_images) > 0:
+        print('>> {}: images...'.format(selfmadedataset))
+        vecs = extract_vectors(net, new_images, image_size, transform, ms=ms, msp=msp).numpy()
+    else:
+        vecs = np.zeros((store.dim, 0), dtype=np.float32)
+    all_fingerprints = np.concatenate([fingerprints[keep_new], fingerprints[extract_new]])
+    update_feature_store(store_dir, keep, vecs, [img_r_path[i] for i in extract_new], all_fingerprints)
 
 def extract_vectors_PQ(net, images, image_size, transform, bbxs=None, print_freq=10):
     # moving network to gpu and eval mode
@@ -13,9 +13,13 @@ from torchvision import transforms
 
 from src.networks.imageretrievalnet import init_network, extract_vectors, extr_selfmade_dataset
 from src.datasets.testdataset import configdataset
-from src.utils.general import load_path_features
+from src.utils.dedup import build_duplicate_groups
+from src.utils.featurestore import load_feature_catalog, quantize_feature_store
+from src.utils.imagelist import parse_extensions
 from src.utils.networks import load_network
 from src.utils.nnsearch import *
+from src.utils.diskann import matching_DiskANN
+from src.utils.vocabtree import matching_VocabTree
 
 # test options
 parser = argparse.ArgumentParser(description='Historical Image Retrieval')
@@ -34,9 +38,39 @@ parser.add_argument('--soa-layers', type=str, default='45',
                     help='config soa blocks for second-order attention')
 parser.add_argument('--K-nearest-neighbour', '-K', default=30, type=int, metavar='K',
                     help="retreive top-K results (default: 30)")
-parser.add_argument('--matching_method', '-mm', default='L2', help="select matching methods: L2, PQ, ANNOY, HNSW, PQ_HNSW")
+parser.add_argument('--matching_method', '-mm', default='L2', help="select matching methods: L2, FP16, INT8, PQ, ANNOY, HNSW, PQ_HNSW, DiskANN, VocabTree")
 parser.add_argument('--ifgenerate', '-gen', dest='ifgenerate', action='store_true',
                     help='Include --ifgenerate if the trees/graphs/distance tables have not been generated and saved')
+parser.add_argument('--incremental', '-inc', dest='incremental', action='store_true',
+                    help='only extract images that are new or changed since the last run and drop deleted ones')
+parser.add_argument('--hash', dest='use_hash', action='store_true',
+                    help='with --incremental, also compare sha256 of the files whose size or mtime changed')
+parser.add_argument('--extensions', '-ext', metavar='EXTENSIONS', default='.jpg', type=parse_extensions,
+                    help="comma separated list of image file extensions, case-insensitive (default: '.jpg')")
+parser.add_argument('--dedup-threshold', '-dedup', dest='dedup_threshold', default=None, type=float, metavar='T',
+                    help='collapse images whose normalized descriptors are within L2 distance T (0: exact duplicates) '
+                         'and index one representative per group (default: no collapsing)')
+parser.add_argument('--ef-search', '-efs', dest='ef_search', default=None, type=int, metavar='EF',
+                    help='HNSW/PQ_HNSW: size of the candidate list of the search (default: the ef tuned for K, or K)')
+parser.add_argument('--hnsw-metric', dest='hnsw_metric', default='l2', choices=['l2', 'ip'],
+                    help="HNSW: distance of the graph, 'ip' (inner product) ranks our L2-normalized descriptors like "
+                         "'l2' with less work per edge (default: 'l2')")
+parser.add_argument('--hnsw-storage', dest='hnsw_storage', default='float32', choices=['float32', 'float16', 'external'],
+                    help="HNSW: how the graph keeps the vectors, 'float16' halves their memory, 'external' reads them "
+                         "from the feature stores instead of copying them (default: 'float32')")
+parser.add_argument('--hnsw-reorder', dest='hnsw_reorder', action='store_true',
+                    help='HNSW/PQ_HNSW: with --ifgenerate, renumber the graph so that neighbours are stored close '
+                         'together (faster search on large memory-mapped indexes)')
+parser.add_argument('--hnsw-compress', dest='hnsw_compress', action='store_true',
+                    help='HNSW/PQ_HNSW: with --ifgenerate, store the neighbour lists delta coded and byte-packed without '
+                         'edge distances (several times smaller index)')
+parser.add_argument('--pq-table-bytes', dest='pq_table_bytes', default=2**30, type=int, metavar='BYTES',
+                    help='PQ_HNSW: with --ifgenerate, memory for the codeword distance tables of the graph construction, '
+                         'tables of the most frequent codewords replace codeword gathers (default: 2**30, 1 GB)')
+parser.add_argument('--tree-candidates', dest='tree_candidates', default=2000, type=int, metavar='N',
+                    help='VocabTree: number of images gathered from the closest leaves and rescored exactly (default: 2000)')
+parser.add_argument('--target-recall', '-recall', dest='target_recall', default=None, type=float, metavar='R',
+                    help='HNSW/PQ_HNSW: tune the search ef for this recall@K once and store it in the index (e.g. 0.95)')
 
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
@@ -82,34 +116,53 @@ transform = transforms.Compose([
 datasets = args.datasets.split(',')
 for dataset in datasets:
     print('>> {}: Extracting...'.format(dataset))
-    extr_selfmade_dataset(net, dataset, args.image_size, transform, ms)
+    extr_selfmade_dataset(net, dataset, args.image_size, transform, ms, network=args.network,
+                          incremental=args.incremental, use_hash=args.use_hash, extensions=args.extensions)
 
-dim_vec = 2048
-vecs = np.empty((dim_vec, 0))
-img_paths = []
-for dataset in datasets:
-    vecs_temp, img_r_path_temp = load_path_features(dataset)
-    vecs = np.concatenate([vecs, vecs_temp], axis=1)
-    images = ['/static/' + i for i in img_r_path_temp]
-    img_paths = img_paths + images
+# The feature stores of all datasets are presented as one N x D matrix without concatenating them
+vecs = load_feature_catalog(datasets, network=args.network)
+dim_vec = vecs.dim
 
 # During the offline procedure, qvec doesn't matter. It can be anything since the construction of tree, graph, etc does not
 # depend on qvec. Similar for K.
-qvec = np.zeros((dim_vec, 1))
+qvec = np.zeros((dim_vec, 1), dtype=np.float32)
 K = args.K_nearest_neighbour
 
+# With --dedup-threshold the indexes are built over one representative per group of near-duplicates
+db = vecs
+if args.dedup_threshold is not None:
+    groups = build_duplicate_groups(vecs, 'database', threshold=args.dedup_threshold)
+    db = groups.subset(vecs)
+
 # Note: parameters like N_books, n_bits_perbook, n_trees, etc will significantly influence the retrieval performance and efficiency
 # Usually larger values lead to better performance but slower retrieval time
 # If you want to change default values, don't forget to update the changes in online.py 
 if args.matching_method == 'L2':
-    match_idx, _ = matching_L2(K, vecs.T, qvec.T)
+    match_idx, _ = matching_L2(K, db, qvec.T)
+elif args.matching_method in ('FP16', 'INT8'):
+    # scalar-quantized copies of the feature stores, the top 200 are rescored with the float32 vectors
+    mode = {'FP16': 'float16', 'INT8': 'int8'}[args.matching_method]
+    if args.ifgenerate:
+        for dataset in datasets:
+            quantize_feature_store(dataset, mode)
+    match_idx, _ = matching_quantized(K, db, qvec.T, mode=mode, rescore=200)
 elif args.matching_method == 'PQ':
-    match_idx, _ = matching_Nano_PQ(K, vecs.T, qvec.T, dataset='database', N_books=16, n_bits_perbook=13, ifgenerate=args.ifgenerate)
+    match_idx, _ = matching_Nano_PQ(K, db, qvec.T, dataset='database', N_books=16, n_bits_perbook=13, ifgenerate=args.ifgenerate)
 elif args.matching_method == 'ANNOY':
-    match_idx, _ = matching_ANNOY(K, vecs.T, qvec.T, 'euclidean', dataset='database', n_trees=100, ifgenerate=args.ifgenerate)
+    match_idx, _ = matching_ANNOY(K, db, qvec.T, 'euclidean', dataset='database', n_trees=100, ifgenerate=args.ifgenerate)
 elif args.matching_method == 'HNSW':
-    match_idx, _ = matching_HNSW(K, vecs.T, qvec.T, dataset='database', m=16, ef=100, ifgenerate=args.ifgenerate)
+    match_idx, _ = matching_HNSW(K, db, qvec.T, dataset='database', m=16, ef=100, ifgenerate=args.ifgenerate,
+                                 ef_search=args.ef_search, target_recall=args.target_recall,
+                                 metric=args.hnsw_metric, storage=args.hnsw_storage, reorder=args.hnsw_reorder, compress=args.hnsw_compress)
 elif args.matching_method == 'PQ_HNSW':
-    match_idx, _ = matching_HNSW_NanoPQ(K, vecs.T, qvec.T, dataset='database', N_books=16, N_words=2**13, m=16, ef=100, ifgenerate=args.ifgenerate)
+    match_idx, _ = matching_HNSW_NanoPQ(K, db, qvec.T, dataset='database', N_books=16, N_words=2**13, m=16, ef=100, ifgenerate=args.ifgenerate,
+                                        ef_search=args.ef_search, target_recall=args.target_recall, reorder=args.hnsw_reorder, compress=args.hnsw_compress,
+                                        table_bytes=args.pq_table_bytes)
+elif args.matching_method == 'DiskANN':
+    # the graph and the vectors stay on disk, only the PQ codes are kept in memory
+    match_idx, _ = matching_DiskANN(K, db, qvec.T, dataset='database', R=64, L=100, N_books=32, ifgenerate=args.ifgenerate)
+elif args.matching_method == 'VocabTree':
+    match_idx, _ = matching_VocabTree(K, db, qvec.T, dataset='database', branching=16, depth=3, candidates=args.tree_candidates,
+                                      ifgenerate=args.ifgenerate)
 else:
     print('Invalid method')
\ No newline at end of file
@@ -13,9 +13,13 @@ from flask import Flask, request, render_template
 from pathlib import Path
 from src.datasets.testdataset import configdataset
 from src.utils.nnsearch import *
+from src.utils.diskann import build_diskann, load_diskann, matching_DiskANN
+from src.utils.vocabtree import build_vocabulary_tree, load_vocabulary_tree, matching_VocabTree
 from src.utils.Reranking import *
 from src.utils.networks import load_network
-from src.utils.general import load_path_features
+from src.utils.dedup import load_duplicate_groups
+from src.utils.featurestore import load_feature_catalog
+from src.utils.imagelist import image_list_matches
 
 
 datasets_names = ['oxford5k', 'paris6k', 'roxford5k', 'rparis6k', 'revisitop1m']
@@ -30,7 +34,7 @@ parser.add_argument('--datasets', '-d', metavar='DATASETS', default='roxford5k,r
                         " (default: 'roxford5k,rparis6k')")
 parser.add_argument('--K-nearest-neighbour', '-K', default=30, type=int, metavar='K',
                     help="retreive top-K results (default: 30)")
-parser.add_argument('--matching_method', '-mm', default='L2', help="select matching methods: L2, PQ, ANNOY, HNSW, PQ_HNSW")
+parser.add_argument('--matching_method', '-mm', default='L2', help="select matching methods: L2, FP16, INT8, PQ, ANNOY, HNSW, PQ_HNSW, DiskANN, VocabTree")
 parser.add_argument('--ifgenerate', '-gen', dest='ifgenerate', action='store_true',
                     help='Include --ifgenerate if the trees/graphs/distance tables have not been generated and saved')
 parser.add_argument('--image-size', '-imsize', dest='image_size', default=1024, type=int, metavar='N',
@@ -42,6 +46,30 @@ parser.add_argument('--soa', action='store_true',
                     help='use soa blocks')
 parser.add_argument('--soa-layers', type=str, default='45',
                     help='config soa blocks for second-order attention')
+parser.add_argument('--dedup-threshold', '-dedup', dest='dedup_threshold', default=None, type=float, metavar='T',
+                    help='search the near-duplicate groups built by offline.py with the same threshold '
+                         'and return all members of the retrieved groups (default: no collapsing)')
+parser.add_argument('--ef-search', '-efs', dest='ef_search', default=None, type=int, metavar='EF',
+                    help='HNSW/PQ_HNSW: size of the candidate list of the search (default: the ef tuned for K, or K)')
+parser.add_argument('--hnsw-metric', dest='hnsw_metric', default='l2', choices=['l2', 'ip'],
+                    help="HNSW: distance of the graph, 'ip' (inner product) ranks our L2-normalized descriptors like "
+                         "'l2' with less work per edge (default: 'l2')")
+parser.add_argument('--hnsw-storage', dest='hnsw_storage', default='float32', choices=['float32', 'float16', 'external'],
+                    help="HNSW: how the graph keeps the vectors, 'float16' halves their memory, 'external' reads them "
+                         "from the feature stores instead of copying them (default: 'float32')")
+parser.add_argument('--hnsw-reorder', dest='hnsw_reorder', action='store_true',
+                    help='HNSW/PQ_HNSW: with --ifgenerate, renumber the graph so that neighbours are stored close '
+                         'together (faster search on large memory-mapped indexes)')
+parser.add_argument('--hnsw-compress', dest='hnsw_compress', action='store_true',
+                    help='HNSW/PQ_HNSW: with --ifgenerate, store the neighbour lists delta coded and byte-packed without '
+                         'edge distances (several times smaller index)')
+parser.add_argument('--pq-table-bytes', dest='pq_table_bytes', default=2**30, type=int, metavar='BYTES',
+                    help='PQ_HNSW: with --ifgenerate, memory for the codeword distance tables of the graph construction, '
+                         'tables of the most frequent codewords replace codeword gathers (default: 2**30, 1 GB)')
+parser.add_argument('--tree-candidates', dest='tree_candidates', default=2000, type=int, metavar='N',
+                    help='VocabTree: number of images gathered from the closest leaves and rescored exactly (default: 2000)')
+parser.add_argument('--target-recall', '-recall', dest='target_recall', default=None, type=float, metavar='R',
+                    help='HNSW/PQ_HNSW: tune the search ef for this recall@K once and store it in the index (e.g. 0.95)')
 
 # GPU ID
 parser.add_argument('--gpu-id', '-g', default='0', metavar='N',
@@ -88,18 +116,36 @@ transform = transforms.Compose([
 #############
 # Read image features
 datasets = args.datasets.split(',')
-dim_vec = 2048
-vecs = np.empty((dim_vec, 0))
-img_paths = []
-for dataset in datasets:
-    vecs_temp, img_r_path_temp = load_path_features(dataset)
-    vecs = np.concatenate([vecs, vecs_temp], axis=1)
-    images = ['/static/' + i for i in img_r_path_temp]
-    img_paths = img_paths + images
-
-rel_img_paths = [os.path.relpath(path, '/static/test/') for path in img_paths]
+# The feature stores of all datasets are presented as one N x D matrix without concatenating them
+vecs = load_feature_catalog(datasets, network=args.network)
+dim_vec = vecs.dim
+# the image lists written by offline.py, results of a dataset whose images changed since the extraction may be stale
+for name, store in zip(vecs.names, vecs.stores):
+    if not image_list_matches(name, store.paths):
+        print('>> {}: images were added or removed since the features were extracted, '
+              'run offline.py with --incremental'.format(name))
+# vecs.paths is a memory-mapped path table, the '/static/' prefix is only added to the returned results
 K = args.K_nearest_neighbour
 
+# With --dedup-threshold the indexes hold one representative per group of near-duplicates
+db = vecs
+groups = None
+if args.dedup_threshold is not None:
+    groups = load_duplicate_groups(vecs, 'database', threshold=args.dedup_threshold)
+    db = groups.subset(vecs)
+
+# DiskANN and VocabTree are opened once, DiskANN keeps its file and a cache of the nodes around the entry point
+disk_index = None
+if args.matching_method == 'DiskANN':
+    if args.ifgenerate:
+        build_diskann(db, 'database', R=64, L=100, N_books=32)
+    disk_index = load_diskann(db, 'database', R=64, L=100, N_books=32)
+tree_index = None
+if args.matching_method == 'VocabTree':
+    if args.ifgenerate:
+        build_vocabulary_tree(db, 'database', branching=16, depth=3)
+    tree_index = load_vocabulary_tree(db, 'database', branching=16, depth=3)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -116,6 +162,14 @@ def index():
         qvec = extract_vectors_single(net, uploaded_img_path, args.image_size, transform, ms=ms)
         qvec = np.expand_dims(qvec.numpy(), axis=1)
 
+        # Optional filter: only return images of the selected collections (datasets)
+        collections = request.form.getlist('collections')
+        allowed = None
+        if collections and set(collections) != set(vecs.names):
+            allowed = vecs.collection_mask(collections)
+        # HNSW applies the filter during the graph search, the mask is over the indexed rows
+        db_allowed = allowed if allowed is None or groups is None else groups.group_mask(allowed)
+
         # Run search
         # Select methods for preliminary ranking
         # Set ifgenerate=True for the first time to build trees/graphs or to do quantization
@@ -124,32 +178,56 @@ def index():
         # Note: parameters like N_books, n_bits_perbook, n_trees, etc will significantly influence the retrieval performance and efficiency
         # Usually larger values lead to better performance but slower retrieval time
         if args.matching_method == 'L2':
-            match_idx, _ = matching_L2(K, vecs.T, qvec.T)
+            match_idx, _ = matching_L2(K, db, qvec.T)
+        elif args.matching_method in ('FP16', 'INT8'):
+            mode = {'FP16': 'float16', 'INT8': 'int8'}[args.matching_method]
+            match_idx, _ = matching_quantized(K, db, qvec.T, mode=mode, rescore=200)
         elif args.matching_method == 'PQ':
-            match_idx, _ = matching_Nano_PQ(K, vecs.T, qvec.T, dataset='database', N_books=16, n_bits_perbook=13, ifgenerate=args.ifgenerate)
+            match_idx, _ = matching_Nano_PQ(K, db, qvec.T, dataset='database', N_books=16, n_bits_perbook=13, ifgenerate=args.ifgenerate)
         elif args.matching_method == 'ANNOY':
-            match_idx, _ = matching_ANNOY(K, vecs.T, qvec.T, 'euclidean', dataset='database', n_trees=100, ifgenerate=args.ifgenerate)
+            match_idx, _ = matching_ANNOY(K, db, qvec.T, 'euclidean', dataset='database', n_trees=100, ifgenerate=args.ifgenerate)
         elif args.matching_method == 'HNSW':
-            match_idx, _ = matching_HNSW(K, vecs.T, qvec.T, dataset='database', m=16, ef=100, ifgenerate=args.ifgenerate)
+            match_idx, _ = matching_HNSW(K, db, qvec.T, dataset='database', m=16, ef=100, ifgenerate=args.ifgenerate,
+                                         ef_search=args.ef_search, target_recall=args.target_recall,
+                                         metric=args.hnsw_metric, storage=args.hnsw_storage, reorder=args.hnsw_reorder, compress=args.hnsw_compress, allowed=db_allowed)
         elif args.matching_method == 'PQ_HNSW':
-            match_idx, _ = matching_HNSW_NanoPQ(K, vecs.T, qvec.T, dataset='database', N_books=16, N_words=2**13, m=16, ef=100, ifgenerate=args.ifgenerate)
+            match_idx, _ = matching_HNSW_NanoPQ(K, db, qvec.T, dataset='database', N_books=16, N_words=2**13, m=16, ef=100, ifgenerate=args.ifgenerate,
+                                                ef_search=args.ef_search, target_recall=args.target_recall, reorder=args.hnsw_reorder, compress=args.hnsw_compress,
+                                                table_bytes=args.pq_table_bytes)
+        elif args.matching_method == 'DiskANN':
+            match_idx, _ = matching_DiskANN(K, db, qvec.T, dataset='database', index=disk_index)
+        elif args.matching_method == 'VocabTree':
+            match_idx, _ = matching_VocabTree(K, db, qvec.T, dataset='database', candidates=args.tree_candidates, index=tree_index)
         else:
             print('Invalid method')
 
-        
+        if groups is not None:
+            # positions among the representatives -> ids of all group members
+            match_idx = groups.expand(match_idx, K, allowed=allowed)
+
         # Re-ranking
-        ranks = match_idx.T
-        ranks2 = qge1(ranks, qvec, vecs, K)
-        idx2 = ranks2.T
+        ranks = match_idx[:, match_idx[0] >= 0].T
+        if len(ranks) >= 3:
+            ranks2 = qge1(ranks, qvec, vecs, K)
+            idx2 = ranks2.T
+        else:
+            idx2 = ranks.T
+        # the query expansion ranks the whole database again, keep the selected collections only
+        order = np.ravel(idx2)
+        if allowed is not None:
+            order = order[allowed[order]]
 
+        img_paths = ['/static/' + path for path in vecs.paths[order[:K]]]
         # scores1 = [(id, img_paths[id]) for id in np.squeeze(match_idx)[:10]]
-        scores2 = [(rel_img_paths[id], img_paths[id]) for id in np.squeeze(idx2)[:K]]
+        scores2 = [(os.path.relpath(path, '/static/test/'), path) for path in img_paths]
         return render_template('index.html', 
                                query_path=query_path,
+                               collections=vecs.names,
+                               selected=collections,
                             #    scores=scores1,
                                marks=scores2)
     else:
-        return render_template('index.html')
+        return render_template('index.html', collections=vecs.names)
 
 
 if __name__=="__main__":
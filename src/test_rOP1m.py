@@ -17,6 +17,7 @@ from src.datasets.testdataset import configdataset
 from src.utils.download import download_test
 from src.utils.evaluate import compute_map_and_print
 from src.utils.general import get_data_root, htime, save_path_feature, load_path_features
+from src.utils.featurestore import MANIFEST_FILE, feature_store_dir, load_feature_store
 from src.utils.networks import load_network
 from src.utils.Reranking import *
 
@@ -129,8 +130,13 @@ def main():
             qvecs, _ = load_path_features(dataset + '_query')
 
         if args.include1m: # whether to include 1 million distractors
-            vecs_1m = torch.load(args.network + '_vecs_' + 'revisitop1m' + '.pt')
-            vecs_1m = vecs_1m.numpy()
+            if os.path.exists(os.path.join(feature_store_dir('revisitop1m'), MANIFEST_FILE)):
+                # extracted by extract_1m.py
+                vecs_1m = load_feature_store('revisitop1m', network=args.network).vecs.T
+            else:
+                # downloaded pre-extracted features
+                vecs_1m = torch.load(args.network + '_vecs_' + 'revisitop1m' + '.pt')
+                vecs_1m = vecs_1m.numpy()
             vecs = np.concatenate([vecs, vecs_1m], axis=1)
 
         print('>> {}: Evaluating...'.format(dataset))
@@ -24,6 +24,7 @@ from src.utils.adalam import AdalamFilter
 from src.utils.dataset import Dataset
 from src.utils.diffusion import Diffusion
 from src.utils.knn import KNN
+from src.utils.featurestore import FeatureCatalog
 from src.utils.nnsearch import *
 from src.utils.evaluate import compute_map_and_print
 from src.utils.evaluate2 import compute_map_and_print2
@@ -192,7 +193,7 @@ We use diffusion from: https://github.com/fyang93/diffusion
 def QGE(ranks, qvecs, vecs, dataset, gnd, cache_dir, gnd_path2, AQE):
     def feature_enhancement(it_times, k, ranks, qvecs, vecs, w):
         for it_time in range(it_times):
-            qe_weight = (np.arange(k, 0, -1) / k).reshape(1, k, 1) # build an array, [1, 1/2, ..., 1/k]
+            qe_weight = (np.arange(k, 0, -1, dtype=np.float32) / k).reshape(1, k, 1) # build an array, [1, 1/2, ..., 1/k]
             ranks_top = ranks[:k, int(0): int(ranks.shape[1])]
             top_k_vecs = vecs[:, ranks_top]
             # If we have query images in databases, we can use the following line.
@@ -283,10 +284,20 @@ def QGE(ranks, qvecs, vecs, dataset, gnd, cache_dir, gnd_path2, AQE):
        print('----------------------------------------')
         
 def qge1(ranks, qvec, vecs, K):
+    # vecs is either the D x N database matrix or an N x D FeatureCatalog
     def feature_enhancement(it_times, k, ranks, qvecs, vecs, w):
         for it_time in range(it_times):
-            qe_weight = (np.arange(k, 0, -1) / k).reshape(1, k, 1) # build an array, [1, 1/2, ..., 1/k]
+            qe_weight = (np.arange(k, 0, -1, dtype=np.float32) / k).reshape(1, k, 1) # build an array, [1, 1/2, ..., 1/k]
             ranks_top = ranks[:k, int(0): int(ranks.shape[1])]
+            if isinstance(vecs, FeatureCatalog):
+                # gather only the top-k rows and score the database store by store
+                top_k_vecs = np.moveaxis(vecs[ranks_top], -1, 0)
+                qvecs_top = (top_k_vecs * (qe_weight ** w)).sum(axis=1)
+                qvecs_top = qvecs_top / (np.linalg.norm(qvecs_top, ord=2, axis=0, keepdims=True) + 1e-6)
+                qvecs_qe = qvecs_top
+                scores_aqe = vecs.dot(qvecs_qe)
+                ranks_aqe = np.argsort(-scores_aqe, axis=0)
+                continue
             top_k_vecs = vecs[:, ranks_top]
             # If we have query images in databases, we can use the following line.
             qvecs_top = (top_k_vecs * (qe_weight ** w)).sum(axis=1)
@@ -300,6 +311,8 @@ def qge1(ranks, qvec, vecs, K):
     k = 3 
     w = 8. / 2
     it_times = 1 
+    # float32 like the database, a float64 query would upcast every scoring pass
+    qvec = np.ascontiguousarray(qvec, dtype=np.float32)
     qvecs_qe, ranks_aqe = feature_enhancement(it_times, k, ranks, qvec, vecs, w)
     return ranks_aqe
 
@@ -0,0 +1,265 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the near-duplicate collapsing stage of the offline pipeline
+
+Historical archives contain many re-scans and copies of the same print. All pairs of images
+within `threshold` (L2 distance of the normalized descriptors) are found from coarse quantization
+codes: the images are bucketed by their closest k-means centroid and compared with the buckets
+they probe (small collections are compared exhaustively). Then every image in id order that is
+not yet grouped becomes the representative of the ungrouped images within `threshold` of it. threshold=0 only collapses
+exact duplicates. The indexes store the representatives only, search results are expanded back
+to all members.
+"""
+
+import time
+import numpy as np
+from sklearn.cluster import KMeans
+
+from src.utils.featurestore import FeatureSubset, iter_chunks
+from src.utils.indexstore import IndexWriter, load_index
+
+
+def _l2_normalize(x):
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+class DuplicateGroups(object):
+    '''
+        representatives: increasing ids of the group representatives (one per group)
+        group_members[group_offsets[g]:group_offsets[g+1]]: ids of the members of group g,
+        the representative first
+    '''
+
+    def __init__(self, representatives, group_offsets, group_members):
+        self.representatives = representatives
+        self.group_offsets = group_offsets
+        self.group_members = group_members
+
+    def __len__(self):
+        return len(self.representatives)
+
+    @property
+    def num_images(self):
+        return len(self.group_members)
+
+    def subset(self, features):
+        # the representatives of features as an n_groups x D matrix
+        return FeatureSubset(features, self.representatives)
+
+    def members(self, g):
+        return self.group_members[self.group_offsets[g]:self.group_offsets[g+1]]
+
+    def group_mask(self, allowed):
+        # groups with at least one member in the bool mask allowed over the image ids
+        return np.logical_or.reduceat(allowed[self.group_members], self.group_offsets[:-1])
+
+    def expand(self, idx, K, allowed=None):
+        '''
+            Inputs:
+                idx: N_query x k positions in the representatives (as returned by a search on subset()),
+                     -1 for missing results
+                K: number of results per query
+                allowed: optional bool mask over the image ids, other group members are dropped
+            Outputs:
+                N_query x K image ids, the members of every returned group in ranking order,
+                -1 where fewer than K members were found
+        '''
+        num_query = idx.shape[0]
+        K = min(K, self.num_images)
+        out = np.full((num_query, K), -1, dtype=np.int64)
+        for row in range(num_query):
+            res = np.concatenate([self.members(g) for g in idx[row] if g >= 0] or [np.zeros(0, np.int64)])
+            if allowed is not None:
+                res = res[allowed[res]]
+            res = res[:K]
+            out[row, :len(res)] = res
+        return out
+
+
+def _check_pairs(features, i, j, threshold):
+    # the candidate pairs (i, j) whose normalized descriptors are within threshold
+    diff = _l2_normalize(np.asarray(features[i], dtype=np.float32)) - \
+        _l2_normalize(np.asarray(features[j], dtype=np.float32))
+    close = np.linalg.norm(diff, axis=1) <= threshold
+    return i[close], j[close]
+
+
+def _sorted_pairs(first, second):
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    first, second = np.concatenate(first), np.concatenate(second)
+    order = np.lexsort((second, first))
+    return first[order], second[order]
+
+
+def exact_pairs(features, threshold, block_size=4096, chunk_size=65536):
+    '''
+        All pairs of rows within threshold by comparing every row with every other, O(N^2 D),
+        only used for small collections (see range_pairs)
+        Outputs:
+            first, second: ids of the pairs, first < second, sorted by first
+    '''
+    num = len(features)
+    # candidates by inner product (||x - y||^2 = 2 - 2 x.y), with a margin for the rounding of the
+    # product, the candidates are then checked on the difference of the vectors
+    limit = threshold ** 2 + 1e-4
+    first, second = [], []
+    for q0 in range(0, num, block_size):
+        block = _l2_normalize(np.asarray(features[q0:q0 + block_size], dtype=np.float32))
+        # only the rows after the block start, every pair is found once
+        for c0 in range(q0, num, chunk_size):
+            chunk = _l2_normalize(np.asarray(features[c0:c0 + chunk_size], dtype=np.float32))
+            dist = 2 - 2 * (block @ chunk.T)
+            i, j = np.nonzero(dist <= limit)
+            i, j = i + q0, j + c0
+            keep = i < j
+            if keep.any():
+                i, j = _check_pairs(features, i[keep], j[keep], threshold)
+                first.append(i)
+                second.append(j)
+    return _sorted_pairs(first, second)
+
+
+def bucket_pairs(features, threshold, N_words=None, n_train=100000, block_size=4096):
+    '''
+        All pairs of rows within threshold, the candidates come from coarse quantization codes.
+        Every image is put in the bucket of its closest k-means centroid and probes all buckets
+        whose centroid c is within d(x, c) <= d(x, c(x)) + 2 * threshold. If ||x - y|| <= threshold,
+        y lies in the bucket c(y) and d(x, c(y)) <= d(y, c(y)) + t <= d(y, c(x)) + t <= d(x, c(x)) + 2t,
+        so x probes the bucket of y: pairs across bucket boundaries are found, and every candidate
+        is checked on the exact distance.
+        Inputs:
+            features: N x D descriptors (array, FeatureStore or FeatureCatalog)
+            threshold: maximum L2 distance
+            N_words: number of buckets (default: sqrt(N), at most 4096)
+            n_train: number of descriptors the centroids are trained on
+            block_size: number of probing images compared with a bucket at a time
+        Outputs:
+            first, second: ids of the pairs, first < second, sorted by first
+    '''
+    num = len(features)
+    if N_words is None:
+        N_words = int(min(4096, max(1, np.sqrt(num))))
+    rng = np.random.default_rng(42)
+    train_ids = np.sort(rng.choice(num, size=min(num, max(n_train, N_words)), replace=False))
+    kmeans = KMeans(n_clusters=min(N_words, len(train_ids)), n_init=1, max_iter=20, random_state=0)
+    centroids = kmeans.fit(_l2_normalize(np.asarray(features[train_ids], dtype=np.float32))).cluster_centers_
+    centroids = centroids.astype(np.float32)
+    c_sqnorms = (centroids ** 2).sum(axis=1)
+
+    # bucket of every image and the (image, bucket) probes, margin for the rounding of the distances
+    bucket = np.empty(num, dtype=np.int64)
+    probe_ids, probe_buckets = [], []
+    for start, block in iter_chunks(features, block_size):
+        block = _l2_normalize(np.asarray(block, dtype=np.float32))
+        dist = np.sqrt(np.maximum(1 - 2 * (block @ centroids.T) + c_sqnorms, 0))
+        bucket[start:start + len(block)] = dist.argmin(axis=1)
+        i, b = np.nonzero(dist <= dist.min(axis=1, keepdims=True) + 2 * threshold + 1e-3)
+        probe_ids.append(i + start)
+        probe_buckets.append(b)
+    probe_ids, probe_buckets = np.concatenate(probe_ids), np.concatenate(probe_buckets)
+    order = np.argsort(bucket, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(bucket, minlength=len(centroids)))])
+    probe_order = np.argsort(probe_buckets, kind='stable')
+    probe_ids = probe_ids[probe_order]
+    probe_offsets = np.concatenate([[0], np.cumsum(np.bincount(probe_buckets, minlength=len(centroids)))])
+
+    limit = threshold ** 2 + 1e-4
+    first, second = [], []
+    for b in range(len(centroids)):
+        members = order[offsets[b]:offsets[b+1]]
+        probers = probe_ids[probe_offsets[b]:probe_offsets[b+1]]
+        if not len(members) or len(probers) < 2:
+            continue
+        member_vecs = _l2_normalize(np.asarray(features[members], dtype=np.float32))
+        for p0 in range(0, len(probers), block_size):
+            ids = probers[p0:p0 + block_size]
+            dist = 2 - 2 * (_l2_normalize(np.asarray(features[ids], dtype=np.float32)) @ member_vecs.T)
+            i, j = np.nonzero(dist <= limit)
+            i, j = ids[i], members[j]
+            keep = i != j
+            if not keep.any():
+                continue
+            # a pair inside one bucket is found from both sides
+            pairs = np.unique(np.stack([np.minimum(i[keep], j[keep]), np.maximum(i[keep], j[keep])]), axis=1)
+            i, j = _check_pairs(features, pairs[0], pairs[1], threshold)
+            first.append(i)
+            second.append(j)
+    first, second = _sorted_pairs(first, second)
+    if len(first):
+        # pairs of images in different buckets are found by both buckets when both probe
+        keep = np.concatenate([[True], (first[1:] != first[:-1]) | (second[1:] != second[:-1])])
+        first, second = first[keep], second[keep]
+    return first, second
+
+
+def range_pairs(features, threshold, exact_max=20000, block_size=4096, chunk_size=65536, N_words=None, n_train=100000):
+    '''
+        All pairs of rows whose normalized descriptors are within threshold, by bucket_pairs or,
+        for collections of at most exact_max images, by exact_pairs. Every pair is kept in memory,
+        so the threshold should only cover near-copies.
+        Outputs:
+            first, second: ids of the pairs, first < second, sorted by first
+    '''
+    if len(features) <= exact_max:
+        return exact_pairs(features, threshold, block_size=block_size, chunk_size=chunk_size)
+    return bucket_pairs(features, threshold, N_words=N_words, n_train=n_train, block_size=block_size)
+
+
+def find_duplicate_groups(features, threshold=0.0, exact_max=20000, N_words=None):
+    '''
+        Inputs:
+            features: N x D descriptors (array, FeatureStore or FeatureCatalog)
+            threshold: maximum L2 distance between normalized descriptors of a group member and
+                       its representative
+            exact_max: collections up to this size are compared exhaustively (see range_pairs)
+            N_words: number of buckets of the larger collections (see bucket_pairs)
+        Outputs:
+            DuplicateGroups
+    '''
+    t1 = time.time()
+    num = len(features)
+    first, second = range_pairs(features, threshold, exact_max=exact_max, N_words=N_words)
+
+    # leader clustering in id order: the first ungrouped image becomes the representative of all
+    # ungrouped images within threshold. Images before it are already grouped, so only the pairs
+    # (i, j > i) are needed, and images without any pair stay alone.
+    leader = np.arange(num, dtype=np.int64)
+    grouped = np.zeros(num, dtype=bool)
+    starts = np.flatnonzero(np.concatenate([[True], first[1:] != first[:-1]])) if len(first) else []
+    ends = np.append(starts[1:], len(first)) if len(first) else []
+    for start, end in zip(starts, ends):
+        i = first[start]
+        if grouped[i]:
+            continue
+        close = second[start:end]
+        close = close[~grouped[close]]
+        leader[close] = i
+        grouped[close] = True
+
+    representatives, group = np.unique(leader, return_inverse=True)
+    group_members = np.argsort(group, kind='stable')
+    group_offsets = np.concatenate([[0], np.cumsum(np.bincount(group, minlength=len(representatives)))])
+    t2 = time.time()
+    print('>> Duplicates: {} images in {} groups ({:.1f}% collapsed) in {:.1f}s'.format(
+        num, len(representatives), 100 * (1 - len(representatives) / max(num, 1)), t2 - t1))
+    return DuplicateGroups(representatives, group_offsets, group_members)
+
+
+def build_duplicate_groups(features, dataset, threshold=0.0):
+    # find the groups and save them as the 'dedup' index of dataset
+    params = {'threshold': threshold}
+    groups = find_duplicate_groups(features, threshold=threshold)
+    writer = IndexWriter(dataset, 'dedup', params, features)
+    writer.save_array('representatives', groups.representatives)
+    writer.save_array('group_offsets', groups.group_offsets)
+    writer.save_array('group_members', groups.group_members)
+    writer.commit()
+    return groups
+
+
+def load_duplicate_groups(features, dataset, threshold=0.0):
+    params = {'threshold': threshold}
+    index = load_index(dataset, 'dedup', params, features)
+    return DuplicateGroups(index.array('representatives'), index.array('group_offsets'),
+                           index.array('group_members'))
@@ -0,0 +1,426 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the disk-resident graph index (Vamana graph as in DiskANN)
+
+For collections whose vectors do not fit in memory. The index is a single-layer Vamana graph
+whose nodes are stored in diskann.bin as fixed-size records (normalized float32 vector, number
+of neighbours, neighbour ids) packed into 4096-byte sectors, so that a node is read with one
+sector-aligned pread. Only the PQ codes of the database (nanopq, as in matching_Nano_PQ) and a
+cache of the nodes around the entry point are kept in memory: the search walks the graph by PQ
+distance, reads beam_width nodes per round and computes exact distances for the read nodes only.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush, heapreplace
+
+import numpy as np
+import nanopq
+
+from src.utils.featurestore import iter_chunks
+from src.utils.indexstore import IndexWriter, load_index
+from src.utils.nnsearch import as_float32, check_features, l2_normalize, pq_encode_chunked, pq_from_codewords, print_latency
+
+SECTOR = 4096
+
+
+def _rows(features, ids):
+    # normalized float32 rows of features
+    return l2_normalize(as_float32(features[np.asarray(ids, dtype=np.int64)]))
+
+
+def find_medoid(features, chunk_size=65536):
+    # id of the vector closest to the mean of the normalized vectors, the entry point of the graph
+    total = None
+    for _, block in iter_chunks(features, chunk_size):
+        s = l2_normalize(as_float32(block)).sum(axis=0, dtype=np.float64)
+        total = s if total is None else total + s
+    mean = (total / len(features)).astype(np.float32)
+    best, best_dist = 0, np.inf
+    for start, block in iter_chunks(features, chunk_size):
+        dist = ((l2_normalize(as_float32(block)) - mean) ** 2).sum(axis=1)
+        i = int(np.argmin(dist))
+        if dist[i] < best_dist:
+            best, best_dist = start + i, float(dist[i])
+    return best
+
+
+class VamanaBuilder(object):
+    '''
+        In-memory construction of a Vamana graph (Subramanya et al., DiskANN, NeurIPS 2019).
+        neighbors is an N x R int32 matrix (-1 padded) with counts[i] neighbours in row i. Vectors
+        are gathered from the features when needed, the features are never loaded as a whole.
+    '''
+
+    def __init__(self, features, R=64, L=100, alpha=1.2, seed=0):
+        self.features = features
+        self.R = R
+        self.L = L
+        self.alpha = alpha
+        self.rng = np.random.default_rng(seed)
+        num = len(features)
+        self.medoid = find_medoid(features)
+        # random initial graph
+        degree = min(R, num - 1)
+        self.neighbors = np.full((num, R), -1, dtype=np.int32)
+        if degree > 0:
+            init = self.rng.integers(0, num - 1, size=(num, degree))
+            # skip the node itself (duplicate neighbours are removed by the first prune)
+            init += init >= np.arange(num)[:, None]
+            self.neighbors[:, :degree] = init
+        self.counts = np.full(num, degree, dtype=np.int32)
+
+    def _distances(self, vec, ids):
+        # squared L2 distances between a normalized vector and the normalized rows ids
+        return np.maximum(2 - 2 * (_rows(self.features, ids) @ vec), 0)
+
+    def greedy_search(self, vec, L):
+        '''
+            Beam search from the medoid with a candidate list of L elements
+            Outputs:
+                ids and distances of the expanded nodes
+        '''
+        start = self.medoid
+        dist = float(self._distances(vec, [start])[0])
+        candidates = [(dist, start)]
+        top = [(-dist, start)]
+        visited = {start}
+        expanded_ids, expanded_dists = [], []
+        while candidates:
+            dist, c = heappop(candidates)
+            if len(top) >= L and dist > -top[0][0]:
+                break
+            expanded_ids.append(c)
+            expanded_dists.append(dist)
+            edges = [e for e in self.neighbors[c, :self.counts[c]].tolist() if e not in visited]
+            if not edges:
+                continue
+            visited.update(edges)
+            for e, d in zip(edges, self._distances(vec, edges).tolist()):
+                if len(top) < L or d < -top[0][0]:
+                    heappush(candidates, (d, e))
+                    if len(top) < L:
+                        heappush(top, (-d, e))
+                    else:
+                        heapreplace(top, (-d, e))
+        return np.array(expanded_ids, dtype=np.int64), np.array(expanded_dists, dtype=np.float32)
+
+    def robust_prune(self, p, ids, dists, alpha):
+        '''
+            Neighbours of p among the candidates ids (at distances dists): the closest candidate is
+            kept and every candidate c with alpha * d(kept, c) <= d(p, c) is dropped, until R are kept.
+            d is the L2 distance, dists are squared distances and are compared with alpha ** 2.
+        '''
+        ids, first = np.unique(ids, return_index=True)
+        dists = dists[first]
+        ids, dists = ids[ids != p], dists[ids != p]
+        order = np.argsort(dists, kind='stable')
+        ids, dists = ids[order], dists[order]
+        vecs = _rows(self.features, ids)
+        alpha2 = alpha * alpha
+        alive = np.ones(len(ids), dtype=bool)
+        keep = []
+        for i in range(len(ids)):
+            if not alive[i]:
+                continue
+            keep.append(ids[i])
+            if len(keep) == self.R:
+                break
+            d = np.maximum(2 - 2 * (vecs[i+1:] @ vecs[i]), 0)
+            alive[i+1:] &= alpha2 * d > dists[i+1:]
+        return np.array(keep, dtype=np.int64)
+
+    def _set_neighbors(self, p, ids):
+        self.neighbors[p, :len(ids)] = ids
+        self.neighbors[p, len(ids):] = -1
+        self.counts[p] = len(ids)
+
+    def insert(self, p, alpha):
+        # search p, prune its candidates and add the backlinks, pruning the rows that overflow
+        vec = _rows(self.features, [p])[0]
+        ids, dists = self.greedy_search(vec, self.L)
+        own = self.neighbors[p, :self.counts[p]].astype(np.int64)
+        ids = np.concatenate([ids, own])
+        dists = np.concatenate([dists, self._distances(vec, own)])
+        new = self.robust_prune(p, ids, dists, alpha)
+        self._set_neighbors(p, new)
+        for j in new.tolist():
+            row = self.neighbors[j, :self.counts[j]]
+            if p in row:
+                continue
+            if self.counts[j] < self.R:
+                self.neighbors[j, self.counts[j]] = p
+                self.counts[j] += 1
+            else:
+                cand = np.append(row.astype(np.int64), p)
+                self._set_neighbors(j, self.robust_prune(j, cand, self._distances(_rows(self.features, [j])[0], cand), alpha))
+
+    def build(self, verbose=True):
+        # two passes over the points in random order, the first with alpha = 1
+        num = len(self.features)
+        for alpha in (1.0, self.alpha):
+            t1 = time.time()
+            for i, p in enumerate(self.rng.permutation(num).tolist()):
+                self.insert(p, alpha)
+                if verbose and (i + 1) % 10000 == 0:
+                    print('>> Vamana (alpha={}): {}/{} points, {:.1f}s'.format(alpha, i + 1, num, time.time() - t1))
+        return self.neighbors, self.counts
+
+
+def node_layout(dim, R):
+    '''
+        Record of a node in diskann.bin and how the records are placed in sectors
+        Outputs:
+            dtype: record dtype (vector, count, neighbours)
+            per_block: number of records in a block
+            block_bytes: size of a block, a multiple of SECTOR; record i is at byte
+                         (i // per_block) * block_bytes + (i % per_block) * dtype.itemsize
+    '''
+    dtype = np.dtype([('vec', '<f4', (dim,)), ('count', '<u4'), ('neighbors', '<u4', (R,))])
+    if dtype.itemsize <= SECTOR:
+        return dtype, SECTOR // dtype.itemsize, SECTOR
+    return dtype, 1, -(-dtype.itemsize // SECTOR) * SECTOR
+
+
+def write_disk_graph(path, features, neighbors, counts, chunk_size=16384):
+    # write the nodes of the graph with their normalized vectors into path, see node_layout
+    num, R = neighbors.shape
+    dtype, per_block, block_bytes = node_layout(features.shape[1], R)
+    chunk_size = max(per_block, chunk_size // per_block * per_block)
+    with open(path, 'wb') as f:
+        for start in range(0, num, chunk_size):
+            end = min(start + chunk_size, num)
+            num_blocks = -(-(end - start) // per_block)
+            records = np.zeros(num_blocks * per_block, dtype=dtype)
+            records['vec'][:end - start] = _rows(features, np.arange(start, end))
+            records['count'][:end - start] = counts[start:end]
+            records['neighbors'][:end - start] = np.maximum(neighbors[start:end], 0)
+            # the records of a block are followed by zero padding up to the block size
+            blocks = np.zeros((num_blocks, block_bytes), dtype=np.uint8)
+            blocks[:, :per_block * dtype.itemsize] = records.view(np.uint8).reshape(num_blocks, -1)
+            f.write(blocks.tobytes())
+
+
+class DiskANN(object):
+    '''
+        Search side of a disk-resident Vamana index
+        Inputs:
+            path: diskann.bin
+            meta: layout of the index (manifest['diskann'])
+            pq: trained nanopq.PQ, codes: N x N_books PQ codes of the database (kept in memory)
+            L: default size of the candidate list, beam_width: nodes read per round
+            cache_nodes: number of nodes around the entry point kept in memory
+    '''
+
+    def __init__(self, path, meta, pq, codes, L=100, beam_width=4, cache_nodes=10000):
+        self.meta = meta
+        self.pq = pq
+        self.codes = np.asarray(codes)
+        self.L = L
+        self.beam_width = beam_width
+        self.dtype, self.per_block, self.block_bytes = node_layout(meta['dim'], meta['R'])
+        self.fd = os.open(path, os.O_RDONLY)
+        if hasattr(os, 'posix_fadvise'):
+            # the reads are random, read-ahead would only fill the page cache
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_RANDOM)
+        self._io = ThreadPoolExecutor(max_workers=beam_width) if beam_width > 1 else None
+        self.cache = {}
+        self._fill_cache(cache_nodes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def close(self):
+        if self._io is not None:
+            self._io.shutdown()
+        os.close(self.fd)
+
+    def _read_block(self, block):
+        data = os.pread(self.fd, self.block_bytes, block * self.block_bytes)
+        return np.frombuffer(data, dtype=self.dtype, count=self.per_block)
+
+    def read_nodes(self, ids):
+        '''
+            Inputs:
+                ids: node ids
+            Outputs:
+                list of (vector, neighbour ids) of the nodes, one sector-aligned read per block
+        '''
+        nodes = {i: self.cache[i] for i in ids if i in self.cache}
+        missing = [i for i in ids if i not in nodes]
+        blocks = sorted(set(i // self.per_block for i in missing))
+        if blocks:
+            read = self._io.map(self._read_block, blocks) if self._io is not None and len(blocks) > 1 else map(self._read_block, blocks)
+            records = dict(zip(blocks, read))
+            for i in missing:
+                record = records[i // self.per_block][i % self.per_block]
+                nodes[i] = (record['vec'], record['neighbors'][:record['count']].astype(np.int64))
+        return [nodes[i] for i in ids]
+
+    def _fill_cache(self, cache_nodes):
+        # breadth-first from the entry point, these nodes are read by almost every search
+        frontier = [self.meta['medoid']]
+        seen = set(frontier)
+        while frontier and len(self.cache) < cache_nodes:
+            frontier = frontier[:cache_nodes - len(self.cache)]
+            nodes = self.read_nodes(frontier)
+            following = []
+            for i, (vec, neighbors) in zip(frontier, nodes):
+                self.cache[i] = (vec.copy(), neighbors)
+                following.extend(e for e in neighbors.tolist() if e not in seen)
+                seen.update(neighbors.tolist())
+            frontier = following
+
+    def search(self, q, k, L=None, beam_width=None):
+        '''
+            Inputs:
+                q: normalized query vector
+                k: number of neighbours
+                L: size of the candidate list (default: the one of the index, at least k)
+                beam_width: number of nodes read per round (default: the one of the index)
+            Outputs:
+                list of (id, squared L2 distance) of the k closest read nodes, in increasing distance
+        '''
+        L = max(L or self.L, k)
+        beam_width = beam_width or self.beam_width
+        table = self.pq.dtable(query=q)
+        start = self.meta['medoid']
+        # candidate list sorted by PQ distance
+        cand_ids = np.array([start], dtype=np.int64)
+        cand_dists = table.adist(codes=self.codes[cand_ids])
+        expanded = np.zeros(1, dtype=bool)
+        visited = {start}
+        exact_ids, exact_dists = [], []
+        while True:
+            frontier = np.flatnonzero(~expanded)[:beam_width]
+            if not len(frontier):
+                break
+            expanded[frontier] = True
+            nodes = self.read_nodes(cand_ids[frontier].tolist())
+            vecs = np.stack([vec for vec, _ in nodes])
+            exact_ids.extend(cand_ids[frontier].tolist())
+            exact_dists.extend(np.maximum(2 - 2 * (vecs @ q), 0).tolist())
+            new = [e for _, neighbors in nodes for e in neighbors.tolist() if e not in visited]
+            if not new:
+                continue
+            new = np.unique(np.array(new, dtype=np.int64))
+            visited.update(new.tolist())
+            cand_ids = np.concatenate([cand_ids, new])
+            cand_dists = np.concatenate([cand_dists, table.adist(codes=self.codes[new])])
+            expanded = np.concatenate([expanded, np.zeros(len(new), dtype=bool)])
+            order = np.argsort(cand_dists, kind='stable')[:L]
+            cand_ids, cand_dists, expanded = cand_ids[order], cand_dists[order], expanded[order]
+        exact_ids = np.array(exact_ids, dtype=np.int64)
+        exact_dists = np.array(exact_dists, dtype=np.float32)
+        order = np.argsort(exact_dists, kind='stable')[:k]
+        return list(zip(exact_ids[order].tolist(), exact_dists[order].tolist()))
+
+    def search_batch(self, queries, k, L=None, workers=None, return_latency=False):
+        '''
+            Search many queries on a pool of threads (the reads release the GIL)
+            Outputs:
+                ids: Q x k int64 ids, -1 where fewer than k elements were found
+                dists: Q x k float32 squared L2 distances, inf where fewer than k elements were found
+                latency: Q seconds (only with return_latency)
+        '''
+        queries = l2_normalize(as_float32(queries))
+        num_query = len(queries)
+        ids = np.full((num_query, k), -1, dtype=np.int64)
+        dists = np.full((num_query, k), np.inf, dtype=np.float32)
+        latency = np.zeros(num_query)
+
+        def run(row):
+            t1 = time.perf_counter()
+            res = self.search(queries[row], k, L=L)
+            latency[row] = time.perf_counter() - t1
+            if res:
+                ids[row, :len(res)] = [idx for idx, _ in res]
+                dists[row, :len(res)] = [dist for _, dist in res]
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            list(executor.map(run, range(num_query)))
+        if return_latency:
+            return ids, dists, latency
+        return ids, dists
+
+
+def diskann_params(R, L, alpha, N_books, N_words):
+    return {'R': R, 'L': L, 'alpha': alpha, 'N_books': N_books, 'N_words': N_words}
+
+
+def build_diskann(features, dataset, R=64, L=100, alpha=1.2, N_books=32, N_words=256, n_train=100000):
+    '''
+        Build the disk-resident index of features and write it to outputs/<dataset>/DiskANN
+        Inputs:
+            features: N x D descriptors (array, FeatureStore or FeatureCatalog)
+            R: maximum number of neighbours, L: candidate list of the construction, alpha: pruning
+            N_books, N_words: product quantizer of the in-memory codes
+            n_train: number of descriptors the quantizer is trained on
+        Outputs:
+            directory of the index
+    '''
+    features = check_features(features)
+    num, dim = features.shape
+    t1 = time.time()
+    # the quantizer is trained on a sample, the database is encoded block by block
+    rng = np.random.default_rng(42)
+    train_ids = np.sort(rng.choice(num, size=min(num, n_train), replace=False))
+    pq = nanopq.PQ(M=N_books, Ks=min(N_words, len(train_ids) - 1), verbose=False)
+    pq.fit(vecs=_rows(features, train_ids), iter=20, seed=42)
+    codes = pq_encode_chunked(pq, features)
+
+    print('==> Building Vamana graph ...')
+    builder = VamanaBuilder(features, R=R, L=L, alpha=alpha)
+    neighbors, counts = builder.build()
+
+    writer = IndexWriter(dataset, 'DiskANN', diskann_params(R, L, alpha, N_books, N_words), features)
+    write_disk_graph(writer.path('diskann.bin'), features, neighbors, counts)
+    writer.save_array('codewords', pq.codewords)
+    writer.save_array('codes', codes)
+    writer.manifest['diskann'] = {'dim': dim, 'R': R, 'medoid': int(builder.medoid), 'sector': SECTOR}
+    t2 = time.time()
+    print('>> DiskANN build: {:.1f}s, average degree {:.1f}'.format(t2 - t1, counts.mean()))
+    return writer.commit(build_time=t2 - t1)
+
+
+def load_diskann(features, dataset, R=64, L=100, alpha=1.2, N_books=32, N_words=256, beam_width=4, cache_nodes=10000):
+    # open the index built by build_diskann with the same parameters from the same features
+    index = load_index(dataset, 'DiskANN', diskann_params(R, L, alpha, N_books, N_words), features)
+    pq = pq_from_codewords(index.array('codewords', mmap_mode=None))
+    return DiskANN(index.path('diskann.bin'), index.manifest['diskann'], pq, index.array('codes', mmap_mode=None),
+                   L=L, beam_width=beam_width, cache_nodes=cache_nodes)
+
+
+def matching_DiskANN(K, embedded_features_train, embedded_features_test, dataset, R=64, L=100, alpha=1.2, N_books=32,
+                     N_words=256, ifgenerate=True, index=None, beam_width=4):
+    '''
+        Inputs:
+            K: number of nearest neighbours
+            embedded_features_train: feature vectors of the dataset images
+            embedded_features_test: feature vectors of the query images
+            dataset: name of the dataset
+            R, L, alpha: degree, candidate list and pruning factor of the Vamana graph
+            N_books, N_words: product quantizer of the in-memory codes
+            ifgenerate: build the index (otherwise it is loaded)
+            index: an opened DiskANN (e.g. loaded once by online.py), overrides ifgenerate
+            beam_width: number of nodes read per round
+        Outputs:
+            idx: the indices of the top-K nearest neighbours
+            time_per_query: average mathching time per query
+    '''
+    num_test = len(embedded_features_test)
+    close = index is None
+    if index is None:
+        if ifgenerate:
+            build_diskann(embedded_features_train, dataset, R=R, L=L, alpha=alpha, N_books=N_books, N_words=N_words)
+        index = load_diskann(embedded_features_train, dataset, R=R, L=L, alpha=alpha, N_books=N_books, N_words=N_words,
+                             beam_width=beam_width)
+    t1 = time.time()
+    idx, _, latency = index.search_batch(embedded_features_test, K, return_latency=True)
+    t2 = time.time()
+    if close:
+        index.close()
+    print_latency(latency)
+    time_per_query = (t2 - t1) / num_test
+    return idx, time_per_query
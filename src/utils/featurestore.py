@@ -0,0 +1,813 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the binary feature store that keeps the descriptors of a dataset on disk
+
+A feature store is a directory (outputs/features/<dataset>/ by default) holding
+    manifest.json:    dim, count, dtype, network name, multi-scale setting and checksum
+    features.bin:     contiguous row-major N x D float32 matrix (no header), opened with np.memmap
+    paths.txt:        relative image paths, one per line, row i belongs to feature row i
+    paths.offsets.npy: int64 offsets of the lines of paths.txt (see src/utils/pathtable.py)
+    fingerprints.npy: size, mtime and optional sha256 of every image, used for incremental ingestion
+    progress.json:    only while a store is being written, rows that can be resumed after a crash
+    features.<mode>.bin, quantization.<mode>.npy:
+                      optional scalar-quantized copy of the normalized rows ('float16' or per-dimension
+                      'int8' with scale/offset), searched instead of features.bin (see quantize_feature_store)
+Loading only reads the manifest and maps the matrix, so it is O(1) and the pages are
+shared between all processes that open the same store.
+
+Convert existing pickles (outputs/features/<dataset>_path_feature.pkl) with
+    python3 -m src.utils.featurestore --convert 'YOUR_DATASET_1,YOUR_DATASET_2'
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+
+from src.utils.pathtable import ChainedPathTable, PathTable, load_path_table, path_offsets
+
+FEATURE_ROOT = 'outputs/features'
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+FEATURES_FILE = 'features.bin'
+PATHS_FILE = 'paths.txt'
+PATH_OFFSETS_FILE = 'paths.offsets.npy'
+FINGERPRINTS_FILE = 'fingerprints.npy'
+PROGRESS_FILE = 'progress.json'
+QUANTIZATION_MODES = {'float16': np.float16, 'int8': np.int8}
+FINGERPRINT_DTYPE = np.dtype([('size', '<i8'), ('mtime_ns', '<i8'), ('sha256', 'S16')])
+CHECKSUM_ROWS = 65536
+
+
+def feature_store_dir(dataset, root=FEATURE_ROOT):
+    # same naming rule as save_path_feature: 'GLM/test' -> 'GLM_test'
+    return os.path.join(root, dataset.replace('/', '_'))
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    # write to a temporary file first so that a crash never leaves a half written manifest
+    tmp_path = os.path.join(directory, MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_FILE))
+
+
+def fingerprint_files(paths, use_hash=False):
+    '''
+        Inputs:
+            paths: absolute paths of the image files
+            use_hash: also compute the (truncated) sha256 of the contents, which is slow but
+                      survives copies and touches that change the mtime only
+        Outputs:
+            structured array of FINGERPRINT_DTYPE, one entry per path
+    '''
+    fingerprints = np.zeros(len(paths), dtype=FINGERPRINT_DTYPE)
+    for i, path in enumerate(paths):
+        st = os.stat(path)
+        fingerprints[i]['size'] = st.st_size
+        fingerprints[i]['mtime_ns'] = st.st_mtime_ns
+    if use_hash:
+        hash_files(paths, fingerprints, range(len(paths)))
+    return fingerprints
+
+
+def hash_files(paths, fingerprints, rows):
+    # fill in the sha256 field of the given rows
+    from src.utils.general import sha256_hash
+    for i in rows:
+        fingerprints[i]['sha256'] = sha256_hash(paths[i], length=17).encode('ascii')
+
+
+class ContentChecksum(object):
+    '''
+        sha256 of the descriptors and paths of a store that does not depend on how the rows were
+        written: the rows are hashed in fixed blocks of CHECKSUM_ROWS rows (with their paths), the
+        checksum is the sha256 of the block digests. The digests of the complete blocks are kept in
+        the manifest, so appending or resuming only re-reads the rows of the last, incomplete block.
+    '''
+
+    def __init__(self, digests=()):
+        self.digests = list(digests)
+        self._reset()
+
+    def _reset(self):
+        self._rows = hashlib.sha256()
+        self._paths = hashlib.sha256()
+        self._count = 0
+
+    def update(self, rows, lines):
+        # rows: n x D contiguous block, lines: the n utf-8 encoded paths
+        data = memoryview(rows.reshape(len(rows), -1)).cast('B')
+        row_bytes = rows[0].nbytes if len(rows) else 0
+        pos = 0
+        while pos < len(lines):
+            take = min(len(lines) - pos, CHECKSUM_ROWS - self._count)
+            self._rows.update(data[pos * row_bytes:(pos + take) * row_bytes])
+            for line in lines[pos:pos + take]:
+                self._paths.update(line + b'\n')
+            self._count += take
+            pos += take
+            if self._count == CHECKSUM_ROWS:
+                self.digests.append(self._block_digest())
+                self._reset()
+
+    def _block_digest(self):
+        return hashlib.sha256(self._rows.digest() + self._paths.digest()).hexdigest()
+
+    def hexdigest(self):
+        digests = self.digests + ([self._block_digest()] if self._count else [])
+        return hashlib.sha256(''.join(digests).encode('ascii')).hexdigest()
+
+    @classmethod
+    def restore(cls, digests, vecs, paths):
+        # continue the checksum of the N rows vecs/paths given the digests of their complete blocks
+        digests = list(digests)[:len(vecs) // CHECKSUM_ROWS]
+        checksum = cls(digests)
+        start = len(digests) * CHECKSUM_ROWS
+        for i in range(start, len(vecs), CHECKSUM_ROWS):
+            checksum.update(np.ascontiguousarray(vecs[i:i+CHECKSUM_ROWS]),
+                            [path.encode('utf-8') for path in paths[i:i+CHECKSUM_ROWS]])
+        return checksum
+
+
+class FeatureStore(object):
+    '''
+        Read-only view of a feature store directory
+        vecs: N x D np.memmap (row i is the descriptor of paths[i])
+        paths: PathTable of the relative image paths
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        if self.manifest.get('format_version') != FORMAT_VERSION:
+            raise ValueError('Unsupported feature store version in {}'.format(directory))
+        self.dim = self.manifest['dim']
+        self.count = self.manifest['count']
+        self.dtype = np.dtype(self.manifest['dtype'])
+        # the matchers and the re-ranking expect float32, checked once here instead of on every search
+        if self.dtype != np.float32:
+            raise ValueError('Feature store {} has dtype {}, expected float32'.format(directory, self.dtype))
+        self._vecs = None
+        self._paths = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def shape(self):
+        return (self.count, self.dim)
+
+    @property
+    def vecs(self):
+        if self._vecs is None:
+            if self.count == 0:
+                # np.memmap can not map an empty file
+                self._vecs = np.empty((0, self.dim), dtype=self.dtype)
+            else:
+                self._vecs = np.memmap(os.path.join(self.directory, FEATURES_FILE), dtype=self.dtype,
+                                       mode='r', shape=(self.count, self.dim))
+        return self._vecs
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            # an interrupted append may have left lines after the last complete row
+            self._paths = load_path_table(os.path.join(self.directory, PATHS_FILE),
+                                          os.path.join(self.directory, PATH_OFFSETS_FILE), self.count)
+        return self._paths
+
+    @property
+    def checksum(self):
+        # sha256 of the descriptors and paths, used to detect indexes built from other features
+        checksum = self.manifest.get('checksum')
+        if checksum is None:
+            checksum = ContentChecksum.restore((), self.vecs, self.paths).hexdigest()
+        return checksum
+
+    def quantized(self, mode):
+        '''
+            Inputs:
+                mode: 'float16' or 'int8'
+            Outputs:
+                QuantizedMatrix of the normalized rows, written by quantize_feature_store
+        '''
+        # the copy may have been written after this store was opened, its entry is read from disk
+        entry = read_manifest(self.directory).get('quantized', {}).get(mode)
+        if entry is None or entry['checksum'] != self.checksum:
+            raise ValueError('No up to date {} copy of {}, build it with --ifgenerate'.format(mode, self.directory))
+        dtype = QUANTIZATION_MODES[mode]
+        if self.count == 0:
+            codes = np.empty((0, self.dim), dtype=dtype)
+        else:
+            codes = np.memmap(os.path.join(self.directory, 'features.{}.bin'.format(mode)), dtype=dtype,
+                              mode='r', shape=(self.count, self.dim))
+        scale = offset = None
+        if mode == 'int8':
+            scale, offset = np.load(os.path.join(self.directory, 'quantization.{}.npy'.format(mode)))
+        return QuantizedMatrix(codes, scale, offset)
+
+    @property
+    def fingerprints(self):
+        # None for stores written without fingerprints (e.g. converted pickles)
+        fp_path = os.path.join(self.directory, FINGERPRINTS_FILE)
+        if not os.path.exists(fp_path):
+            return None
+        fingerprints = np.load(fp_path)
+        assert len(fingerprints) == self.count
+        return fingerprints
+
+
+class FeatureStoreWriter(object):
+    '''
+        Writes descriptors row by row (or block by block) into a feature store directory.
+        The manifest is only written by close(), so an unfinished store can not be loaded.
+        With append=True the rows are added after the ones of the existing store.
+        checkpoint() makes the rows written so far durable and records them in progress.json,
+        with resume=True a writer continues after the last checkpoint of an interrupted run.
+    '''
+
+    def __init__(self, directory, dim, dtype='float32', append=False, resume=False):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.progress = None
+        self._fingerprints = []
+        # byte offsets of the lines written to paths.txt
+        self._path_offsets = [np.zeros(1, dtype=np.int64)]
+        self._checksum = ContentChecksum()
+        mode = 'w'
+        if append:
+            store = FeatureStore(directory)
+            assert store.dim == dim and store.dtype == self.dtype
+            self.count = store.count
+            fingerprints = store.fingerprints
+            if fingerprints is not None:
+                self._fingerprints.append(fingerprints)
+            self._checksum = ContentChecksum.restore(store.manifest.get('checksum_blocks', ()), store.vecs, store.paths)
+            self._path_offsets = [np.asarray(store.paths.offsets)]
+            # drop the rows an interrupted append wrote after the ones of the manifest
+            with open(os.path.join(directory, FEATURES_FILE), 'r+b') as f:
+                f.truncate(self.count * dim * self.dtype.itemsize)
+            with open(os.path.join(directory, PATHS_FILE), 'r+b') as f:
+                f.truncate(self._path_offsets[0][-1])
+            mode = 'a'
+        elif resume:
+            self.progress = read_progress(directory)
+            assert self.progress['dim'] == dim and self.progress['dtype'] == self.dtype.name
+            self.count = self.progress['count']
+            # drop whatever was written after the last checkpoint
+            with open(os.path.join(directory, FEATURES_FILE), 'r+b') as f:
+                f.truncate(self.count * dim * self.dtype.itemsize)
+            with open(os.path.join(directory, PATHS_FILE), 'r+b') as f:
+                offsets = path_offsets(np.frombuffer(f.read(), dtype=np.uint8), self.count)
+                f.truncate(offsets[-1])
+            self._path_offsets = [offsets]
+            # re-read the rows of the last incomplete checksum block
+            vecs = np.memmap(os.path.join(directory, FEATURES_FILE), dtype=self.dtype, mode='r',
+                             shape=(self.count, dim)) if self.count else np.empty((0, dim), dtype=self.dtype)
+            paths = PathTable(np.fromfile(os.path.join(directory, PATHS_FILE), dtype=np.uint8), offsets)
+            self._checksum = ContentChecksum.restore(self.progress.get('checksum_blocks', ()), vecs, paths)
+            mode = 'a'
+        elif os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+            # the old store becomes invalid as soon as its files are overwritten
+            os.remove(os.path.join(directory, MANIFEST_FILE))
+        self._f_vecs = open(os.path.join(directory, FEATURES_FILE), mode + 'b')
+        self._f_paths = open(os.path.join(directory, PATHS_FILE), mode + 'b')
+
+    def write(self, rows, paths, fingerprints=None):
+        '''
+            rows: n x D block of descriptors (any float dtype, any memory layout)
+            paths: the n relative image paths of the rows
+            fingerprints: optional n fingerprints of the image files (see fingerprint_files)
+        '''
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        assert rows.ndim == 2 and rows.shape[1] == self.dim
+        assert rows.shape[0] == len(paths)
+        self._f_vecs.write(rows.tobytes())
+        lines = [path.encode('utf-8') for path in paths]
+        self._checksum.update(rows, lines)
+        self._f_paths.write(b''.join(line + b'\n' for line in lines))
+        if lines:
+            ends = np.cumsum([len(line) + 1 for line in lines], dtype=np.int64)
+            self._path_offsets.append(self._path_offsets[-1][-1] + ends)
+        if fingerprints is not None:
+            assert len(fingerprints) == rows.shape[0]
+            self._fingerprints.append(np.asarray(fingerprints, dtype=FINGERPRINT_DTYPE))
+        self.count += rows.shape[0]
+
+    def checkpoint(self, **state):
+        '''
+            Flush the written rows to disk and record them in progress.json
+            state: additional information needed to resume (e.g. a key of the image list)
+        '''
+        for f in (self._f_vecs, self._f_paths):
+            f.flush()
+            os.fsync(f.fileno())
+        progress = dict(state, count=self.count, dim=self.dim, dtype=self.dtype.name,
+                        checksum_blocks=self._checksum.digests)
+        tmp_path = os.path.join(self.directory, PROGRESS_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, os.path.join(self.directory, PROGRESS_FILE))
+        self.progress = progress
+
+    def close(self, network=None, multiscale=None, fingerprints=None):
+        # fingerprints: fingerprints of all rows, replacing the ones passed to write()
+        self._f_vecs.close()
+        self._f_paths.close()
+        fp_path = os.path.join(self.directory, FINGERPRINTS_FILE)
+        if fingerprints is None:
+            fingerprints = np.concatenate(self._fingerprints) if self._fingerprints else None
+        if fingerprints is not None and len(fingerprints) == self.count:
+            np.save(fp_path, np.asarray(fingerprints, dtype=FINGERPRINT_DTYPE))
+        elif os.path.exists(fp_path):
+            # fingerprints of only a part of the rows are useless
+            os.remove(fp_path)
+        offsets_path = os.path.join(self.directory, PATH_OFFSETS_FILE)
+        with open(offsets_path + '.tmp', 'wb') as f:
+            np.save(f, np.concatenate(self._path_offsets))
+        os.replace(offsets_path + '.tmp', offsets_path)
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'dim': self.dim,
+            'count': self.count,
+            'dtype': self.dtype.name,
+            'network': network,
+            'multiscale': multiscale,
+            'checksum': self._checksum.hexdigest(),
+            'checksum_blocks': self._checksum.digests,
+        }
+        write_manifest(self.directory, manifest)
+        if os.path.exists(os.path.join(self.directory, PROGRESS_FILE)):
+            os.remove(os.path.join(self.directory, PROGRESS_FILE))
+        return manifest
+
+
+def read_progress(directory):
+    # progress.json of an interrupted writer, None if there is nothing to resume
+    progress_path = os.path.join(directory, PROGRESS_FILE)
+    if not os.path.exists(progress_path):
+        return None
+    with open(progress_path, 'r') as f:
+        return json.load(f)
+
+
+def save_feature_store(dataset, vecs, img_r_path, network=None, multiscale=None, fingerprints=None, chunk_size=10000):
+    '''
+        Inputs:
+            dataset: name of the dataset
+            vecs: D x N descriptors, same layout as returned by extract_vectors
+            img_r_path: relative paths of the N images
+            network: name of the network that produced the descriptors
+            multiscale: list of scales used during extraction
+            fingerprints: optional fingerprints of the N image files
+            chunk_size: number of rows converted to row-major float32 at a time
+        Outputs:
+            directory of the feature store
+    '''
+    directory = feature_store_dir(dataset)
+    dim, num = vecs.shape
+    writer = FeatureStoreWriter(directory, dim)
+    for i in range(0, num, chunk_size):
+        writer.write(vecs[:, i:i+chunk_size].T, img_r_path[i:i+chunk_size],
+                     None if fingerprints is None else fingerprints[i:i+chunk_size])
+    writer.close(network=network, multiscale=multiscale)
+    return directory
+
+
+def update_feature_store(directory, keep, vecs, img_r_path, fingerprints, chunk_size=10000):
+    '''
+        Keep some rows of an existing store and append new ones.
+        If all rows are kept the new rows are appended in place, otherwise the kept rows are
+        copied chunk by chunk into a new store which then replaces the old one.
+        Inputs:
+            directory: directory of the existing feature store
+            keep: increasing row ids of the existing store that stay in the store
+            vecs: D x n descriptors to append
+            img_r_path: relative paths of the n new images
+            fingerprints: fingerprints of all kept rows followed by the n new ones
+        Outputs:
+            manifest of the updated store
+    '''
+    store = FeatureStore(directory)
+    network, multiscale = store.manifest['network'], store.manifest['multiscale']
+    keep = np.asarray(keep, dtype=np.int64)
+    n_keep = len(keep)
+    if n_keep == store.count:
+        writer = FeatureStoreWriter(directory, store.dim, store.dtype, append=True)
+        # replace the fingerprints of the kept rows, they may have been refreshed
+        writer._fingerprints = [fingerprints[:n_keep]]
+    else:
+        tmp_dir = directory.rstrip('/') + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        writer = FeatureStoreWriter(tmp_dir, store.dim, store.dtype)
+        paths = store.paths
+        for i in range(0, n_keep, chunk_size):
+            rows = keep[i:i+chunk_size]
+            writer.write(store.vecs[rows], paths[rows], fingerprints[i:i+len(rows)])
+    for i in range(0, vecs.shape[1], chunk_size):
+        writer.write(vecs[:, i:i+chunk_size].T, img_r_path[i:i+chunk_size],
+                     fingerprints[n_keep+i:n_keep+i+chunk_size])
+    manifest = writer.close(network=network, multiscale=multiscale)
+    if writer.directory != directory:
+        # swap the directories, the old store stays valid until the new one is complete
+        old_dir = directory.rstrip('/') + '.old'
+        os.rename(directory, old_dir)
+        os.rename(writer.directory, directory)
+        shutil.rmtree(old_dir)
+    return manifest
+
+
+class QuantizedMatrix(object):
+    '''
+        N x D scalar-quantized rows, row i is approximately codes[i] * scale + offset
+        (scale and offset are per-dimension float32 arrays, None for float16 codes).
+        With rows given, row i is codes[rows[i]] (see take), the codes are gathered per block.
+        Scoring works on the codes block by block, only rows that are gathered are dequantized.
+    '''
+
+    def __init__(self, codes, scale=None, offset=None, rows=None):
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+        self.rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        self.dim = codes.shape[1]
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.codes) if self.rows is None else len(self.rows)
+
+    @property
+    def shape(self):
+        return (len(self), self.dim)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def take(self, rows):
+        # the matrix of the given rows, nothing is copied until they are scored
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return QuantizedMatrix(self.codes, self.scale, self.offset, rows)
+
+    def _codes(self, key):
+        return self.codes[key] if self.rows is None else self.codes[self.rows[key]]
+
+    def _dequantize(self, codes):
+        rows = codes.astype(np.float32)
+        if self.scale is not None:
+            rows *= self.scale
+            rows += self.offset
+        return rows
+
+    def __getitem__(self, key):
+        return self._dequantize(np.asarray(self._codes(key)))
+
+    def iter_chunks(self, chunk_size=65536):
+        for start in range(0, len(self), chunk_size):
+            yield start, self._dequantize(self._codes(slice(start, start + chunk_size)))
+
+    def iter_scores(self, q, chunk_size=65536):
+        '''
+            Inputs:
+                q: D x Q float32 queries
+            Outputs:
+                (first row id, n x Q inner products) blocks, computed on the codes:
+                x.q = codes.(scale * q) + offset.q
+        '''
+        if self.scale is None:
+            q_scaled, bias = q, 0
+        else:
+            q_scaled, bias = self.scale[:, None] * q, self.offset @ q
+        for start in range(0, len(self), chunk_size):
+            yield start, self._codes(slice(start, start + chunk_size)).astype(np.float32) @ q_scaled + bias
+
+
+def quantize_feature_store(dataset, mode, chunk_size=65536):
+    '''
+        Write the scalar-quantized copy of the normalized rows of a feature store
+        Inputs:
+            dataset: name of the dataset
+            mode: 'float16' (2 bytes per value) or 'int8' (1 byte per value, per-dimension
+                  scale and offset computed from the minimum and maximum of every dimension)
+        Outputs:
+            QuantizedMatrix of the store
+    '''
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError('Unknown quantization mode {}, use one of {}'.format(mode, list(QUANTIZATION_MODES)))
+    directory = feature_store_dir(dataset)
+    store = FeatureStore(directory)
+
+    def normalized_chunks():
+        for start in range(0, store.count, chunk_size):
+            rows = np.asarray(store.vecs[start:start+chunk_size])
+            yield rows / np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+
+    scale = offset = None
+    if mode == 'int8':
+        low = np.full(store.dim, np.inf, dtype=np.float32)
+        high = np.full(store.dim, -np.inf, dtype=np.float32)
+        for rows in normalized_chunks():
+            low = np.minimum(low, rows.min(axis=0))
+            high = np.maximum(high, rows.max(axis=0))
+        scale = np.where(high > low, (high - low) / 255, 1).astype(np.float32)
+        offset = (low + 128 * scale).astype(np.float32)
+        np.save(os.path.join(directory, 'quantization.{}.npy'.format(mode)), np.stack([scale, offset]))
+    with open(os.path.join(directory, 'features.{}.bin'.format(mode)), 'wb') as f:
+        for rows in normalized_chunks():
+            if mode == 'int8':
+                rows = np.clip(np.rint((rows - offset) / scale), -128, 127)
+            f.write(rows.astype(QUANTIZATION_MODES[mode]).tobytes())
+    manifest = store.manifest
+    manifest.setdefault('quantized', {})[mode] = {'checksum': store.checksum}
+    write_manifest(directory, manifest)
+    print('>> {}: {} copy of {} rows written'.format(dataset, mode, store.count))
+    return FeatureStore(directory).quantized(mode)
+
+
+def quantized_parts(features, mode):
+    '''
+        Inputs:
+            features: FeatureStore, FeatureCatalog or FeatureSubset of one of them
+        Outputs:
+            (ids, QuantizedMatrix) of every store, ids are the row ids of features of the rows
+            of the QuantizedMatrix
+    '''
+    if isinstance(features, FeatureStore):
+        return [(np.arange(features.count, dtype=np.int64), features.quantized(mode))]
+    if isinstance(features, FeatureCatalog):
+        return [(np.arange(start, end, dtype=np.int64), st.quantized(mode))
+                for start, end, st in zip(features.offsets[:-1], features.offsets[1:], features.stores)]
+    if isinstance(features, FeatureSubset):
+        # the rows of the subset in every part of its base, in base order so the codes are read sequentially
+        parts = []
+        order = np.argsort(features.ids, kind='stable')
+        base_ids = features.ids[order]
+        for ids, qmat in quantized_parts(features.source, mode):
+            if not len(ids):
+                continue
+            part_order = np.argsort(ids, kind='stable')
+            pos = np.minimum(np.searchsorted(ids[part_order], base_ids), len(ids) - 1)
+            hit = ids[part_order[pos]] == base_ids
+            if hit.any():
+                parts.append((order[hit], qmat.take(part_order[pos[hit]])))
+        return parts
+    raise TypeError('Quantized search needs a FeatureStore, a FeatureCatalog or a FeatureSubset, not {}'.format(
+        type(features).__name__))
+
+
+def load_feature_store(dataset, network=None):
+    '''
+        Inputs:
+            dataset: name of the dataset
+            network: if given, refuse stores that were extracted by another network
+        Outputs:
+            FeatureStore with N x D memory-mapped descriptors and the relative paths
+    '''
+    store = FeatureStore(feature_store_dir(dataset))
+    if network is not None and store.manifest['network'] not in (None, network):
+        raise ValueError('Features of {} were extracted with {}, not {}'.format(
+            dataset, store.manifest['network'], network))
+    return store
+
+
+class FeatureCatalog(object):
+    '''
+        Several feature stores presented as one logical N x D matrix without concatenating them.
+        Global id g belongs to store i = locate(g)[0] with local id g - offsets[i].
+        Indexing with an int, a slice or an (n-dimensional) array of global ids gathers only the
+        requested rows; iter_chunks walks over the stores without copying.
+    '''
+
+    def __init__(self, stores, names=None):
+        assert len(stores) > 0
+        self.stores = list(stores)
+        self.names = list(names) if names is not None else [st.directory for st in self.stores]
+        self.dim = self.stores[0].dim
+        self.dtype = self.stores[0].dtype
+        for st in self.stores:
+            if st.dim != self.dim or st.dtype != self.dtype:
+                raise ValueError('Feature stores of a catalog must have the same dim and dtype')
+        # offsets[i] is the global id of the first row of store i, offsets[-1] the total count
+        self.offsets = np.cumsum([0] + [len(st) for st in self.stores]).astype(np.int64)
+        self._paths = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self), self.dim)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def locate(self, gids):
+        '''
+            Inputs:
+                gids: global id(s)
+            Outputs:
+                store index and local id within that store, same shape as gids
+        '''
+        gids = np.asarray(gids, dtype=np.int64)
+        if np.any(gids < 0) or np.any(gids >= len(self)):
+            raise IndexError('global id out of range')
+        store_idx = np.searchsorted(self.offsets, gids, side='right') - 1
+        return store_idx, gids - self.offsets[store_idx]
+
+    def global_id(self, store_idx, local_ids):
+        # inverse of locate, store_idx can be the index or the name of a store
+        if not isinstance(store_idx, (int, np.integer)):
+            store_idx = self.names.index(store_idx)
+        return self.offsets[store_idx] + np.asarray(local_ids, dtype=np.int64)
+
+    def collection_mask(self, names):
+        '''
+            Inputs:
+                names: names (or indices) of the stores to keep
+            Outputs:
+                N bool mask of the global ids that belong to these stores
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        for name in names:
+            i = name if isinstance(name, (int, np.integer)) else self.names.index(name)
+            mask[self.offsets[i]:self.offsets[i+1]] = True
+        return mask
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            store_idx, local = self.locate(key)
+            return np.asarray(self.stores[int(store_idx)].vecs[int(local)])
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self)))
+        gids = np.asarray(key, dtype=np.int64)
+        flat = gids.reshape(-1)
+        out = np.empty((len(flat), self.dim), dtype=self.dtype)
+        store_idx, local = self.locate(flat)
+        for i in np.unique(store_idx):
+            mask = store_idx == i
+            out[mask] = self.stores[i].vecs[local[mask]]
+        return out.reshape(gids.shape + (self.dim,))
+
+    def __iter__(self):
+        for _, block in self.iter_chunks():
+            yield from block
+
+    def iter_chunks(self, chunk_size=65536):
+        # yields (first global id, rows) blocks that never cross a store boundary
+        for i, st in enumerate(self.stores):
+            vecs = st.vecs
+            for start in range(0, len(st), chunk_size):
+                yield int(self.offsets[i]) + start, vecs[start:start+chunk_size]
+
+    def dot(self, q):
+        '''
+            Inputs:
+                q: D or D x Q query vector(s)
+            Outputs:
+                N or N x Q inner products with all rows, computed store by store
+        '''
+        q = np.asarray(q, dtype=self.dtype)
+        out = np.empty((len(self),) + q.shape[1:], dtype=np.result_type(self.dtype, q.dtype))
+        for start, block in self.iter_chunks():
+            out[start:start+len(block)] = block @ q
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        # materialising the whole matrix, only use this where a full copy is unavoidable
+        out = np.concatenate([st.vecs for st in self.stores], axis=0)
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    @property
+    def checksum(self):
+        return hashlib.sha256(''.join(st.checksum for st in self.stores).encode('ascii')).hexdigest()
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            self._paths = ChainedPathTable([st.paths for st in self.stores])
+        return self._paths
+
+    def path(self, gid):
+        return self.paths[int(gid)]
+
+
+class FeatureSubset(object):
+    '''
+        Selected rows of an N x D matrix, FeatureStore or FeatureCatalog, presented as an
+        n x D matrix; row i of the subset is row ids[i] of the base. Rows are gathered on demand.
+        source is the object the subset was made of (e.g. to find its quantized copies).
+    '''
+
+    def __init__(self, base, ids):
+        self.source = base
+        self.base = base.vecs if isinstance(base, FeatureStore) else base
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.dim = self.base.shape[1]
+        self.dtype = self.base.dtype
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def shape(self):
+        return (len(self.ids), self.dim)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return np.asarray(self.base[int(self.ids[key])])
+        return np.asarray(self.base[self.ids[key]])
+
+    def __iter__(self):
+        for _, block in self.iter_chunks():
+            yield from block
+
+    def iter_chunks(self, chunk_size=65536):
+        for start in range(0, len(self.ids), chunk_size):
+            yield start, np.asarray(self.base[self.ids[start:start+chunk_size]])
+
+    def dot(self, q):
+        q = np.asarray(q)
+        return np.concatenate([block @ q for _, block in self.iter_chunks()], axis=0)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[np.arange(len(self.ids))]
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    @property
+    def checksum(self):
+        sha256 = hashlib.sha256(features_checksum(self.base).encode('ascii'))
+        sha256.update(self.ids.tobytes())
+        return sha256.hexdigest()
+
+
+def load_feature_catalog(datasets, network=None):
+    # catalog over the feature stores of several datasets, global ids follow the order of datasets
+    stores = [load_feature_store(dataset, network=network) for dataset in datasets]
+    return FeatureCatalog(stores, names=datasets)
+
+
+def iter_chunks(features, chunk_size=65536):
+    '''
+        Iterate over the rows of an N x D matrix, a FeatureStore or a FeatureCatalog in blocks
+        Outputs: (first row id, rows) tuples
+    '''
+    if isinstance(features, FeatureStore):
+        features = features.vecs
+    if hasattr(features, 'iter_chunks'):
+        yield from features.iter_chunks(chunk_size)
+        return
+    for start in range(0, len(features), chunk_size):
+        yield start, features[start:start+chunk_size]
+
+
+def features_checksum(features, chunk_size=65536):
+    # checksum of a FeatureStore, a FeatureCatalog or a plain N x D matrix
+    if hasattr(features, 'checksum'):
+        return features.checksum
+    sha256 = hashlib.sha256()
+    for _, block in iter_chunks(features, chunk_size):
+        sha256.update(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+    return sha256.hexdigest()
+
+
+def convert_path_feature_pickle(dataset, network=None, multiscale=None):
+    # convert outputs/features/<dataset>_path_feature.pkl written by save_path_feature
+    from src.utils.general import load_path_features
+    vecs, img_r_path = load_path_features(dataset)
+    return save_feature_store(dataset, np.asarray(vecs), img_r_path, network=network, multiscale=multiscale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Feature store utilities')
+    parser.add_argument('--convert', '-c', metavar='DATASETS', required=True,
+                        help="comma separated list of datasets whose pickled path/feature files are converted")
+    parser.add_argument('--network', '-n', metavar='NETWORK', default=None,
+                        help="network the pickled features were extracted with (recorded in the manifest)")
+    parser.add_argument('--multiscale', '-ms', metavar='MULTISCALE', default=None,
+                        help="multi-scale setting the pickled features were extracted with, e.g. '[1, 2**(1/2), 1/2**(1/2)]'")
+    args = parser.parse_args()
+    ms = list(eval(args.multiscale)) if args.multiscale is not None else None
+    for dataset in args.convert.split(','):
+        directory = convert_path_feature_pickle(dataset, network=args.network, multiscale=ms)
+        print('>> {}: converted to {}'.format(dataset, directory))
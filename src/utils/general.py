@@ -56,13 +56,10 @@ def tb_setup(save_dir):
 
     return summary
 
-def path_all_jpg(directory, start):
-    paths = []
-    for dirpath, _, filenames in os.walk(directory):
-        paths = paths + [os.path.join(dirpath, f) for f in filenames if f.endswith(".jpg")]
-        # paths = paths + [os.path.join(dirpath, f) for f in filenames]
-    rel_paths = [os.path.relpath(path, start) for path in paths]
-    return paths, rel_paths
+def path_all_jpg(directory, start, extensions=('.jpg',)):
+    # see src/utils/imagelist.py for the cached version used by the extraction
+    from src.utils.imagelist import scan_images
+    return scan_images(directory, start, extensions=extensions)
 
 def save_path_feature(dataset, vecs, img_r_path):
     # save the dictionary of paths and features of images into a pkl file    
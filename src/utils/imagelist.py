@@ -0,0 +1,171 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the scanner that builds the list of images of a dataset
+
+Directories are listed in parallel with os.scandir. The listing of every directory is
+cached together with its mtime; a directory whose mtime did not change has the same
+entries, so its cached listing is reused instead of reading it again. (Its subdirectories
+are still checked, because changes deeper in the tree do not change the mtime of parents.)
+The listings of a dataset are cached in outputs/images/<dataset>.cache.pkl.
+
+The result is written as the image list of the dataset, outputs/images/<dataset>.txt (one path
+relative to `start` per line) with its line offsets in <dataset>.offsets.npy, the same compact
+format as the path table of a feature store (see src/utils/pathtable.py). The extraction reads
+the images from it, and online.py compares it with the paths of the feature stores.
+"""
+
+import os
+import time
+import pickle
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from src.utils.pathtable import load_path_table
+
+IMAGE_LIST_ROOT = 'outputs/images'
+IMAGE_EXTENSIONS = ('.jpg',)
+
+
+def parse_extensions(text):
+    # '.jpg, PNG,.tif' -> ('.jpg', '.png', '.tif')
+    extensions = []
+    for ext in text.split(','):
+        ext = ext.strip().lower()
+        if ext:
+            extensions.append(ext if ext.startswith('.') else '.' + ext)
+    if not extensions:
+        raise ValueError('No image extensions in {!r}'.format(text))
+    return tuple(extensions)
+
+
+def _list_dir(dirpath, cached):
+    # (mtime_ns, files, subdirs) of a directory, cached is the entry of the previous scan
+    mtime_ns = os.stat(dirpath).st_mtime_ns
+    if cached is not None and cached[0] == mtime_ns:
+        return dirpath, cached, True
+    files, subdirs = [], []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            # like os.walk, symbolic links to directories are not followed
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    return dirpath, (mtime_ns, sorted(files), sorted(subdirs)), False
+
+
+def scan_images(directory, start, extensions=IMAGE_EXTENSIONS, cache_path=None, workers=16):
+    '''
+        Inputs:
+            directory: root directory of the dataset
+            start: directory the relative paths are relative to
+            extensions: file extensions of the images, compared case-insensitively
+            cache_path: file with the directory listings of the previous scan (None: no cache)
+            workers: number of directories listed in parallel
+        Outputs:
+            paths: absolute paths of the images, sorted
+            rel_paths: paths relative to start
+    '''
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+
+    t1 = time.time()
+    listing = {}
+    n_reused = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_list_dir, directory, cache.get(directory))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath, entry, reused = future.result()
+                listing[dirpath] = entry
+                n_reused += reused
+                for subdir in entry[2]:
+                    subpath = os.path.join(dirpath, subdir)
+                    pending.add(executor.submit(_list_dir, subpath, cache.get(subpath)))
+    t2 = time.time()
+    print('>> Scanned {} directories ({} unchanged) in {:.2f}s'.format(len(listing), n_reused, t2 - t1))
+
+    if cache_path is not None:
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path + '.tmp', 'wb') as f:
+            pickle.dump(listing, f)
+        os.replace(cache_path + '.tmp', cache_path)
+
+    extensions = tuple(ext.lower() for ext in extensions)
+    paths = [os.path.join(dirpath, f) for dirpath in sorted(listing)
+             for f in listing[dirpath][1] if f.lower().endswith(extensions)]
+    rel_paths = [os.path.relpath(path, start) for path in paths]
+    return paths, rel_paths
+
+
+def image_list_path(dataset, root=IMAGE_LIST_ROOT):
+    return os.path.join(root, dataset.replace('/', '_') + '.txt')
+
+
+def listing_cache_path(dataset, root=IMAGE_LIST_ROOT):
+    return os.path.splitext(image_list_path(dataset, root))[0] + '.cache.pkl'
+
+
+def _offsets_path(list_path):
+    return os.path.splitext(list_path)[0] + '.offsets.npy'
+
+
+def write_image_list(list_path, rel_paths):
+    # the paths and their line offsets, each file is replaced atomically
+    directory = os.path.dirname(list_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    lines = [path.encode('utf-8') + b'\n' for path in rel_paths]
+    with open(list_path + '.tmp', 'wb') as f:
+        f.write(b''.join(lines))
+    offsets = np.concatenate([[0], np.cumsum([len(line) for line in lines], dtype=np.int64)]).astype(np.int64)
+    with open(_offsets_path(list_path) + '.tmp', 'wb') as f:
+        np.save(f, offsets)
+    os.replace(list_path + '.tmp', list_path)
+    os.replace(_offsets_path(list_path) + '.tmp', _offsets_path(list_path))
+
+
+def load_image_list(dataset, root=IMAGE_LIST_ROOT):
+    # PathTable of the image list of a dataset, None if it was never scanned
+    list_path = image_list_path(dataset, root)
+    if not os.path.exists(list_path):
+        return None
+    return load_path_table(list_path, _offsets_path(list_path), None)
+
+
+def image_list_matches(dataset, paths):
+    '''
+        Inputs:
+            dataset: name of the dataset
+            paths: PathTable, e.g. the paths of the feature store of the dataset
+        Outputs:
+            False if the image list of the dataset has other images than paths (True without a list)
+    '''
+    listed = load_image_list(dataset)
+    if listed is None:
+        return True
+    if len(listed) != len(paths):
+        return False
+    if np.array_equal(listed.blob[:listed.offsets[-1]], paths.blob[:paths.offsets[-1]]):
+        return True
+    # incremental runs append the new images after the kept ones
+    return set(listed) == set(paths)
+
+
+def build_image_list(dataset, directory, start, extensions=IMAGE_EXTENSIONS, workers=16):
+    '''
+        Scan the images of a dataset, reusing the directory listings of the previous scan,
+        and write its image list
+        Outputs:
+            PathTable of the image paths relative to start, read back from the image list
+    '''
+    _, rel_paths = scan_images(directory, start, extensions=extensions, cache_path=listing_cache_path(dataset),
+                               workers=workers)
+    write_image_list(image_list_path(dataset), rel_paths)
+    return load_image_list(dataset)
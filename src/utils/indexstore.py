@@ -0,0 +1,148 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the versioned on-disk format of the nearest neighbour search indexes
+
+An index is a directory outputs/<dataset>/<method>/ holding
+    manifest.json: format version, method, build parameters, checksum and size of the
+                   features the index was built from, build time and the list of payloads
+    <name>.npy:    array payloads, loaded with np.load(mmap_mode='r')
+    <name>.pkl:    Python objects that have no array representation
+    other files:   payloads written by external libraries (e.g. ANNOY trees)
+An index is written into a temporary directory that replaces the old one only when it is
+complete. load_index refuses indexes built with other parameters or from other features,
+so the indexes used by online.py are always the ones offline.py built for the same data.
+"""
+
+import os
+import json
+import time
+import shutil
+import pickle
+import numpy as np
+
+from src.utils.featurestore import features_checksum
+
+INDEX_ROOT = 'outputs'
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+def index_dir(dataset, method, root=INDEX_ROOT):
+    return os.path.join(root, dataset.replace('/', '_'), method)
+
+
+def _normalize_params(params):
+    # compare parameters the way they are stored in the manifest (tuples become lists, etc.)
+    return json.loads(json.dumps(params))
+
+
+class IndexWriter(object):
+    '''
+        Collects the payloads of an index and publishes them together with the manifest.
+        Usage:
+            writer = IndexWriter(dataset, 'HNSW', {'m': m, 'ef': ef}, features)
+            writer.save_array('levels', levels)
+            writer.commit()
+    '''
+
+    def __init__(self, dataset, method, params, features):
+        self.directory = index_dir(dataset, method)
+        self.tmp_directory = self.directory + '.tmp'
+        if os.path.exists(self.tmp_directory):
+            shutil.rmtree(self.tmp_directory)
+        os.makedirs(self.tmp_directory)
+        self.manifest = {
+            'format_version': FORMAT_VERSION,
+            'method': method,
+            'params': _normalize_params(params),
+            'num_vectors': len(features),
+            'features_checksum': features_checksum(features),
+            'arrays': [],
+            'objects': [],
+            'files': [],
+        }
+
+    def path(self, name):
+        # path of a payload file written by an external library
+        self.manifest['files'].append(name)
+        return os.path.join(self.tmp_directory, name)
+
+    def save_array(self, name, array):
+        np.save(os.path.join(self.tmp_directory, name + '.npy'), np.ascontiguousarray(array))
+        self.manifest['arrays'].append(name)
+
+    def save_object(self, name, obj):
+        with open(os.path.join(self.tmp_directory, name + '.pkl'), 'wb') as f:
+            pickle.dump(obj, f)
+        self.manifest['objects'].append(name)
+
+    def commit(self, **extra):
+        # extra: additional metadata, e.g. tuned search parameters
+        self.manifest['built'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.manifest.update(extra)
+        with open(os.path.join(self.tmp_directory, MANIFEST_FILE), 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        if os.path.exists(self.directory):
+            old_directory = self.directory + '.old'
+            if os.path.exists(old_directory):
+                shutil.rmtree(old_directory)
+            os.rename(self.directory, old_directory)
+            os.rename(self.tmp_directory, self.directory)
+            shutil.rmtree(old_directory)
+        else:
+            os.rename(self.tmp_directory, self.directory)
+        return self.directory
+
+
+class IndexReader(object):
+    '''
+        Validated view of an index directory, array payloads are memory-mapped
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE), 'r') as f:
+            self.manifest = json.load(f)
+
+    def array(self, name, mmap_mode='r'):
+        return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode=mmap_mode)
+
+    def object(self, name):
+        with open(os.path.join(self.directory, name + '.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def update_manifest(self, **extra):
+        # store additional metadata (e.g. tuned search parameters) in an existing index
+        self.manifest.update(extra)
+        tmp_path = os.path.join(self.directory, MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.directory, MANIFEST_FILE))
+
+
+def load_index(dataset, method, params, features):
+    '''
+        Inputs:
+            dataset: name of the dataset (the folder under outputs/)
+            method: name of the index, e.g. 'HNSW'
+            params: build parameters, must equal the ones the index was built with
+            features: the features that are searched, must be the ones the index was built from
+        Outputs:
+            IndexReader of the index
+    '''
+    directory = index_dir(dataset, method)
+    if not os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        raise ValueError('No {} index in {}, build it with --ifgenerate'.format(method, directory))
+    reader = IndexReader(directory)
+    manifest = reader.manifest
+    if manifest.get('format_version') != FORMAT_VERSION or manifest.get('method') != method:
+        raise ValueError('{} has an unsupported index format, rebuild it with --ifgenerate'.format(directory))
+    if manifest['params'] != _normalize_params(params):
+        raise ValueError('{} was built with {}, not {}, rebuild it with --ifgenerate'.format(
+            directory, manifest['params'], _normalize_params(params)))
+    if manifest['num_vectors'] != len(features) or manifest['features_checksum'] != features_checksum(features):
+        raise ValueError('{} was built from other features, rebuild it with --ifgenerate'.format(directory))
+    return reader
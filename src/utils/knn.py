@@ -7,12 +7,11 @@ from tqdm import tqdm
 
 class BaseKNN(object):
     def __init__(self, database, method):
-        if database.dtype != np.float32:
-            database = database.astype(np.float32)
+        # at most one copy, none if the database already is contiguous float32
+        database = np.ascontiguousarray(database, dtype=np.float32)
         self.N = len(database)
         self.D = database[0].shape[-1]
-        self.database = database if database.flags['C_CONTIGUOUS'] \
-                               else np.ascontiguousarray(database)
+        self.database = database
 
     def add(self, batch_size=10000):
         if self.N <= batch_size:
@@ -23,10 +22,7 @@ class BaseKNN(object):
                                   desc='index adding')]
 
     def search(self, queries, k):
-        if not queries.flags['C_CONTIGUOUS']:
-            queries = np.ascontiguousarray(queries)
-        if queries.dtype != np.float32:
-            queries = queries.astype(np.float32)
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
         sims, ids = self.index.search(queries, k)
         return sims, ids
 
@@ -3,9 +3,13 @@ Image Search Engine for Historical Research: A Prototype
 This file contains classes/functions related to data compression and nearest neighbor search
 """
 
+import os
 import time
 import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import pickle
+import threading
 import torch as T
 import numpy as np
 
@@ -27,8 +31,81 @@ import sys
 from heapq import heapify, heappop, heappush, heapreplace, nlargest, nsmallest
 from math import log2
 from operator import itemgetter
-from random import random
+from random import random, seed as random_seed
 from progressbar import *
+from scipy import sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from src.utils.featurestore import FeatureSubset, iter_chunks, quantized_parts
+from src.utils.indexstore import IndexReader, IndexWriter, load_index
+
+def merge_topk(best_dist, best_idx, dist, idx, K):
+    '''
+        Keep the K smallest distances per row out of the current best candidates and a new block
+        Inputs:
+            best_dist, best_idx: Q x k current candidates (k <= K)
+            dist: Q x n distances of the new block, idx: the n (or Q x n) ids of the block
+        Outputs:
+            Q x min(K, k + n) unsorted candidates
+    '''
+    if idx.ndim == 1:
+        idx = np.broadcast_to(idx, dist.shape)
+    cand_dist = np.concatenate([best_dist, dist], axis=1)
+    cand_idx = np.concatenate([best_idx, idx], axis=1)
+    if cand_dist.shape[1] <= K:
+        return cand_dist, cand_idx
+    part = np.argpartition(cand_dist, K-1, axis=1)[:, :K]
+    return np.take_along_axis(cand_dist, part, axis=1), np.take_along_axis(cand_idx, part, axis=1)
+
+
+# per-thread visit marks of the graph searches, see _visit_marks
+_VISITED = threading.local()
+
+
+def _visit_marks(size):
+    '''
+        Scratch array of the graph search: element e is visited when marks[e] == epoch. Every
+        search takes a new epoch instead of clearing (or allocating) an array of all elements,
+        so its cost depends on the number of visited nodes only.
+    '''
+    marks = getattr(_VISITED, 'marks', None)
+    if marks is None or len(marks) < size:
+        marks = _VISITED.marks = np.zeros(max(size, 2 * len(marks) if marks is not None else 0), dtype=np.uint32)
+        _VISITED.epoch = 0
+    _VISITED.epoch += 1
+    if _VISITED.epoch == np.iinfo(np.uint32).max:
+        marks[:] = 0
+        _VISITED.epoch = 1
+    return marks, _VISITED.epoch
+
+
+def sort_topk(best_dist, best_idx):
+    order = np.argsort(best_dist, axis=1, kind='stable')
+    return np.take_along_axis(best_dist, order, axis=1), np.take_along_axis(best_idx, order, axis=1)
+
+
+def l2_normalize(x):
+    x_norm = np.linalg.norm(x, axis=1)
+    x_norm = np.expand_dims(x_norm, axis=1)
+    return x / x_norm
+
+
+def as_float32(x):
+    # queries (and plain database arrays) are converted once to contiguous float32, no copy if they already are
+    return np.ascontiguousarray(x, dtype=np.float32)
+
+
+def check_features(features):
+    '''
+        Descriptors are contiguous float32 from the feature store to the matchers.
+        Feature stores and catalogs are validated when they are loaded and are returned as they are,
+        plain arrays are converted once.
+    '''
+    if isinstance(features, np.ndarray) and not isinstance(features, np.memmap):
+        return as_float32(features)
+    if features.dtype != np.float32:
+        raise TypeError('Expected float32 descriptors, got {}'.format(features.dtype))
+    return features
+
 
 def squared_distances(x, y):
     '''
@@ -56,233 +133,505 @@ def fractional_distance(x, y, p=0.5):
     return np.sum(diff_fraction, axis=-1) ** (1/p)
 
 
-class HNSW(object):
-    # self._graphs[level][i] contains a {j: dist} dictionary,
-    # where j is a neighbor of i and dist is distance
-
-    def l2_distance(self, a, b):
-        dist = np.linalg.norm(a - b)
-        return dist
-
-    def cosine_distance(self, a, b):
-        try:
-            return np.dot(a, b) / (np.linalg.norm(a) * (np.linalg.norm(b)))
-        except ValueError:
-            print(a)
-            print(b)
-
-    def l2_distance_PQ_symmetric(self, encoded_a, encoded_b):
-        # if (encoded_a == encoded_b).all():
-        #     dist = 0
-        # else:
-        #     idx_diff = list(np.where(encoded_a != encoded_b)[0])
-        #     dist = 0
-        #     # for i in range(N_books):
-        #     for i in idx_diff:
-        #         sub_a = self.c[i][encoded_a[i]].numpy()
-        #         sub_b = self.c[i][encoded_b[i]].numpy()
-        #         dist = dist + np.sum((sub_a-sub_b)**2)
-
-        # This implementation is much faster
-        filter = encoded_a != encoded_b
-        idx_diff = list(np.where(filter)[0])
-        encoded_a = encoded_a[filter].astype('int64')
-        encoded_b = encoded_b[filter].astype('int64')
-        a = self.reshaped_C[encoded_a, idx_diff, :]
-        b = self.reshaped_C[encoded_b, idx_diff, :]
-        dist = np.sum((a-b)**2)
-        return dist
-
-    def l2_distance_PQ_asymmetric(self, encoded_x, dist_table):
-        _, N_books = dist_table.shape
-        dist = np.sum(dist_table[encoded_x, range(N_books)])
-        return dist
-
-    def construct_dist_table(self, query, N_books):
-        '''
+def pack_adjacency(neighbors, counts, row_ids, chunk_size=65536):
+    '''
+        Compressed form of the neighbour lists of a graph level, without the edge distances
         Inputs:
-        query: query vector
-        N_books: number of the sub-codebooks
+            neighbors: rows x M element ids, -1 padded
+            counts: number of neighbours of every row
+            row_ids: element id of every row
         Outputs:
-        dist_table: N_words * N_books
-        '''
-        reshaped_q = np.reshape(query, (1, N_books, -1))
-        dist_table = np.sum((self.reshaped_C-reshaped_q)**2, axis=2)
-        return dist_table
-
-
-    def _distance(self, x, y):
-        return self.distance_func(x, [y])[0]
+            offsets: rows + 1 (uint32, or int64 for large levels), row r is data[offsets[r]:offsets[r+1]]
+            data: uint8, for every row the sorted neighbour ids delta-coded (the first zigzag-coded
+                  relative to the element of the row, the others relative to their predecessor),
+                  packed as one byte w followed by the deltas in w little-endian bytes each, w being
+                  the smallest of 1, 2, 3 or 4 that holds all deltas of the row
+    '''
+    rows, M = neighbors.shape
+    counts = np.asarray(counts, dtype=np.int64)
+    row_bytes = np.empty(rows, dtype=np.int64)
+    chunks = []
+    for start in range(0, rows, chunk_size):
+        end = min(start + chunk_size, rows)
+        valid = np.arange(M) < counts[start:end, None]
+        ids = np.sort(np.where(valid, neighbors[start:end].astype(np.int64), np.iinfo(np.int64).max), axis=1)
+        deltas = np.diff(ids, axis=1, prepend=0)
+        first = ids[:, 0] - np.asarray(row_ids[start:end], dtype=np.int64)
+        deltas[:, 0] = (first << 1) ^ (first >> 63)
+        deltas[~valid] = 0
+        width = 1 + (deltas.max(axis=1, initial=0)[:, None] >= (1 << (8 * np.arange(1, 4)))).sum(axis=1)
+        size = np.where(counts[start:end] > 0, 1 + width * counts[start:end], 0)
+        row_bytes[start:end] = size
+        data = np.zeros(int(size.sum()), dtype=np.uint8)
+        pos = np.cumsum(size) - size
+        has = counts[start:end] > 0
+        data[pos[has]] = width[has]
+        # byte k of delta j of a row is at 1 + j * width + k
+        byte_pos = pos[:, None] + 1 + np.arange(M) * width[:, None]
+        for k in range(4):
+            sel = valid & (k < width[:, None])
+            data[byte_pos[sel] + k] = (deltas[sel] >> (8 * k)) & 255
+        chunks.append(data)
+    offsets = np.concatenate([[0], np.cumsum(row_bytes)])
+    offsets = offsets.astype(np.uint32 if offsets[-1] < 2**32 else np.int64)
+    return offsets, np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+
+
+class PackedAdjacency(object):
+    '''
+        Read-only neighbour lists of a graph level in the format of pack_adjacency, decoded one row
+        at a time during the search (a view of the row and a cumulative sum)
+    '''
 
-    def vectorized_distance_(self, x, ys):
-        # pprint.pprint([self.distance_func(x, y) for y in ys])
-        return [self.distance_func(x, y) for y in ys]
+    _dtypes = {1: np.dtype('u1'), 2: np.dtype('<u2'), 4: np.dtype('<u4')}
+
+    def __init__(self, offsets, data):
+        # plain ndarray views, slicing a memmap subclass is several times slower
+        self.offsets = np.asarray(offsets)
+        self.data = np.asarray(data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, row, idx):
+        # sorted neighbour ids of row, the row of element idx
+        start, end = int(self.offsets[row]), int(self.offsets[row+1])
+        if start == end:
+            return np.zeros(0, dtype=np.int64)
+        width = int(self.data[start])
+        packed = self.data[start+1:end]
+        if width == 3:
+            packed = packed.reshape(-1, 3).astype(np.int64)
+            values = packed[:, 0] | (packed[:, 1] << 8) | (packed[:, 2] << 16)
+        else:
+            values = packed.view(self._dtypes[width]).astype(np.int64)
+        first = int(values[0])
+        values[0] = ((first >> 1) ^ -(first & 1)) + idx
+        return np.add.accumulate(values, out=values)
+
+    def unpack(self, row_ids, M):
+        # rows x M int32 neighbour matrix (-1 padded) and the number of neighbours of every row
+        neighbors = np.full((len(self), M), -1, dtype=np.int32)
+        counts = np.zeros(len(self), dtype=np.int32)
+        for row, idx in enumerate(np.asarray(row_ids).tolist()):
+            ids = self.row(row, idx)
+            neighbors[row, :len(ids)] = ids
+            counts[row] = len(ids)
+        return neighbors, counts
 
-    def vectorized_distance_PQ_(self, xs, dist_table):
-        return [self.l2_distance_PQ_asymmetric(x, dist_table) for x in xs]
 
-    def __init__(self, distance_type, m=5, ef=200, m0=None, Codewords=None, N_books=None, heuristic=True, vectorized=False):
-        self.data = []
-        Codewords = np.array(Codewords)
-        self.Codewords = Codewords
+class HNSW(object):
+    '''
+        Hierarchical Navigable Small World graph stored in arrays.
+        Level l is a fixed-degree neighbour matrix (rows x M_l int32, -1 padded) together with the
+        distances of the edges (inf padded) and the number of neighbours of every row. Level 0 has a
+        row for every element (row = element id), upper levels map element ids to rows with
+        self._slots[l]. The elements are kept in one contiguous matrix (float32 vectors, or PQ codes
+        if Codewords are given), so the whole neighbour list of a node is scored with one product.
+        Graphs loaded from a compressed index keep PackedAdjacency levels (no edge distances) until
+        a method modifying the graph calls decompress().
+    '''
 
-        if (self.Codewords).any() == None:
-            if distance_type == "l2":
-                # l2 distance
-                distance_func = self.l2_distance
-            elif distance_type == "cosine":
-                # cosine distance
-                distance_func = self.cosine_distance
-            else:
-                raise TypeError('Please check your distance type!')
-        else:
-            distance_func = self.l2_distance_PQ_symmetric
-            _, dim = Codewords.shape
+    # A filtered search keeping n of the N elements scores them directly if n * n <= flat_ratio * ef * N:
+    # the graph search would visit about ef * N / n nodes and visiting a node costs about as much as
+    # scoring flat_ratio elements in one batch (measured ~40us vs ~0.06us for D=64)
+    flat_ratio = 512
+    # search_batch uses a process per min_batch queries at most, below that sending the queries costs more than it saves
+    min_batch = 32
+
+    def __init__(self, distance_type, m=5, ef=200, m0=None, Codewords=None, N_books=None, heuristic=True, vectorized=False,
+                 table_bytes=2**23, table_words=None, storage='float32', vectors=None):
+        # vectorized: kept for compatibility, neighbour lists are always scored at once
+        # table_bytes: maximum size of the codeword-to-codeword distance tables of PQ graphs, see _symmetric_table
+        # table_words: N_books x n codewords whose table rows are kept if the full tables exceed table_bytes
+        #              (see frequent_codewords)
+        # distance_type: 'l2', 'ip' (1 - x.q, for L2-normalized vectors such as our descriptors) or 'cosine'
+        # storage: how the vectors are kept, 'float32', 'float16' (half the memory, upcast per scored batch)
+        #          or 'external' (no copy, element i is row i of vectors, e.g. the feature store)
+        if Codewords is None and distance_type not in ('l2', 'ip', 'cosine'):
+            raise TypeError('Please check your distance type!')
+        if storage not in ('float32', 'float16', 'external') or (Codewords is not None and storage != 'float32'):
+            raise ValueError('Unsupported storage {} (PQ codes are always stored)'.format(storage))
+        self.distance_type = distance_type
+        self.Codewords = None if Codewords is None else np.asarray(Codewords)
+        if self.Codewords is not None:
+            _, dim = self.Codewords.shape
             L_word = int(dim / N_books)
-            self.reshaped_C = np.reshape(Codewords, (-1, N_books, L_word))
-            Codewords = T.from_numpy(Codewords)
-            self.c = T.split(Codewords, L_word, 1)
-
-        self.distance_func = distance_func
-
-        if vectorized:
-            self.distance = self._distance
-            self.vectorized_distance = distance_func
-        else:
-            self.distance = distance_func
-            self.vectorized_distance = self.vectorized_distance_
+            self.reshaped_C = np.reshape(self.Codewords, (-1, N_books, L_word)).astype(np.float32)
+            self._books = np.arange(N_books)
+            self._C_sqnorms = np.einsum('wbl,wbl->wb', self.reshaped_C, self.reshaped_C)
 
         self._m = m     # number of established connections 5~48
         self._ef = ef   # size of the dynamic candidate list efConstruction
         self._m0 = 2 * m if m0 is None else m0  # maximum number of connections for each element
         self._level_mult = 1 / log2(m)  # normalization factor for level generation
-        self._graphs = []
+        self._heuristic = heuristic
         self._enter_point = None
 
-        self._select = (
-            self._select_heuristic if heuristic else self._select_naive)
+        self._storage = storage
+        self._count = 0
+        self._data = None       # capacity x D vectors, capacity x N_books codes or the external vectors
+        self._sqnorms = None    # squared norms of the vectors
+        self._neighbors = []    # per level: rows x M_l int32 element ids (or a PackedAdjacency)
+        self._ndists = []       # per level: rows x M_l float32 distances (None if packed)
+        self._counts = []       # per level: number of neighbours of every row (None if packed)
+        self._slots = [None]    # per upper level: {element id: row}
+        self._position = None   # scratch array of _select_heuristic
+        self._deleted = None    # capacity bool tombstones, None until the first delete
+        self._num_deleted = 0
+        self._ids = None        # original id of every element after reorder()/compact(), None: the element id
+        self._next_id = None    # original id of the next added element once _ids is set
+        self._vectors = None    # the vectors of an 'external' graph, element i is row _ids[i] (or i) of them
+        self._version = 0       # incremented by every change of the graph, a search pool of an older version is replaced
+        self._pool = None       # (process pool, workers, version) of search_batch
+        self._table_bytes = table_bytes
+        self._table_words = None if table_words is None else np.asarray(table_words)
+        self._sym_table = None  # N_books x n x N_words squared distances from n codewords of every book to all
+        self._sym_slot = None   # N_books x N_words row of every codeword in _sym_table, -1 if it has none
+        if storage == 'external':
+            self.attach(vectors)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def data(self):
+        return self._data[:self._count]
+
+    def attach(self, vectors):
+        # vectors (array, FeatureStore, FeatureCatalog, FeatureSubset) referenced by an 'external' graph
+        if self._storage != 'external':
+            raise ValueError('Only graphs with external storage reference vectors')
+        if vectors is None:
+            raise ValueError('A graph with external storage needs the vectors it was built on')
+        self._vectors = getattr(vectors, 'vecs', vectors)
+        self._data = self._vectors if self._ids is None else FeatureSubset(self._vectors, self._ids)
+        self._version += 1
+
+    def original_ids(self, ids):
+        # element ids (e.g. search results) -> ids before reorder() and compact(), -1 stays -1
+        ids = np.asarray(ids)
+        if self._ids is None:
+            return ids
+        return np.where(ids >= 0, self._ids[np.maximum(ids, 0)], -1)
+
+    def _rows(self, ids):
+        # float32 vectors of the elements ids, float16 and external rows are converted per batch
+        rows = self._data[ids]
+        return rows if rows.dtype == np.float32 else np.asarray(rows, dtype=np.float32)
+
+    def _element(self, idx):
+        # element idx as the argument of _scorer
+        return self._data[idx] if self.Codewords is not None else self._rows(np.array([idx]))[0]
+
+    def _level_m(self, level):
+        return self._m0 if level == 0 else self._m
+
+    def _append(self, elem):
+        # with external storage elem must be the next row of the vectors, it is not copied
+        elem = np.asarray(elem)
+        self._version += 1
+        external = self._storage == 'external'
+        if self._sqnorms is None:
+            if not external:
+                dtype = elem.dtype if self.Codewords is not None else np.dtype(self._storage)
+                self._data = np.empty((16,) + elem.shape, dtype=dtype)
+            self._sqnorms = np.empty(16, dtype=np.float32)
+        if self._count == len(self._sqnorms):
+            if not external:
+                self._data = np.concatenate([self._data, np.empty_like(self._data)])
+            self._sqnorms = np.concatenate([self._sqnorms, np.empty_like(self._sqnorms)])
+            if self._deleted is not None:
+                self._deleted = np.concatenate([self._deleted, np.zeros_like(self._deleted)])
+        idx = self._count
+        row = idx if self._ids is None else self._next_id
+        if external and row >= len(self._vectors):
+            raise ValueError('Element {} is not a row of the external vectors'.format(row))
+        if not external:
+            self._data[idx] = elem
+        if self._ids is not None:
+            # the element gets the next original id, compact() leaves gaps so len(_ids) may be taken
+            self._ids = np.append(self._ids, self._next_id)
+            self._next_id += 1
+            if external:
+                self._data = FeatureSubset(self._vectors, self._ids)
+        self._count += 1
+        if self.Codewords is None:
+            vec = self._element(idx)
+            self._sqnorms[idx] = vec @ vec
+        return idx
+
+    def _add_level(self):
+        level = len(self._neighbors)
+        M = self._level_m(level)
+        self._neighbors.append(np.full((16, M), -1, dtype=np.int32))
+        self._ndists.append(np.full((16, M), np.inf, dtype=np.float32))
+        self._counts.append(np.zeros(16, dtype=np.int32))
+        if level > 0:
+            self._slots.append({})
+
+    def _row(self, level, idx):
+        # row of element idx in the neighbour matrix of level, None if idx is not in that level
+        if level == 0:
+            return idx if idx < self._count else None
+        return self._slots[level].get(idx)
+
+    def _new_row(self, level, idx):
+        if level == 0:
+            row = idx
+        else:
+            row = len(self._slots[level])
+            self._slots[level][idx] = row
+        if row >= len(self._counts[level]):
+            grow = max(row + 1, 2 * len(self._counts[level]))
+            M = self._level_m(level)
+            for arrays, fill in ((self._neighbors, -1), (self._ndists, np.inf)):
+                old = arrays[level]
+                arrays[level] = np.full((grow, M), fill, dtype=old.dtype)
+                arrays[level][:len(old)] = old
+            counts = np.zeros(grow, dtype=np.int32)
+            counts[:len(self._counts[level])] = self._counts[level]
+            self._counts[level] = counts
+        return row
+
+    def _neighbor_ids(self, level, idx):
+        row = self._row(level, idx)
+        neighbors = self._neighbors[level]
+        if isinstance(neighbors, PackedAdjacency):
+            return neighbors.row(row, idx)
+        return neighbors[row, :self._counts[level][row]]
+
+    def decompress(self):
+        '''
+            Turn the packed levels of a graph loaded from a compressed index back into neighbour
+            matrices, the edge distances are computed again. Called by the methods modifying the graph.
+        '''
+        for level, packed in enumerate(self._neighbors):
+            if not isinstance(packed, PackedAdjacency):
+                continue
+            row_ids = self._row_ids(level)
+            neighbors, counts = packed.unpack(row_ids, self._level_m(level))
+            ndists = np.full(neighbors.shape, np.inf, dtype=np.float32)
+            for row in np.flatnonzero(counts).tolist():
+                n = counts[row]
+                ndists[row, :n] = self._scorer(self._element(int(row_ids[row])))(neighbors[row, :n])
+            self._neighbors[level], self._ndists[level], self._counts[level] = neighbors, ndists, counts
+
+    def _row_ids(self, level):
+        # element id of every row of level (rows of upper levels are numbered in insertion order)
+        if level == 0:
+            return np.arange(self._count)
+        return np.fromiter(self._slots[level], dtype=np.int64, count=len(self._slots[level]))
+
+    def construct_dist_table(self, query, N_books):
+        '''
+        Inputs:
+        query: query vector
+        N_books: number of the sub-codebooks
+        Outputs:
+        dist_table: N_words * N_books
+        '''
+        reshaped_q = np.reshape(query, (N_books, -1)).astype(np.float32)
+        # ||c - q||^2 = ||c||^2 - 2 c.q + ||q||^2 without an N_words x N_books x L_word temporary
+        dist_table = self._C_sqnorms - 2 * np.einsum('wbl,bl->wb', self.reshaped_C, reshaped_q) \
+            + np.einsum('bl,bl->b', reshaped_q, reshaped_q)
+        return np.maximum(dist_table, 0)
+
+    def _scorer(self, q, query=False):
+        '''
+            Inputs:
+                q: an element (vector or PQ code) or, with query=True, a query vector
+            Outputs:
+                function mapping an array of element ids to their distances to q
+        '''
+        if self.Codewords is None:
+            q = np.asarray(q, dtype=np.float32)
+            qq = float(q @ q)
+            if self.distance_type == 'l2':
+                def score(ids):
+                    # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2, one matrix-vector product for all ids
+                    return np.sqrt(np.maximum(self._sqnorms[ids] - 2 * (self._rows(ids) @ q) + qq, 0))
+            elif self.distance_type == 'ip':
+                # a single dot product per element, no norms
+                def score(ids):
+                    return 1 - self._rows(ids) @ q
+            else:
+                # cosine distance, smaller is closer like the other distances
+                def score(ids):
+                    return 1 - (self._rows(ids) @ q) / np.sqrt(self._sqnorms[ids] * qq)
+        elif query:
+            # asymmetric distance: query vector to PQ codes
+            dist_table = self.construct_dist_table(q, len(self._books))
+            def score(ids):
+                return dist_table[self._data[ids], self._books].sum(axis=1)
+        elif self._symmetric_table() is not None:
+            # symmetric distance: PQ code to PQ codes, a table lookup per book that has a row for q
+            q = np.asarray(q)
+            slot = self._sym_slot[self._books, q]
+            hot = slot >= 0
+            if hot.all():
+                rows = self._sym_table[self._books, slot]
+                def score(ids):
+                    return rows[self._books, self._data[ids]].sum(axis=1)
+            else:
+                hot_books, cold_books = self._books[hot], self._books[~hot]
+                rows = self._sym_table[hot_books, slot[hot]]
+                sub_q = self.reshaped_C[q[cold_books], cold_books]
+                def score(ids):
+                    codes = self._data[ids]
+                    diff = self.reshaped_C[codes[:, cold_books], cold_books] - sub_q
+                    return rows[np.arange(len(hot_books)), codes[:, hot_books]].sum(axis=1) + np.sum(diff * diff, axis=(1, 2))
+        else:
+            # symmetric distance with the codewords of large codebooks
+            sub_q = self.reshaped_C[np.asarray(q), self._books]
+            def score(ids):
+                diff = self.reshaped_C[self._data[ids], self._books] - sub_q
+                return np.sum(diff * diff, axis=(1, 2))
+        return score
+
+    def _symmetric_table(self):
+        '''
+            Squared distances between the codewords of every book, looked up by the symmetric distances
+            of graph construction instead of gathering the codewords: the N_words row of a code stays in
+            the CPU caches while its neighbour lists are scored. The full N_books x N_words x N_words
+            tables are computed once if they fit in table_bytes (4MB for 16 books of 256 words).
+            Otherwise only the rows of table_words are kept (N_books * n * N_words * 4 bytes, e.g. the most
+            frequent codewords) and the books of a code without a row gather the codewords as before.
+            None if there are no tables.
+        '''
+        if self._sym_table is None:
+            num_words = self.reshaped_C.shape[0]
+            if len(self._books) * num_words * num_words * 4 <= self._table_bytes:
+                words = np.tile(np.arange(num_words), (len(self._books), 1))
+            elif self._table_words is not None and self._table_words.shape[1]:
+                words = self._table_words
+            else:
+                return None
+            self._sym_table = np.stack([self._book_distances(b, words[b]) for b in self._books])
+            self._sym_slot = np.full((len(self._books), num_words), -1, dtype=np.int32)
+            self._sym_slot[self._books[:, None], words] = np.arange(words.shape[1])
+        return self._sym_table
+
+    def _book_distances(self, book, words):
+        # len(words) x N_words squared distances from the codewords words of one book to all of its codewords
+        C = self.reshaped_C[:, book]
+        sqnorms = self._C_sqnorms[:, book]
+        return np.maximum(sqnorms[words, None] - 2 * (C[words] @ C.T) + sqnorms, 0)
 
     def add(self, elem, ef=None):
 
+        self.decompress()
         if ef is None:
             ef = self._ef
 
-        distance = self.distance
-        data = self.data
-        graphs = self._graphs
         point = self._enter_point
-        m = self._m
-
-        # level at which the element will be inserted
+        # number of levels the element will be inserted in
         level = int(-log2(random()) * self._level_mult) + 1
-        # print("level: %d" % level)
 
         # elem will be at data[idx]
-        idx = len(data)
-        data.append(elem)
+        idx = self._append(elem)
+        score = self._scorer(self._element(idx))
 
         if point is not None:  # the HNSW is not empty, we have an entry point
-            dist = distance(elem, data[point])
+            dist = float(score(np.array([point]))[0])
             # for all levels in which we dont have to insert elem,
             # we search for the closest neighbor
-            for layer in reversed(graphs[level:]):
-                point, dist = self._search_graph_ef1(elem, point, dist, layer)
+            for layer in reversed(range(level, len(self._neighbors))):
+                point, dist = self._search_graph_ef1(score, point, dist, layer)
             # at these levels we have to insert elem; ep is a heap of entry points.
             ep = [(-dist, point)]
-            # pprint.pprint(ep)
-            layer0 = graphs[0]
-            for layer in reversed(graphs[:level]):
-                level_m = m if layer is not layer0 else self._m0
-                # navigate the graph and update ep with the closest
-                # nodes we find
-                ep = self._search_graph(elem, ep, layer, ef)
-                # insert in g[idx] the best neighbors
-                layer[idx] = layer_idx = {}
-                self._select(layer_idx, ep, level_m, layer, heap=True)
-                # assert len(layer_idx) <= level_m
-                # insert backlinks to the new node
-                for j, dist in layer_idx.items():
-                    self._select(layer[j], (idx, dist), level_m, layer)
-                    # assert len(g[j]) <= level_m
-                # assert all(e in g for _, e in ep)
-        for i in range(len(graphs), level):
-            # for all new levels, we create an empty graph
-            graphs.append({idx: {}})
+            for layer in reversed(range(min(level, len(self._neighbors)))):
+                # navigate the graph and update ep with the closest nodes we find
+                ep = self._search_graph(score, ep, layer, ef)
+                self._insert(layer, idx, ep)
+        for layer in range(len(self._neighbors), level):
+            # for all new levels, we create a graph with only this element
+            self._add_level()
+            self._new_row(layer, idx)
             self._enter_point = idx
 
     def balanced_add(self, elem, ef=None):
+        self.decompress()
         if ef is None:
             ef = self._ef
 
-        distance = self.distance
-        data = self.data
-        graphs = self._graphs
         point = self._enter_point
-        m = self._m
-        m0 = self._m0
-
-        idx = len(data)
-        data.append(elem)
+        idx = self._append(elem)
+        score = self._scorer(self._element(idx))
+        num_levels = len(self._neighbors)
 
         if point is not None:
-            dist = distance(elem, data[point])
+            dist = float(score(np.array([point]))[0])
             pd = [(point, dist)]
-            # pprint.pprint(len(graphs))
-            for layer in reversed(graphs[1:]):
-                point, dist = self._search_graph_ef1(elem, point, dist, layer)
+            for layer in reversed(range(1, num_levels)):
+                point, dist = self._search_graph_ef1(score, point, dist, layer)
                 pd.append((point, dist))
-            for level, layer in enumerate(graphs):
-                # print('\n')
-                # pprint.pprint(layer)
-                level_m = m0 if level == 0 else m
-                candidates = self._search_graph(
-                    elem, [(-dist, point)], layer, ef)
-                layer[idx] = layer_idx = {}
-                self._select(layer_idx, candidates, level_m, layer, heap=True)
-                # add reverse edges
-                for j, dist in layer_idx.items():
-                    self._select(layer[j], [idx, dist], level_m, layer)
-                    assert len(layer[j]) <= level_m
-                if len(layer_idx) < level_m:
+            for level in range(num_levels):
+                candidates = self._search_graph(score, [(-dist, point)], level, ef)
+                self._insert(level, idx, candidates)
+                neighbors = self._neighbor_ids(level, idx)
+                if len(neighbors) < self._level_m(level):
                     return
-                if level < len(graphs) - 1:
-                    if any(p in graphs[level + 1] for p in layer_idx):
+                if level < num_levels - 1:
+                    if any(int(p) in self._slots[level + 1] for p in neighbors):
                         return
                 point, dist = pd.pop()
-        graphs.append({idx: {}})
+        self._add_level()
+        self._new_row(len(self._neighbors) - 1, idx)
         self._enter_point = idx
 
-    def search(self, q, k=None, ef=None):
-        """Find the k points closest to q."""
-        if (self.Codewords).any() == None:
-            distance = self.distance
-        else:
-            distance = self.l2_distance_PQ_asymmetric
-        graphs = self._graphs
-        point = self._enter_point
-
+    def search(self, q, k=None, ef=None, allowed=None):
+        '''
+            Find the k points closest to q
+            Inputs:
+                q: query vector
+                k: number of neighbours (None: all ef candidates)
+                ef: size of the dynamic candidate list (default: the one of the graph)
+                allowed: optional N bool mask, only elements with allowed[idx] are returned
+            Outputs:
+                list of (id, distance) in increasing distance
+        '''
+        if self._enter_point is None:
+            raise ValueError("Empty graph")
+        return self._search(self._scorer(q, query=True), k, ef, *self._filter(allowed))
+
+    def _filter(self, allowed):
+        # skip mask (None: nothing skipped) and number of elements that may be returned
+        if allowed is None:
+            return (self._deleted[:self._count] if self._num_deleted else None), self._count - self._num_deleted
+        allowed = np.asarray(allowed, dtype=bool)
+        if allowed.ndim != 1 or len(allowed) < self._count:
+            raise ValueError('allowed must be a bool mask over the {} elements'.format(self._count))
+        skip = ~allowed[:self._count]
+        if self._num_deleted:
+            skip |= self._deleted[:self._count]
+        return skip, self._count - int(np.count_nonzero(skip))
+
+    def _search(self, score, k, ef, skip, num_live):
         if ef is None:
             ef = self._ef
-
-        if point is None:
-            raise ValueError("Empty graph")
-        if (self.Codewords).any() == None:
-            dist = distance(q, self.data[point])
-        else:
-            encoded_x = self.data[point]
-            dist_table = self.construct_dist_table(q, len(encoded_x))
-            dist = distance(encoded_x, dist_table)
-        # look for the closest neighbor from the top to the 2nd level
-        if (self.Codewords).any() == None:
-            for layer in reversed(graphs[1:]):
-                point, dist = self._search_graph_ef1(q, point, dist, layer)
-            # look for ef neighbors in the bottom level
-            ep = self._search_graph(q, [(-dist, point)], graphs[0], ef)
+        if num_live == 0:
+            return []
+        if skip is not None and num_live < self._count:
+            # Skipped elements are traversed but never fill the candidate list, so a filter keeping
+            # a fraction s of the elements makes the search visit about ef / s nodes. Once that is
+            # more than scoring the allowed elements directly, do the latter.
+            ef = max(ef, k or 0)
+            if num_live * num_live <= self.flat_ratio * ef * self._count:
+                ids = np.flatnonzero(~skip)
+                dist = score(ids)
+                if len(ids) > (k or ef):
+                    top = np.argpartition(dist, (k or ef) - 1)[:k or ef]
+                    ids, dist = ids[top], dist[top]
+                ep = list(zip((-dist).tolist(), ids.tolist()))
+                skip = None
+            else:
+                ep = self._search_level(score, 0, ef, skip=skip)
         else:
-            for layer in reversed(graphs[1:]):
-                point, dist = self._search_graph_ef1_PQ(q, point, dist, layer, dist_table)
-            # look for ef neighbors in the bottom level
-            ep = self._search_graph_PQ(q, [(-dist, point)], graphs[0], ef, dist_table)
+            # deleted elements are still traversed but never returned
+            ep = self._search_level(score, 0, ef, skip=skip)
+        if skip is not None:
+            ep = [(md, idx) for md, idx in ep if not skip[idx]]
 
         if k is not None:
             ep = nlargest(k, ep)
@@ -291,12 +640,117 @@ class HNSW(object):
 
         return [(idx, -md) for md, idx in ep]
 
-    def _search_graph_ef1(self, q, entry, dist, layer):
+    def search_exact(self, q, k, chunk_size=65536, allowed=None):
+        '''
+            Brute-force search with the distance of search() over all live elements (and allowed
+            ones if a mask is given), the ground truth of the graph search
+        '''
+        skip, _ = self._filter(allowed)
+        score = self._scorer(q, query=True)
+        best_dist, best_idx = np.empty((1, 0), dtype=np.float32), np.empty((1, 0), dtype=np.int64)
+        for start in range(0, self._count, chunk_size):
+            ids = np.arange(start, min(start + chunk_size, self._count))
+            if skip is not None:
+                ids = ids[~skip[ids]]
+            best_dist, best_idx = merge_topk(best_dist, best_idx, score(ids).astype(np.float32)[None], ids, k)
+        best_dist, best_idx = sort_topk(best_dist, best_idx)
+        return list(zip(best_idx[0].tolist(), best_dist[0].tolist()))
+
+    def _decoded(self, ids):
+        # float32 vectors of elements (PQ codes are decoded)
+        if self.Codewords is None:
+            return self._rows(ids)
+        return self.reshaped_C[self._data[ids], self._books].reshape(len(ids), -1)
+
+    def search_batch(self, queries, k, ef=None, workers=None, return_latency=False, allowed=None):
+        '''
+            Search many queries, split over forked processes sharing the (read-only) graph. The
+            processes are kept for the next calls until the graph changes (see close_pool()).
+            Inputs:
+                queries: Q x D query vectors
+                k: number of neighbours per query
+                ef: size of the dynamic candidate list (default: the one of the graph)
+                workers: number of processes (None: all cores), each one gets at least
+                         min_batch queries, smaller batches are searched in this process
+                return_latency: also return the search time of every query
+                allowed: optional filter, an N bool mask shared by all queries or a Q x N mask per query
+            Outputs:
+                ids: Q x k int64 ids, -1 where fewer than k elements were found
+                dists: Q x k float32 distances, inf where fewer than k elements were found
+                latency: Q seconds (only with return_latency)
+        '''
+        queries = as_float32(queries) if self.Codewords is None else np.asarray(queries, dtype=np.float32)
+        num_query = len(queries)
+        if self._enter_point is None:
+            raise ValueError("Empty graph")
+        per_query = allowed is not None and np.ndim(allowed) == 2
+        if per_query and len(allowed) != num_query:
+            raise ValueError('allowed must have one row per query')
+        # the skip mask of a shared filter is computed once
+        shared = None if per_query else self._filter(allowed)
+        allowed = allowed if per_query else None
+        # the search is pure Python and holds the GIL, so only processes run queries in parallel
+        workers = min(workers or os.cpu_count() or 1, num_query // self.min_batch)
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods() \
+                and not multiprocessing.current_process().daemon:
+            bounds = np.linspace(0, num_query, 4 * workers + 1).astype(np.int64)
+            tasks = [(queries[start:end], k, ef, None if allowed is None else allowed[start:end], shared)
+                     for start, end in zip(bounds[:-1], bounds[1:])]
+            parts = self._search_pool(workers).map(_search_part, tasks)
+            ids, dists, latency = (np.concatenate(a) for a in zip(*parts))
+        else:
+            ids, dists, latency = self._search_rows(queries, k, ef, allowed, shared)
+        if return_latency:
+            return ids, dists, latency
+        return ids, dists
+
+    def _search_pool(self, workers):
+        # the processes of search_batch, forked again only when the graph or the number of workers changed
+        if self._pool is not None and self._pool[1:] != (workers, self._version):
+            self.close_pool()
+        if self._pool is None:
+            pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_search_worker, initargs=(self,))
+            self._pool = (pool, workers, self._version)
+        return self._pool[0]
+
+    def close_pool(self):
+        '''
+            Stop the worker processes kept by search_batch (they also stop with the graph or the program)
+        '''
+        if self._pool is not None:
+            self._pool[0].terminate()
+            self._pool[0].join()
+            self._pool = None
+
+    def _search_rows(self, queries, k, ef, allowed, shared):
+        # search_batch in this process, allowed: per-query masks or None, shared: the filter of all queries
+        num_query = len(queries)
+        ids = np.full((num_query, k), -1, dtype=np.int64)
+        dists = np.full((num_query, k), np.inf, dtype=np.float32)
+        latency = np.zeros(num_query)
+        for row in range(num_query):
+            t1 = time.perf_counter()
+            query_filter = self._filter(allowed[row]) if allowed is not None else shared
+            res = self._search(self._scorer(queries[row], query=True), k, ef, *query_filter)
+            latency[row] = time.perf_counter() - t1
+            if res:
+                ids[row, :len(res)] = [idx for idx, _ in res]
+                dists[row, :len(res)] = [dist for _, dist in res]
+        return ids, dists, latency
+
+    def _search_level(self, score, level, ef, skip=None):
+        # heap of the ef closest elements of level (descending greedily from the top level)
+        point = self._enter_point
+        dist = float(score(np.array([point]))[0])
+        # look for the closest neighbor from the top to the level above
+        for layer in reversed(range(level + 1, len(self._neighbors))):
+            point, dist = self._search_graph_ef1(score, point, dist, layer)
+        # look for ef neighbors in the level
+        return self._search_graph(score, [(-dist, point)], level, ef, skip=skip)
+
+    def _search_graph_ef1(self, score, entry, dist, layer):
         """Equivalent to _search_graph when ef=1."""
 
-        vectorized_distance = self.vectorized_distance
-        data = self.data
-
         best = entry
         best_dist = dist
         candidates = [(dist, entry)]
@@ -306,185 +760,1074 @@ class HNSW(object):
             dist, c = heappop(candidates)
             if dist > best_dist:
                 break
-            edges = [e for e in layer[c] if e not in visited]
+            edges = [e for e in self._neighbor_ids(layer, c).tolist() if e not in visited]
+            if not edges:
+                continue
             visited.update(edges)
-            dists = vectorized_distance(q, [data[e] for e in edges])
-            for e, dist in zip(edges, dists):
-                if dist < best_dist:
-                    best = e
-                    best_dist = dist
-                    heappush(candidates, (dist, e))
-                    # break
+            dists = score(np.array(edges))
+            closer = np.flatnonzero(dists < best_dist)
+            for i in closer:
+                heappush(candidates, (float(dists[i]), edges[i]))
+            if len(closer):
+                i = closer[np.argmin(dists[closer])]
+                best, best_dist = edges[i], float(dists[i])
 
         return best, best_dist
 
-    def _search_graph(self, q, ep, layer, ef):
-
-        vectorized_distance = self.vectorized_distance
-        data = self.data
+    def _search_graph(self, score, ep, layer, ef, skip=None):
+        # skip: bool mask of elements that are traversed but do not enter ep (the entry points excepted)
 
         candidates = [(-mdist, p) for mdist, p in ep]
         heapify(candidates)
-        visited = set(p for _, p in ep)
+        visited, epoch = _visit_marks(self._count)
+        visited[[p for _, p in ep]] = epoch
 
         while candidates:
             dist, c = heappop(candidates)
             mref = ep[0][0]
             if dist > -mref:
                 break
-            # pprint.pprint(layer[c])
-            edges = [e for e in layer[c] if e not in visited]
-            visited.update(edges)
-            dists = vectorized_distance(q, [data[e] for e in edges])
-            for e, dist in zip(edges, dists):
+            edges = self._neighbor_ids(layer, c)
+            edges = edges[visited[edges] != epoch]
+            if not len(edges):
+                continue
+            visited[edges] = epoch
+            dists = score(edges)
+            if len(ep) >= ef:
+                # only elements closer than the current ef-th can enter ep
+                closer = dists < -mref
+                edges, dists = edges[closer], dists[closer]
+            for e, dist in zip(edges.tolist(), dists.tolist()):
                 mdist = -dist
-                if len(ep) < ef:
-                    heappush(candidates, (dist, e))
-                    heappush(ep, (mdist, e))
-                    mref = ep[0][0]
-                elif mdist > mref:
+                if len(ep) < ef or mdist > mref:
                     heappush(candidates, (dist, e))
-                    heapreplace(ep, (mdist, e))
+                    if skip is not None and skip[e]:
+                        continue
+                    if len(ep) < ef:
+                        heappush(ep, (mdist, e))
+                    else:
+                        heapreplace(ep, (mdist, e))
                     mref = ep[0][0]
 
         return ep
 
-    def _search_graph_ef1_PQ(self, q, entry, dist, layer, dist_table):
-        """Equivalent to _search_graph when ef=1."""
-
-        data = self.data
-
-        best = entry
-        best_dist = dist
-        candidates = [(dist, entry)]
-        visited = set([entry])
-
-        while candidates:
-            dist, c = heappop(candidates)
-            if dist > best_dist:
+    def _insert(self, layer, idx, ep):
+        # connect the new element idx to the closest elements of ep and add the backlinks
+        self._link(layer, self._new_row(layer, idx), idx, ep)
+
+    def _link(self, layer, row, idx, ep):
+        # make the closest elements of ep (except idx) the neighbours of idx and add the missing backlinks
+        M = self._level_m(layer)
+        nearest = nsmallest(M, ((-mdist, e) for mdist, e in ep if e != idx))
+        self._write_row(layer, row, [e for _, e in nearest], [d for d, _ in nearest])
+        select = self._select_heuristic if self._heuristic else self._select_naive
+        for dist, j in nearest:
+            if idx not in self._neighbor_ids(layer, j):
+                select(layer, j, idx, dist)
+
+    def _select_neighbors(self, cand, M):
+        '''
+            Heuristic neighbour selection of the HNSW paper: a candidate is kept unless it is closer
+            to an already kept neighbour than to the element, so that the neighbours point in
+            different directions (and link clusters). The closest dropped candidates fill up the list.
+            Inputs:
+                cand: (distance, id) candidates sorted by distance
+            Outputs:
+                at most M (distance, id) neighbours
+        '''
+        selected, dropped = [], []
+        for dist, e in cand:
+            if len(selected) >= M:
                 break
-            edges = [e for e in layer[c] if e not in visited]
-            visited.update(edges)
-            dists = self.vectorized_distance_PQ_([data[e] for e in edges], dist_table)
-            for e, dist in zip(edges, dists):
-                if dist < best_dist:
-                    best = e
-                    best_dist = dist
-                    heappush(candidates, (dist, e))
-                    # break
-
-        return best, best_dist
-
-    def _search_graph_PQ(self, q, ep, layer, ef, dist_table):
-
-        data = self.data
+            if selected and (self._scorer(self._element(e))(np.array([s for _, s in selected])) < dist).any():
+                dropped.append((dist, e))
+            else:
+                selected.append((dist, e))
+        return selected + dropped[:M - len(selected)]
+
+    def _write_row(self, layer, row, neighbors, ndists):
+        n = len(neighbors)
+        self._neighbors[layer][row, :n] = neighbors
+        self._neighbors[layer][row, n:] = -1
+        self._ndists[layer][row, :n] = ndists
+        self._ndists[layer][row, n:] = np.inf
+        self._counts[layer][row] = n
+
+    def _select_naive(self, layer, j, idx, dist):
+        # add the edge j -> idx, replacing the longest edge of j if it is full
+        row = self._row(layer, j)
+        n = self._counts[layer][row]
+        neighbors, ndists = self._neighbors[layer][row], self._ndists[layer][row]
+        if n < len(neighbors):
+            neighbors[n], ndists[n] = idx, dist
+            self._counts[layer][row] = n + 1
+            return
+        w = np.argmax(ndists)
+        if dist < ndists[w]:
+            neighbors[w], ndists[w] = idx, dist
 
-        candidates = [(-mdist, p) for mdist, p in ep]
-        heapify(candidates)
-        visited = set(p for _, p in ep)
+    def _select_heuristic(self, layer, j, idx, dist):
+        '''
+            Add the edge j -> idx. If j is full, an edge to an element that is also reachable
+            through a shorter edge of another neighbour of j is dropped first, then the longest one.
+        '''
+        row = self._row(layer, j)
+        n = self._counts[layer][row]
+        neighbors, ndists = self._neighbors[layer][row], self._ndists[layer][row]
+        if n < len(neighbors):
+            neighbors[n], ndists[n] = idx, dist
+            self._counts[layer][row] = n + 1
+            return
+        rows = neighbors if layer == 0 else [self._slots[layer][e] for e in neighbors.tolist()]
+        # M x M neighbours of the neighbours of j and their distances (padding never matches)
+        nn_ids, nn_dists = self._neighbors[layer][rows], self._ndists[layer][rows]
+        p_new = bool(np.any((nn_ids == idx) & (nn_dists < dist)))
+        # p_old[o]: some neighbour of j has an edge to neighbour o that is shorter than j -> o
+        # self._position maps element ids to their position in neighbors (stale entries fail the check)
+        if self._position is None or len(self._position) < self._count:
+            self._position = np.zeros(2 * self._count, dtype=np.intp)
+        self._position[neighbors] = np.arange(len(neighbors))
+        pos = np.minimum(self._position[nn_ids], len(neighbors) - 1)
+        shorter = (neighbors[pos] == nn_ids) & (nn_dists < ndists[pos])
+        p_old = np.zeros(len(neighbors), dtype=bool)
+        p_old[pos[shorter]] = True
+        cand = np.flatnonzero(p_old) if p_old.any() else np.arange(len(neighbors))
+        w = cand[np.argmax(ndists[cand])]
+        if (bool(p_old[w]), ndists[w]) > (p_new, dist):
+            neighbors[w], ndists[w] = idx, dist
+
+    def delete(self, ids):
+        '''
+            Mark elements as deleted. They are no longer returned by search but stay in the graph
+            (and keep routing the searches) until repair() or compact() is called
+            Inputs:
+                ids: an element id or an array of ids
+        '''
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if len(ids) and (ids.min() < 0 or ids.max() >= self._count):
+            raise IndexError('element id out of range')
+        self._version += 1
+        if self._deleted is None:
+            self._deleted = np.zeros(len(self._sqnorms), dtype=bool)
+        self._deleted[ids] = True
+        self._num_deleted = int(np.count_nonzero(self._deleted[:self._count]))
+
+    def replace(self, idx, elem, ef=None):
+        '''
+            Replace the vector (or PQ code) of element idx, e.g. after an image was re-cropped.
+            The element keeps its id and levels, its neighbours are searched again and the
+            distances of the edges pointing to it are updated. A deleted element is restored.
+            With external storage the row is read from the vectors (update them first), elem is ignored.
+        '''
+        if not 0 <= idx < self._count:
+            raise IndexError('element id out of range')
+        self.decompress()
+        self._version += 1
+        if ef is None:
+            ef = self._ef
+        if self._storage != 'external':
+            self._data[idx] = np.asarray(elem)
+        if self.Codewords is None:
+            vec = self._element(idx)
+            self._sqnorms[idx] = vec @ vec
+        if self._deleted is not None and self._deleted[idx]:
+            self._deleted[idx] = False
+            self._num_deleted -= 1
+        score = self._scorer(self._element(idx))
+
+        num_levels = len(self._neighbors)
+        levels = [layer for layer in range(num_levels) if self._row(layer, idx) is not None]
+        for layer in levels:
+            # edges pointing to idx keep their place, only their distance changes
+            rows, cols = np.nonzero(self._neighbors[layer][:self._num_rows(layer)] == idx)
+            if len(rows):
+                self._ndists[layer][rows, cols] = score(self._row_ids(layer)[rows])
+        if self._count == 1:
+            return
 
-        while candidates:
-            dist, c = heappop(candidates)
-            mref = ep[0][0]
-            if dist > -mref:
-                break
-            # pprint.pprint(layer[c])
-            edges = [e for e in layer[c] if e not in visited]
-            visited.update(edges)
-            dists = self.vectorized_distance_PQ_([data[e] for e in edges], dist_table)
-            for e, dist in zip(edges, dists):
-                mdist = -dist
-                if len(ep) < ef:
-                    heappush(candidates, (dist, e))
-                    heappush(ep, (mdist, e))
-                    mref = ep[0][0]
-                elif mdist > mref:
-                    heappush(candidates, (dist, e))
-                    heapreplace(ep, (mdist, e))
-                    mref = ep[0][0]
+        point = self._enter_point
+        dist = float(score(np.array([point]))[0])
+        for layer in reversed(range(len(levels), num_levels)):
+            point, dist = self._search_graph_ef1(score, point, dist, layer)
+        ep = [(-dist, point)]
+        for layer in reversed(levels):
+            ep = self._search_graph(score, ep, layer, ef + 1)
+            self._link(layer, self._row(layer, idx), idx, ep)
+
+    def _num_rows(self, level):
+        return self._count if level == 0 else len(self._slots[level])
+
+    def repair(self):
+        '''
+            Reconnect the graph around the deleted elements: the edges of a live element to deleted
+            elements are replaced by the closest live elements reachable through them (its other
+            neighbours included), the deleted elements lose all their edges and, if needed, the entry
+            point moves to a live element. Only the rows around deleted elements are rewritten.
+            Ids do not change, the deleted elements stay tombstoned (see compact()).
+            Outputs:
+                number of rewritten rows
+        '''
+        if not self._num_deleted:
+            return 0
+        self.decompress()
+        self._version += 1
+        deleted = self._deleted[:self._count]
+        rewritten = 0
+        for layer in range(len(self._neighbors)):
+            num_rows = self._num_rows(layer)
+            row_ids = self._row_ids(layer)
+            neighbors = self._neighbors[layer][:num_rows]
+            dead = (neighbors >= 0) & deleted[np.maximum(neighbors, 0)]
+            backlinks = []
+            for row in np.flatnonzero(dead.any(axis=1) & ~deleted[row_ids]).tolist():
+                idx = int(row_ids[row])
+                n = self._counts[layer][row]
+                own = self._neighbors[layer][row, :n]
+                keep = ~deleted[own]
+                # the live neighbours stay, the freed slots go to the closest live neighbours of the
+                # deleted ones (one more hop through deleted elements if that finds none)
+                hops = own[~keep]
+                cand = np.empty(0, dtype=np.int64)
+                for _ in range(2):
+                    reached = np.unique(np.concatenate([self._neighbor_ids(layer, e) for e in hops.tolist()]))
+                    cand = reached[~deleted[reached]]
+                    cand = cand[(cand != idx) & ~np.isin(cand, own)]
+                    if len(cand):
+                        break
+                    hops = reached[deleted[reached]]
+                    if not len(hops):
+                        break
+                dists = self._scorer(self._element(idx))(cand)
+                nearest = np.argsort(dists, kind='stable')[:n - np.count_nonzero(keep)]
+                self._write_row(layer, row, np.concatenate([own[keep], cand[nearest]]),
+                                np.concatenate([self._ndists[layer][row, :n][keep], dists[nearest]]))
+                rewritten += 1
+                backlinks.append((layer, idx, cand[nearest], dists[nearest]))
+            select = self._select_heuristic if self._heuristic else self._select_naive
+            for _, idx, new, dists in backlinks:
+                for j, dist in zip(new.tolist(), dists.tolist()):
+                    if idx not in self._neighbor_ids(layer, j):
+                        select(layer, j, idx, dist)
+            # deleted elements can no longer be reached, drop their edges
+            self._counts[layer][:num_rows][deleted[row_ids]] = 0
+            self._neighbors[layer][:num_rows][deleted[row_ids]] = -1
+            self._ndists[layer][:num_rows][deleted[row_ids]] = np.inf
+
+        if deleted[self._enter_point]:
+            # highest level that still has a live element, the levels above it are removed
+            while len(self._neighbors) > 1:
+                live = self._row_ids(len(self._neighbors) - 1)
+                live = live[~deleted[live]]
+                if len(live):
+                    break
+                for name in ('_neighbors', '_ndists', '_counts', '_slots'):
+                    getattr(self, name).pop()
+            else:
+                live = np.flatnonzero(~deleted)
+            self._enter_point = int(live[0]) if len(live) else self._enter_point
+        return rewritten
 
-        return ep
+    def compact(self):
+        '''
+            repair() and remove the deleted elements, the remaining elements are renumbered
+            Outputs:
+                ids: former ids of the elements (new id i was ids[i]), map search results with it
+        '''
+        self.repair()
+        keep = np.arange(self._count) if self._deleted is None else np.flatnonzero(~self._deleted[:self._count])
+        if len(keep) == self._count:
+            return keep
+        if not len(keep):
+            raise ValueError('All elements are deleted')
+        self._version += 1
+        new_id = np.full(self._count, -1, dtype=np.int64)
+        new_id[keep] = np.arange(len(keep))
+        for layer in range(len(self._neighbors)):
+            rows = keep if layer == 0 else np.array(
+                [row for e, row in self._slots[layer].items() if new_id[e] >= 0], dtype=np.int64)
+            neighbors = self._neighbors[layer][rows]
+            self._neighbors[layer] = np.where(neighbors >= 0, new_id[neighbors], -1).astype(np.int32)
+            self._ndists[layer] = self._ndists[layer][rows]
+            self._counts[layer] = self._counts[layer][rows]
+            if layer > 0:
+                live = [e for e in self._slots[layer] if new_id[e] >= 0]
+                self._slots[layer] = {int(new_id[e]): row for row, e in enumerate(live)}
+        self._sqnorms = self._sqnorms[keep]
+        if self._ids is None:
+            self._next_id = self._count
+        self._ids = keep if self._ids is None else self._ids[keep]
+        # external vectors are always indexed from their rows, so the graph can grow again
+        self._data = FeatureSubset(self._vectors, self._ids) if self._storage == 'external' else self._data[keep]
+        self._count = len(keep)
+        self._enter_point = int(new_id[self._enter_point])
+        self._deleted = None
+        self._num_deleted = 0
+        self._position = None
+        return keep
+
+    def reorder(self):
+        '''
+            Renumber the elements in reverse Cuthill-McKee order of the level 0 graph (a breadth-first
+            order visiting low-degree nodes first), so that the neighbours of a node get close ids.
+            Their vectors and level 0 rows then share pages and cache lines, which matters most for
+            memory-mapped graphs larger than the page cache. original_ids() maps the new ids back.
+            Outputs:
+                order: former ids of the elements (new id i was order[i]), like compact()
+        '''
+        self.decompress()
+        self._version += 1
+        count = self._count
+        M0 = self._neighbors[0].shape[1]
+        counts = self._counts[0][:count]
+        heads = np.repeat(np.arange(count), counts)
+        tails = self._neighbors[0][:count][np.arange(M0) < counts[:, None]]
+        graph = sparse.csr_matrix((np.ones(len(heads), dtype=np.int8), (heads, tails)), shape=(count, count))
+        order = reverse_cuthill_mckee(graph.maximum(graph.T).tocsr(), symmetric_mode=True).astype(np.int64)
+        new_id = np.empty(count, dtype=np.int64)
+        new_id[order] = np.arange(count)
+        for layer in range(len(self._neighbors)):
+            # upper levels keep their rows, only the element ids change
+            rows = order if layer == 0 else slice(0, self._num_rows(layer))
+            neighbors = self._neighbors[layer][rows]
+            self._neighbors[layer] = np.where(neighbors >= 0, new_id[np.maximum(neighbors, 0)], -1).astype(np.int32)
+            self._ndists[layer] = self._ndists[layer][rows]
+            self._counts[layer] = self._counts[layer][rows]
+            if layer > 0:
+                self._slots[layer] = {int(new_id[e]): row for e, row in self._slots[layer].items()}
+        self._sqnorms = self._sqnorms[order]
+        if self._deleted is not None:
+            self._deleted = self._deleted[order]
+        if self._ids is None:
+            self._next_id = self._count
+        self._ids = order if self._ids is None else self._ids[order]
+        self._data = FeatureSubset(self._vectors, self._ids) if self._storage == 'external' else self._data[order]
+        self._enter_point = int(new_id[self._enter_point])
+        self._position = None
+        return order
+
+    def maintain(self, max_ratio=0.1, compact=False):
+        '''
+            repair() (or compact()) once max_ratio of the elements are deleted and their edges were not
+            repaired yet. Meant to be called after deleting or replacing elements, e.g. between the
+            requests of a server: the repair runs synchronously and the graph must not be searched meanwhile.
+            Inputs:
+                compact: remove the deleted elements instead of only reconnecting around them (renumbers
+                         the elements, map search results with original_ids())
+            Outputs:
+                True if the graph was repaired
+        '''
+        if self._num_deleted < max_ratio * self._count:
+            return False
+        if compact:
+            self.compact()
+        elif self.stats()['dangling_edges']:
+            self.repair()
+        else:
+            return False
+        return True
+
+    def stats(self):
+        # tombstone statistics, a rebuild pays off when many elements are deleted
+        dangling = 0
+        if self._num_deleted:
+            deleted = self._deleted[:self._count]
+            for layer in range(len(self._neighbors)):
+                row_ids = self._row_ids(layer)
+                live = ~deleted[row_ids]
+                neighbors = self._neighbors[layer]
+                if isinstance(neighbors, PackedAdjacency):
+                    neighbors, _ = neighbors.unpack(row_ids, self._level_m(layer))
+                neighbors = neighbors[:self._num_rows(layer)][live]
+                dangling += int(np.count_nonzero((neighbors >= 0) & deleted[np.maximum(neighbors, 0)]))
+        return {'elements': self._count, 'deleted': self._num_deleted,
+                'tombstone_ratio': self._num_deleted / max(self._count, 1),
+                'dangling_edges': dangling, 'levels': len(self._neighbors)}
 
-    def _select_naive(self, d, to_insert, m, layer, heap=False):
+    def __getitem__(self, idx):
 
-        if not heap:
-            idx, dist = to_insert
-            assert idx not in d
-            if len(d) < m:
-                d[idx] = dist
+        for layer in range(len(self._neighbors)):
+            row = self._row(layer, idx)
+            if row is None:
+                return
+            if isinstance(self._neighbors[layer], PackedAdjacency):
+                neighbors = self._neighbor_ids(layer, idx)
+                yield from zip(neighbors.tolist(), self._scorer(self._element(idx))(neighbors).tolist())
+                continue
+            n = self._counts[layer][row]
+            yield from zip(self._neighbors[layer][row, :n].tolist(), self._ndists[layer][row, :n].tolist())
+
+    def __getstate__(self):
+        # drop the unused capacity of the arrays
+        state = self.__dict__.copy()
+        state['_position'] = None
+        state['_sym_table'] = None
+        state['_sym_slot'] = None
+        state['_pool'] = None
+        state['_deleted'] = None if self._deleted is None else self._deleted[:self._count].copy()
+        if self._storage == 'external':
+            # the vectors are attached again after loading
+            state['_data'] = None
+            state['_vectors'] = None
+        else:
+            state['_data'] = None if self._data is None else self._data[:self._count].copy()
+        state['_sqnorms'] = None if self._sqnorms is None else self._sqnorms[:self._count].copy()
+        sizes = [self._count] + [len(slots) for slots in self._slots[1:]]
+        for name in ('_neighbors', '_ndists', '_counts'):
+            state[name] = [a if a is None or isinstance(a, PackedAdjacency) else a[:size].copy()
+                           for a, size in zip(getattr(self, name), sizes)]
+        return state
+
+    def __setstate__(self, state):
+        # graphs pickled before tombstones and distance tables existed
+        state.setdefault('_deleted', None)
+        state.setdefault('_num_deleted', 0)
+        state.setdefault('_table_bytes', 2**23)
+        state.setdefault('_sym_table', None)
+        state.setdefault('_sym_slot', None)
+        state.setdefault('_table_words', None)
+        state.setdefault('_storage', 'float32')
+        state.setdefault('_ids', None)
+        state.setdefault('_vectors', None)
+        state.setdefault('_version', 0)
+        state.setdefault('_pool', None)
+        if '_next_id' not in state:
+            state['_next_id'] = None if state['_ids'] is None else int(state['_ids'].max(initial=-1)) + 1
+        if 'reshaped_C' in state and '_C_sqnorms' not in state:
+            state['_C_sqnorms'] = np.einsum('wbl,wbl->wb', state['reshaped_C'], state['reshaped_C'])
+        self.__dict__.update(state)
+
+
+# state shared with the worker processes of build_hnsw and HNSW.search_batch (inherited through fork)
+_BUILD_STATE = {}
+_SEARCH_STATE = {}
+
+
+def _init_search_worker(hnsw):
+    # the graph of a search_batch worker, inherited through fork instead of being pickled
+    _SEARCH_STATE['hnsw'] = hnsw
+
+
+def _search_part(task):
+    # search_batch of a block of queries: (queries, k, ef, per-query masks or None, shared filter)
+    return _SEARCH_STATE['hnsw']._search_rows(*task)
+
+
+def _build_partition(p):
+    # HNSW of the elements part_ids[p], local id i is element part_ids[p][i]
+    data, ids, kwargs, balanced = (_BUILD_STATE[key] for key in ('data', 'part_ids', 'kwargs', 'balanced'))
+    ids = ids[p]
+    random_seed(p)
+    if kwargs.get('storage') == 'external':
+        kwargs = dict(kwargs, vectors=FeatureSubset(data, ids))
+    hnsw = HNSW(**kwargs)
+    _share_tables(hnsw, _BUILD_STATE['tables'])
+    add = hnsw.balanced_add if balanced else hnsw.add
+    for start in range(0, len(ids), 65536):
+        for x in np.asarray(data[ids[start:start+65536]]):
+            add(x)
+    return hnsw
+
+
+def _relink(task):
+    '''
+        New neighbours of the elements ids of a level of the merged graph: their neighbours within
+        their own partition plus the closest elements found in the graphs of the nearest partitions
+    '''
+    level, ids = task
+    merged, parts, part_ids, near, ef = (_BUILD_STATE[key] for key in ('merged', 'parts', 'part_ids', 'near', 'ef'))
+    M = merged._level_m(level)
+    neighbors = np.full((len(ids), M), -1, dtype=np.int32)
+    ndists = np.full((len(ids), M), np.inf, dtype=np.float32)
+    counts = np.zeros(len(ids), dtype=np.int32)
+    for i, idx in enumerate(ids):
+        row = merged._row(level, idx)
+        n = merged._counts[level][row]
+        cand = dict(zip(merged._neighbors[level][row, :n].tolist(), merged._ndists[level][row, :n].tolist()))
+        for p in near[idx].tolist():
+            part = parts[p]
+            if len(part._neighbors) <= level:
+                continue
+            ep = part._search_level(part._scorer(merged._element(idx)), level, ef)
+            cand.update((int(part_ids[p][e]), -mdist) for mdist, e in ep)
+        nearest = nsmallest(M, ((d, e) for e, d in cand.items()))
+        neighbors[i, :len(nearest)] = [e for _, e in nearest]
+        ndists[i, :len(nearest)] = [d for d, _ in nearest]
+        counts[i] = len(nearest)
+    return level, ids, neighbors, ndists, counts
+
+
+def _refine(task):
+    '''
+        New neighbours of the elements ids of a level of the merged graph, chosen with the heuristic
+        of HNSW among their current neighbours, the elements having an edge to them and the result
+        of a search for them in the whole merged graph
+    '''
+    level, ids = task
+    merged, ef, incoming = (_BUILD_STATE[key] for key in ('merged', 'ef', 'incoming'))
+    offsets, sources, source_dists = incoming[level]
+    M = merged._level_m(level)
+    neighbors = np.full((len(ids), M), -1, dtype=np.int32)
+    ndists = np.full((len(ids), M), np.inf, dtype=np.float32)
+    counts = np.zeros(len(ids), dtype=np.int32)
+    for i, idx in enumerate(ids):
+        row = merged._row(level, idx)
+        n = merged._counts[level][row]
+        cand = dict(zip(merged._neighbors[level][row, :n].tolist(), merged._ndists[level][row, :n].tolist()))
+        cand.update(zip(sources[offsets[row]:offsets[row + 1]].tolist(), source_dists[offsets[row]:offsets[row + 1]].tolist()))
+        ep = merged._search_level(merged._scorer(merged._element(idx)), level, ef)
+        cand.update((e, -mdist) for mdist, e in ep if e != idx)
+        selected = merged._select_neighbors(sorted((d, e) for e, d in cand.items()), M)
+        neighbors[i, :len(selected)] = [e for _, e in selected]
+        ndists[i, :len(selected)] = [d for d, _ in selected]
+        counts[i] = len(selected)
+    return level, ids, neighbors, ndists, counts
+
+
+def _incoming_edges(hnsw, level):
+    # (row offsets, ids, distances) of the elements having an edge to every row of level
+    row_ids = hnsw._row_ids(level)
+    num_rows = len(row_ids)
+    counts = hnsw._counts[level][:num_rows]
+    valid = np.arange(hnsw._neighbors[level].shape[1]) < counts[:, None]
+    heads = np.repeat(row_ids, counts)
+    tails = hnsw._neighbors[level][:num_rows][valid].astype(np.int64)
+    dists = hnsw._ndists[level][:num_rows][valid]
+    if level > 0:
+        slots = hnsw._slots[level]
+        tails = np.fromiter((slots[e] for e in tails.tolist()), dtype=np.int64, count=len(tails))
+    order = np.argsort(tails, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(tails, minlength=num_rows))])
+    return offsets, heads[order], dists[order]
+
+
+def _write_rows(hnsw, results):
+    # write the rows computed by _relink or _refine
+    for level, ids, neighbors, ndists, counts in results:
+        rows = ids if level == 0 else [hnsw._slots[level][idx] for idx in ids]
+        hnsw._neighbors[level][rows] = neighbors
+        hnsw._ndists[level][rows] = ndists
+        hnsw._counts[level][rows] = counts
+
+
+def _share_tables(hnsw, tables):
+    # PQ distance tables computed once by build_hnsw, the workers share their pages through fork
+    hnsw._sym_table, hnsw._sym_slot = tables
+
+
+def _merge_partitions(parts, part_ids, kwargs):
+    # one graph containing the disconnected graphs of all partitions, element ids become global
+    merged = HNSW(**kwargs)
+    num = sum(len(ids) for ids in part_ids)
+    merged._count = num
+    external = merged._storage == 'external'
+    if not external:
+        merged._data = np.empty((num,) + parts[0]._data.shape[1:], dtype=parts[0]._data.dtype)
+    merged._sqnorms = np.empty(num, dtype=np.float32)
+    for part, ids in zip(parts, part_ids):
+        if not external:
+            merged._data[ids] = part.data
+        merged._sqnorms[ids] = part._sqnorms[:len(part)]
+    top = int(np.argmax([len(part._neighbors) for part in parts]))
+    merged._enter_point = int(part_ids[top][parts[top]._enter_point])
+    for level in range(len(parts[top]._neighbors)):
+        merged._add_level()
+        M = merged._level_m(level)
+        rows = num if level == 0 else sum(len(part._slots[level]) for part in parts if len(part._neighbors) > level)
+        merged._neighbors[level] = np.full((rows, M), -1, dtype=np.int32)
+        merged._ndists[level] = np.full((rows, M), np.inf, dtype=np.float32)
+        merged._counts[level] = np.zeros(rows, dtype=np.int32)
+        for part, ids in zip(parts, part_ids):
+            if len(part._neighbors) <= level:
+                continue
+            if level == 0:
+                local = np.arange(len(part))
+                new_rows = ids
             else:
-                max_idx, max_dist = max(d.items(), key=itemgetter(1))
-                if dist < max_dist:
-                    del d[max_idx]
-                    d[idx] = dist
-            return
+                local = np.fromiter(part._slots[level], dtype=np.int64)
+                new_rows = [merged._new_row(level, int(idx)) for idx in ids[local]]
+            neighbors = part._neighbors[level][:len(local)]
+            merged._neighbors[level][new_rows] = np.where(neighbors >= 0, ids[neighbors], -1)
+            merged._ndists[level][new_rows] = part._ndists[level][:len(local)]
+            merged._counts[level][new_rows] = part._counts[level][:len(local)]
+    return merged
 
-        assert not any(idx in d for _, idx in to_insert)
-        to_insert = nlargest(m, to_insert)  # smallest m distances
-        unchecked = m - len(d)
-        assert 0 <= unchecked <= m
-        to_insert, checked_ins = to_insert[:unchecked], to_insert[unchecked:]
-        to_check = len(checked_ins)
-        if to_check > 0:
-            checked_del = nlargest(to_check, d.items(), key=itemgetter(1))
-        else:
-            checked_del = []
-        for md, idx in to_insert:
-            d[idx] = -md
-        zipped = zip(checked_ins, checked_del)
-        for (md_new, idx_new), (idx_old, d_old) in zipped:
-            if d_old <= -md_new:
-                break
-            del d[idx_old]
-            d[idx_new] = -md_new
-            assert len(d) == m
 
-    def _select_heuristic(self, d, to_insert, m, g, heap=False):
+def _partition(data, num_parts, relink, vectors, sample=20000, chunk_size=65536):
+    '''
+        k-means partitioning of the elements
+        Outputs:
+            part_ids: sorted element ids of every partition
+            near: N x relink ids of the next closest partitions of every element
+    '''
+    num = len(data)
+    sample_ids = np.sort(np.random.default_rng(0).choice(num, size=min(num, sample), replace=False))
+    kmeans = KMeans(n_clusters=num_parts, n_init=1, random_state=0).fit(vectors(np.asarray(data[sample_ids])))
+    centroids = kmeans.cluster_centers_.astype(np.float32)
+    order = np.empty((num, min(relink + 1, num_parts)), dtype=np.int64)
+    for start in range(0, num, chunk_size):
+        block = vectors(np.asarray(data[start:start+chunk_size]))
+        dist = ((block[:, None, :] - centroids[None]) ** 2).sum(axis=2)
+        order[start:start+len(block)] = np.argsort(dist, axis=1)[:, :order.shape[1]]
+    part_ids = [np.flatnonzero(order[:, 0] == p) for p in range(num_parts)]
+    # partitions k-means left empty are dropped, near refers to the remaining ones
+    keep = [p for p in range(num_parts) if len(part_ids[p])]
+    renumber = np.full(num_parts, -1, dtype=np.int64)
+    renumber[keep] = np.arange(len(keep))
+    near = [row[row >= 0] for row in renumber[order[:, 1:]]]
+    return [part_ids[p] for p in keep], near
+
+
+def frequent_codewords(codes, N_words, table_bytes, chunk_size=65536):
+    '''
+        The codewords of every book whose symmetric distance table rows fit in table_bytes, most
+        frequent first (see HNSW._symmetric_table)
+        Inputs:
+            codes: N x N_books PQ codes
+        Outputs:
+            N_books x n codeword ids
+    '''
+    N_books = codes.shape[1]
+    counts = np.zeros((N_books, N_words), dtype=np.int64)
+    for _, block in iter_chunks(codes, chunk_size):
+        for book in range(N_books):
+            counts[book] += np.bincount(np.asarray(block[:, book], dtype=np.int64), minlength=N_words)
+    num = min(N_words, table_bytes // (N_books * N_words * 4))
+    return np.argsort(-counts, axis=1, kind='stable')[:, :num]
 
-        nb_dicts = [g[idx] for idx in d]
 
-        def prioritize(idx, dist):
-            return any(nd.get(idx, float('inf')) < dist for nd in nb_dicts), dist, idx
+def build_hnsw(data, m, ef, workers=None, balanced=False, min_partition=20000, relink=2, refine=2, **kwargs):
+    '''
+        Inputs:
+            data: N x D vectors (array, FeatureStore, FeatureCatalog) or N x N_books PQ codes
+            m, ef: see HNSW
+            workers: number of processes (None: all cores). With more than one, the elements are
+                     split into k-means partitions whose graphs are built in parallel and merged,
+                     then every element is re-linked to the closest elements of its `relink`
+                     nearest other partitions. Finally, in `refine` passes, every element searches
+                     the merged graph and picks its neighbours with the HNSW heuristic (two passes
+                     give about the recall of a single-process build)
+            balanced: insert with balanced_add instead of add
+            min_partition: minimum number of elements per partition
+            kwargs: other arguments of HNSW (distance_type, Codewords, N_books, table_bytes, ...). PQ
+                    distance tables larger than table_bytes keep the rows of the most frequent codewords
+        Outputs:
+            hnsw: the HNSW graph
+            timing: seconds spent in every phase of the build
+    '''
+    kwargs = dict(kwargs, m=m, ef=ef)
+    kwargs.setdefault('distance_type', 'l2')
+    data = getattr(data, 'vecs', data)
+    if kwargs.get('storage') == 'external':
+        kwargs['vectors'] = data
+    if kwargs.get('Codewords') is not None and kwargs.get('table_words') is None:
+        kwargs['table_words'] = frequent_codewords(data, len(kwargs['Codewords']), kwargs.get('table_bytes', 2**23))
+    num = len(data)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    num_parts = max(1, min(workers, num // min_partition))
+    if num_parts == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        t1 = time.time()
+        hnsw = HNSW(**kwargs)
+        add = hnsw.balanced_add if balanced else hnsw.add
+        widgets = ['Progress: ', Percentage(), ' ', Bar('#'), ' ', Timer(), ' ', ETA()]
+        pbar = ProgressBar(widgets=widgets, maxval=num).start()
+        for start, block in iter_chunks(data):
+            for i, x in enumerate(block, start):
+                add(x)
+                pbar.update(i + 1)
+        pbar.finish()
+        timing = {'insert': time.time() - t1}
+        print('>> HNSW build: {:.1f}s'.format(timing['insert']))
+        return hnsw, timing
 
-        if not heap:
-            idx, dist = to_insert
-            to_insert = [prioritize(idx, dist)]
-        else:
-            to_insert = nsmallest(m, (prioritize(idx, -mdist)
-                                      for mdist, idx in to_insert))
-
-        assert len(to_insert) > 0
-        assert not any(idx in d for _, _, idx in to_insert)
-
-        unchecked = m - len(d)
-        assert 0 <= unchecked <= m
-        to_insert, checked_ins = to_insert[:unchecked], to_insert[unchecked:]
-        to_check = len(checked_ins)
-        if to_check > 0:
-            checked_del = nlargest(to_check, (prioritize(idx, dist)
-                                              for idx, dist in d.items()))
+    if kwargs.get('Codewords') is None:
+        vectors = lambda x: x.astype(np.float32)
+    else:
+        # PQ codes are partitioned by their reconstructions
+        template = HNSW(**kwargs)
+        codewords = template.reshaped_C
+        books = np.arange(codewords.shape[1])
+        vectors = lambda codes: codewords[codes, books].reshape(len(codes), -1)
+    ctx = multiprocessing.get_context('fork')
+    try:
+        t1 = time.time()
+        part_ids, near = _partition(data, num_parts, relink, vectors)
+        # the PQ tables are computed once, before the workers are forked
+        tables = (None, None)
+        if kwargs.get('Codewords') is not None:
+            template._symmetric_table()
+            tables = (template._sym_table, template._sym_slot)
+        t2 = time.time()
+        _BUILD_STATE.update(data=data, part_ids=part_ids, kwargs=kwargs, balanced=balanced, ef=ef, near=near, tables=tables)
+        with ctx.Pool(min(workers, len(part_ids))) as pool:
+            parts = pool.map(_build_partition, range(len(part_ids)))
+        for part, ids in zip(parts, part_ids):
+            # the tables and external vectors are not sent back by the workers
+            _share_tables(part, tables)
+            if kwargs.get('storage') == 'external':
+                part.attach(FeatureSubset(data, ids))
+        t3 = time.time()
+        merged = _merge_partitions(parts, part_ids, kwargs)
+        _share_tables(merged, tables)
+        t4 = time.time()
+        _BUILD_STATE.update(merged=merged, parts=parts)
+        tasks = []
+        for level in range(len(merged._neighbors)):
+            ids = np.arange(num) if level == 0 else np.fromiter(merged._slots[level], dtype=np.int64)
+            tasks.extend((level, chunk.tolist()) for chunk in np.array_split(ids, max(1, len(ids) // 1000)))
+        # the re-linked rows are written after all searches, which only use the partition graphs
+        with ctx.Pool(workers) as pool:
+            results = pool.map(_relink, tasks)
+        _write_rows(merged, results)
+        t5 = time.time()
+        # global refinement: every element searches the re-linked graph and picks its neighbours
+        # like an insertion, the edges found by the other elements are candidates too
+        for _ in range(refine):
+            _BUILD_STATE.update(incoming=[_incoming_edges(merged, level) for level in range(len(merged._neighbors))])
+            with ctx.Pool(workers) as pool:
+                results = pool.map(_refine, tasks)
+            _write_rows(merged, results)
+        t6 = time.time()
+    finally:
+        _BUILD_STATE.clear()
+    timing = {'partitioning': t2 - t1, 'partitions': t3 - t2, 'merge': t4 - t3, 'relink': t5 - t4, 'refine': t6 - t5}
+    print('>> HNSW build with {} partitions: partitioning {:.1f}s, partitions {:.1f}s, merge {:.1f}s, re-link {:.1f}s, '
+          'refinement {:.1f}s'.format(len(part_ids), timing['partitioning'], timing['partitions'], timing['merge'],
+                                      timing['relink'], timing['refine']))
+    return merged, timing
+
+
+def latency_percentiles(latency, percentiles=(50, 90, 99)):
+    # {'p50': ms, ...} of per-query latencies given in seconds
+    stats = {'p{}'.format(p): float(v) * 1000 for p, v in zip(percentiles, np.percentile(latency, percentiles))}
+    stats['max'] = float(np.max(latency)) * 1000
+    return stats
+
+
+def print_latency(latency):
+    print('>> Latency per query: ' + ', '.join('{} {:.2f}ms'.format(name, value)
+                                                for name, value in latency_percentiles(latency).items()))
+
+
+def hnsw_arrays(hnsw, compress=False):
+    '''
+        Flat-array form of an HNSW graph
+        Inputs:
+            compress: store the neighbour lists with pack_adjacency and no edge distances (always
+                      the case for graphs loaded from a compressed index)
+        Outputs:
+            meta: parameters, entry point, number of levels and next original id (JSON)
+            arrays: {name: array}
+                hnsw_vectors: N x D vectors (or N x N_books PQ codes, none with external storage), hnsw_sqnorms: N
+                hnsw_levels: N uint8, number of levels of every element
+                hnsw_neighbors_<l>, hnsw_ndists_<l>, hnsw_counts_<l>: rows of level l, the rows of
+                upper levels are the elements with hnsw_levels > l in increasing id order
+                hnsw_offsets_<l>, hnsw_adjacency_<l>: instead of the three above if compressed
+                hnsw_codewords, hnsw_deleted: if the graph has codewords / deleted elements
+                hnsw_ids: original id of every element, if the graph was reordered or compacted
+    '''
+    count = len(hnsw)
+    meta = {'distance_type': hnsw.distance_type, 'm': hnsw._m, 'm0': hnsw._m0, 'ef': hnsw._ef,
+            'heuristic': hnsw._heuristic, 'N_books': None, 'storage': hnsw._storage, 'count': count,
+            'enter_point': hnsw._enter_point, 'num_levels': len(hnsw._neighbors)}
+    levels = np.zeros(count, dtype=np.uint8)
+    arrays = {'hnsw_sqnorms': np.zeros(0, dtype=np.float32) if hnsw._sqnorms is None else hnsw._sqnorms[:count]}
+    if hnsw._storage != 'external':
+        arrays['hnsw_vectors'] = hnsw.data
+    packed = any(isinstance(neighbors, PackedAdjacency) for neighbors in hnsw._neighbors)
+    meta['compressed'] = bool(compress or packed)
+    for level in range(len(hnsw._neighbors)):
+        ids = hnsw._row_ids(level)
+        levels[ids] = level + 1
+        if packed:
+            # loaded from a compressed index, the rows are in id order
+            offsets, data = hnsw._neighbors[level].offsets, hnsw._neighbors[level].data
         else:
-            checked_del = []
-        for _, dist, idx in to_insert:
-            d[idx] = dist
-        zipped = zip(checked_ins, checked_del)
-        for (p_new, d_new, idx_new), (p_old, d_old, idx_old) in zipped:
-            if (p_old, d_old) <= (p_new, d_new):
-                break
-            del d[idx_old]
-            d[idx_new] = d_new
-            assert len(d) == m
-
-    def __getitem__(self, idx):
-
-        for g in self._graphs:
-            try:
-                yield from g[idx].items()
-            except KeyError:
-                return
+            rows = np.argsort(ids, kind='stable')
+            if compress:
+                offsets, data = pack_adjacency(hnsw._neighbors[level][rows], hnsw._counts[level][rows], ids[rows])
+        if meta['compressed']:
+            arrays['hnsw_offsets_{}'.format(level)] = offsets
+            arrays['hnsw_adjacency_{}'.format(level)] = data
+            continue
+        arrays['hnsw_neighbors_{}'.format(level)] = hnsw._neighbors[level][rows]
+        arrays['hnsw_ndists_{}'.format(level)] = hnsw._ndists[level][rows]
+        arrays['hnsw_counts_{}'.format(level)] = hnsw._counts[level][rows]
+    arrays['hnsw_levels'] = levels
+    if hnsw.Codewords is not None:
+        meta['N_books'] = len(hnsw._books)
+        arrays['hnsw_codewords'] = hnsw.Codewords
+    if hnsw._num_deleted:
+        arrays['hnsw_deleted'] = hnsw._deleted[:count]
+    if hnsw._ids is not None:
+        arrays['hnsw_ids'] = hnsw._ids[:count]
+        meta['next_id'] = int(hnsw._next_id)
+    return meta, arrays
+
+
+def save_hnsw(writer, hnsw, compress=False):
+    # write hnsw as flat arrays into an IndexWriter, the parameters go to manifest['hnsw']
+    meta, arrays = hnsw_arrays(hnsw, compress=compress)
+    for name, array in arrays.items():
+        writer.save_array(name, array)
+    writer.manifest['hnsw'] = meta
+
+
+def load_hnsw(index, vectors=None, mmap_mode='c'):
+    '''
+        HNSW graph of an index, its arrays are memory-mapped copy-on-write: processes loading the
+        same index share the pages, and changes (add, delete, ...) stay private to the process
+        Inputs:
+            index: IndexReader
+            vectors: the vectors the graph was built on, attached to graphs with external storage
+    '''
+    meta = index.manifest.get('hnsw')
+    if meta is None:
+        if 'hnsw' not in index.manifest.get('objects', []):
+            raise ValueError('{} contains no HNSW graph'.format(index.directory))
+        print('>> {} holds a pickled HNSW graph, convert it for fast loading with: '
+              'python3 -m src.utils.nnsearch --convert {}'.format(index.directory, index.directory))
+        hnsw = load_pickled_hnsw(index.path('hnsw.pkl'))
+    else:
+        storage = meta.get('storage', 'float32')
+        hnsw = HNSW(meta['distance_type'], m=meta['m'], ef=meta['ef'], m0=meta['m0'], heuristic=meta['heuristic'],
+                    Codewords=index.array('hnsw_codewords') if meta['N_books'] else None, N_books=meta['N_books'],
+                    storage=storage, vectors=vectors)
+        hnsw._count = meta['count']
+        hnsw._enter_point = meta['enter_point']
+        if 'hnsw_ids' in index.manifest['arrays']:
+            hnsw._ids = index.array('hnsw_ids')
+            hnsw._next_id = meta.get('next_id', int(hnsw._ids.max(initial=-1)) + 1)
+        if storage != 'external':
+            hnsw._data = index.array('hnsw_vectors', mmap_mode=mmap_mode)
+        elif len(hnsw._data) < (hnsw._count if hnsw._ids is None else int(hnsw._ids.max(initial=-1)) + 1):
+            raise ValueError('{} has {} elements but only {} vectors were given'.format(index.directory, hnsw._count, len(hnsw._data)))
+        elif hnsw._ids is not None:
+            # element i is row _ids[i] of the vectors
+            hnsw.attach(vectors)
+        hnsw._sqnorms = index.array('hnsw_sqnorms', mmap_mode=mmap_mode)
+        levels = index.array('hnsw_levels')
+        for level in range(meta['num_levels']):
+            if meta.get('compressed'):
+                hnsw._neighbors.append(PackedAdjacency(index.array('hnsw_offsets_{}'.format(level), mmap_mode=mmap_mode),
+                                                       index.array('hnsw_adjacency_{}'.format(level), mmap_mode=mmap_mode)))
+                hnsw._ndists.append(None)
+                hnsw._counts.append(None)
+            else:
+                hnsw._neighbors.append(index.array('hnsw_neighbors_{}'.format(level), mmap_mode=mmap_mode))
+                hnsw._ndists.append(index.array('hnsw_ndists_{}'.format(level), mmap_mode=mmap_mode))
+                hnsw._counts.append(index.array('hnsw_counts_{}'.format(level), mmap_mode=mmap_mode))
+            if level > 0:
+                ids = np.flatnonzero(levels > level)
+                hnsw._slots.append(dict(zip(ids.tolist(), range(len(ids)))))
+        if 'hnsw_deleted' in index.manifest['arrays']:
+            hnsw._deleted = index.array('hnsw_deleted', mmap_mode=mmap_mode)
+            hnsw._num_deleted = int(np.count_nonzero(hnsw._deleted))
+    if hnsw._num_deleted:
+        print_hnsw_stats(hnsw)
+    return hnsw
+
+
+class _PickledLegacyHNSW(object):
+    # stands in for the former dict-based HNSW class while its pickles are read, the bound
+    # methods it pickled (distance function, neighbour selection) are read as their names
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return name
+
+
+class _HNSWUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == 'HNSW' and module.split('.')[-1] == 'nnsearch':
+            return _PickledLegacyHNSW
+        return super().find_class(module, name)
+
+
+def load_pickled_hnsw(path):
+    '''
+        HNSW graph pickled by older versions: hnsw.pkl of an index, or the HNSW.pkl files of the
+        former dict-based class (neighbours in per-level {id: {neighbour: distance}} dicts)
+    '''
+    with open(path, 'rb') as f:
+        state = _HNSWUnpickler(f).load().__dict__
+    if '_neighbors' in state:
+        hnsw = HNSW.__new__(HNSW)
+        hnsw.__setstate__(state)
+        return hnsw
+    codewords = state.get('Codewords')
+    if codewords is None or np.ndim(codewords) == 0:
+        codewords, N_books = None, None
+        distance_type = 'cosine' if state['distance_func'] == 'cosine_distance' else 'l2'
+    else:
+        N_books, distance_type = state['reshaped_C'].shape[1], 'l2'
+    hnsw = HNSW(distance_type, m=state['_m'], ef=state['_ef'], m0=state['_m0'], Codewords=codewords, N_books=N_books,
+                heuristic=state['_select'] == '_select_heuristic')
+    for elem in state['data']:
+        hnsw._append(elem)
+    for level, graph in enumerate(state['_graphs']):
+        hnsw._add_level()
+        for idx, neighbors in graph.items():
+            if distance_type == 'cosine':
+                # the former class stored cosine similarities as distances
+                neighbors = {j: 1 - sim for j, sim in neighbors.items()}
+            nearest = sorted((dist, j) for j, dist in neighbors.items())[:hnsw._level_m(level)]
+            hnsw._write_row(level, hnsw._new_row(level, idx), [j for _, j in nearest], [dist for dist, _ in nearest])
+    hnsw._enter_point = state['_enter_point']
+    return hnsw
+
+
+def convert_hnsw_index(directory):
+    # replace the pickled graph of an index directory by its flat arrays
+    index = IndexReader(directory)
+    if 'hnsw' not in index.manifest.get('objects', []):
+        raise ValueError('{} contains no pickled HNSW graph'.format(directory))
+    meta, arrays = hnsw_arrays(load_pickled_hnsw(index.path('hnsw.pkl')))
+    for name, array in arrays.items():
+        np.save(index.path(name + '.npy'), np.ascontiguousarray(array))
+    index.update_manifest(hnsw=meta, arrays=index.manifest['arrays'] + list(arrays),
+                          objects=[name for name in index.manifest['objects'] if name != 'hnsw'])
+    os.remove(index.path('hnsw.pkl'))
+
+
+def convert_hnsw_pickle(path, features, dataset, m, ef):
+    # write a graph pickled outside the index store (outputs/<dataset>/HNSW.pkl) as the HNSW index of dataset
+    hnsw = load_pickled_hnsw(path)
+    if len(hnsw) != len(features):
+        raise ValueError('{} has {} elements but there are {} features'.format(path, len(hnsw), len(features)))
+    writer = IndexWriter(dataset, 'HNSW', {'m': m, 'ef': ef}, features)
+    save_hnsw(writer, hnsw)
+    return writer.commit()
+
+
+def _rewrite_hnsw_index(index, hnsw, compress):
+    # replace the graph arrays of an index directory by those of hnsw
+    meta, arrays = hnsw_arrays(hnsw, compress=compress)
+    arrays.pop('hnsw_codewords', None)    # unchanged (and memory-mapped)
+    for name, array in arrays.items():
+        np.save(index.path(name + '.npy'), np.ascontiguousarray(array))
+    stale = [name for name in index.manifest['arrays']
+             if name.startswith('hnsw_') and name != 'hnsw_codewords' and name not in arrays]
+    for name in stale:
+        os.remove(index.path(name + '.npy'))
+    index.update_manifest(hnsw=meta, arrays=[name for name in index.manifest['arrays'] if name not in stale] +
+                                           [name for name in arrays if name not in index.manifest['arrays']])
+
+
+def _read_hnsw_index(directory):
+    index = IndexReader(directory)
+    meta = index.manifest.get('hnsw')
+    if meta is None:
+        raise ValueError('{} contains no HNSW graph in flat arrays, convert it first'.format(directory))
+    if meta.get('storage') == 'external':
+        raise ValueError('{} references the feature stores, rebuild it instead'.format(directory))
+    # read into memory, the files are overwritten
+    return index, load_hnsw(index, mmap_mode=None)
+
+
+def reorder_hnsw_index(directory):
+    # renumber the graph of an index directory in place for locality, see HNSW.reorder
+    index, hnsw = _read_hnsw_index(directory)
+    compress = index.manifest['hnsw'].get('compressed', False)
+    hnsw.reorder()
+    _rewrite_hnsw_index(index, hnsw, compress)
+
+
+def compress_hnsw_index(directory):
+    # pack the neighbour lists of the graph of an index directory in place, see pack_adjacency
+    index, hnsw = _read_hnsw_index(directory)
+    _rewrite_hnsw_index(index, hnsw, True)
+
+
+def print_hnsw_stats(hnsw):
+    stats = hnsw.stats()
+    print('>> HNSW: {} elements, {} deleted ({:.1f}%), {} edges to deleted elements'.format(
+        stats['elements'], stats['deleted'], 100 * stats['tombstone_ratio'], stats['dangling_edges']))
+
+
+def tune_ef(hnsw, K, target_recall=0.95, queries=None, num_queries=200, max_ef=None):
+    '''
+        Smallest search ef of hnsw whose recall@K reaches target_recall
+        Inputs:
+            K: number of nearest neighbours
+            target_recall: recall@K to reach (against search_exact)
+            queries: held-out query vectors. By default num_queries elements of the graph are
+                     used, every one left out of its own results and ground truth
+            max_ef: largest ef tried (default: the number of elements)
+        Outputs:
+            {'ef', 'recall', 'target_recall', 'num_queries', 'latency_ms'} (median latency)
+    '''
+    live = np.arange(len(hnsw))
+    if hnsw._num_deleted:
+        live = live[~hnsw._deleted[:len(hnsw)]]
+    left_out = None
+    if queries is None:
+        rng = np.random.default_rng(0)
+        left_out = np.sort(rng.choice(live, size=min(num_queries, len(live)), replace=False))
+        queries = hnsw._decoded(left_out)
+    queries = as_float32(queries)
+    K = min(K, len(live) - (left_out is not None))
+    k = K + (left_out is not None)
+    if max_ef is None:
+        max_ef = len(live)
+
+    def results(ids, row):
+        ids = [i for i in ids if i >= 0 and (left_out is None or i != left_out[row])]
+        return set(ids[:K])
+
+    truth = [results([i for i, _ in hnsw.search_exact(q, k)], row) for row, q in enumerate(queries)]
+    evaluated = {}
+
+    def evaluate(ef):
+        if ef not in evaluated:
+            ids, _, latency = hnsw.search_batch(queries, k, ef=ef, return_latency=True)
+            recall = np.mean([len(results(ids[row], row) & truth[row]) / max(K, 1) for row in range(len(queries))])
+            evaluated[ef] = (float(recall), float(np.median(latency)) * 1000)
+        return evaluated[ef][0]
+
+    # double ef (starting at k, the search returns at most ef results) until the target is reached,
+    # then bisect between the last two
+    low, high = None, k
+    while evaluate(high) < target_recall and high < max_ef:
+        low, high = high, min(2 * high, max_ef)
+    if low is not None and evaluate(high) >= target_recall:
+        while high - low > 1:
+            mid = (low + high) // 2
+            if evaluate(mid) >= target_recall:
+                high = mid
+            else:
+                low = mid
+    recall, latency = evaluated[high]
+    print('>> HNSW ef for recall@{} >= {}: ef {} (recall {:.3f}, {:.2f}ms per query)'.format(
+        K, target_recall, high, recall, latency))
+    return {'ef': int(high), 'recall': recall, 'target_recall': target_recall,
+            'num_queries': len(queries), 'latency_ms': latency}
 
 
-def matching_HNSW(K, embedded_features_train, embedded_features_test, dataset, m=4, ef=8, ifgenerate=True):
+def search_ef(hnsw, K, manifest, ef_search=None, target_recall=None, store=None):
+    '''
+        ef used to search an HNSW index for K neighbours
+        Inputs:
+            manifest: manifest of the index, manifest['ef_search'][str(K)] is the ef tuned for K
+            ef_search: explicit ef, overrides the tuned one
+            target_recall: tune ef with tune_ef if no ef was tuned for this K and target
+            store: function storing a newly tuned entry, called as store(ef_search={...})
+        Outputs:
+            ef (at least K)
+    '''
+    tuned = manifest.get('ef_search', {})
+    entry = tuned.get(str(K))
+    if ef_search is None and target_recall is not None and (entry is None or entry['target_recall'] != target_recall):
+        entry = tune_ef(hnsw, K, target_recall)
+        store(ef_search=dict(tuned, **{str(K): entry}))
+    if ef_search is None:
+        ef_search = entry['ef'] if entry is not None else K
+    return max(int(ef_search), K)
+
+
+def matching_HNSW(K, embedded_features_train, embedded_features_test, dataset, m=4, ef=8, ifgenerate=True, workers=None,
+                  ef_search=None, target_recall=None, metric='l2', storage='float32', allowed=None, reorder=False,
+                  compress=False):
     '''
         Inputs: 
             K: number of nearest neighbours
@@ -494,46 +1837,65 @@ def matching_HNSW(K, embedded_features_train, embedded_features_test, dataset, m
             m: number of established connections
             ef: size of the dynamic candidate list efConstruction
             ifgenerate: if the codewords have been generated
+            workers: number of processes building the graph (None: all cores)
+            ef_search: size of the dynamic candidate list of the search (None: the ef tuned for K, or K)
+            target_recall: tune ef_search for this recall@K if it was not tuned yet (stored in the index)
+            metric: 'l2' or 'ip' (inner product, the database vectors must be L2-normalized, which
+                    the descriptors of ImageRetrievalNet are; same ranking as 'l2', less work per edge)
+            storage: vectors of the graph, 'float32', 'float16' or 'external' (the graph references
+                     embedded_features_train instead of holding a copy)
+            allowed: optional bool mask over embedded_features_train, only these rows are returned
+                     (e.g. collection_mask of the catalog); -1 pads the rows if fewer than K are allowed
+            reorder: renumber the graph for memory locality after building it (see HNSW.reorder)
+            compress: save the neighbour lists packed, without edge distances (see pack_adjacency)
         Outputs: 
             idx: the indices of the top-K nearest neighbours
             time_per_query: average mathching time per query
     '''
+    embedded_features_train = check_features(embedded_features_train)
+    embedded_features_test = as_float32(embedded_features_test)
+    if metric == 'ip':
+        embedded_features_test = l2_normalize(embedded_features_test)
     num_train, feature_len = embedded_features_train.shape
     num_test, _ = embedded_features_test.shape
-    if not os.path.exists('outputs/' + dataset):
-            os.makedirs('outputs/' + dataset)
-
-    file_path = 'outputs/' + dataset + '/' + 'HNSW.pkl'
+    params = {'m': m, 'ef': ef}
+    # indexes built before metric and storage were parameters are 'l2' and 'float32' indexes
+    if metric != 'l2':
+        params['metric'] = metric
+    if storage != 'float32':
+        params['storage'] = storage
 
     if ifgenerate:
-        hnsw = HNSW('l2', m=m, ef=ef)
-        widgets = ['Progress: ', Percentage(), ' ', Bar('#'), ' ', Timer(), ' ', ETA()]
-        pbar = ProgressBar(widgets=widgets, maxval=num_train).start()
         # Building HNSW graph
         print("==> Building HNSW graph ...")
-        for i in range(len(embedded_features_train)):
-            hnsw.add(embedded_features_train[i])
-            pbar.update(i + 1)
-        pbar.finish()
+        hnsw, timing = build_hnsw(embedded_features_train, m, ef, workers=workers, distance_type=metric, storage=storage)
+        if reorder:
+            hnsw.reorder()
         # Save HNSW object
-        afile = open(file_path, "wb")
-        with open(file_path, 'wb') as afile:
-            pickle.dump(hnsw, afile)   
+        writer = IndexWriter(dataset, 'HNSW', params, embedded_features_train)
+        save_hnsw(writer, hnsw, compress=compress)
+        ef_search = search_ef(hnsw, K, writer.manifest, ef_search, target_recall, store=writer.manifest.update)
+        writer.commit(build_time=timing)
     else:
         # Load HNSW object
-        with open(file_path, 'rb') as pickle_file:
-            hnsw = pickle.load(pickle_file)
+        index = load_index(dataset, 'HNSW', params, embedded_features_train)
+        hnsw = load_hnsw(index, vectors=embedded_features_train)
+        ef_search = search_ef(hnsw, K, index.manifest, ef_search, target_recall, store=index.update_manifest)
+
+    if allowed is not None and hnsw._ids is not None:
+        # the mask is over the rows of embedded_features_train, the graph may be renumbered
+        allowed = np.asarray(allowed, dtype=bool)[hnsw._ids]
 
-    idx = np.zeros((num_test, K), dtype=np.int64)
     t1 = time.time()
-    for row in range(num_test):
-        query = embedded_features_test[row, :]
-        idx_res = np.array(hnsw.search(query, K, ef=K))[:, 0].astype('int')
-        if len(idx_res) < K:
-            idx_miss = np.where(np.in1d(range(num_train), idx_res) == False)[0]
-            idx_res = np.concatenate((idx_res, idx_miss))
-        idx[row, :] = idx_res
+    idx, _, latency = hnsw.search_batch(embedded_features_test, K, ef=ef_search, return_latency=True, allowed=allowed)
+    # the graph search can miss elements of badly connected regions, fall back to brute force
+    expected = min(K, hnsw._count - hnsw._num_deleted if allowed is None else int(np.count_nonzero(allowed)))
+    for row in np.flatnonzero(np.count_nonzero(idx >= 0, axis=1) < expected):
+        exact = [i for i, _ in hnsw.search_exact(embedded_features_test[row], K, allowed=allowed)]
+        idx[row, :len(exact)] = exact
+    idx = hnsw.original_ids(idx)
     t2 = time.time()
+    print_latency(latency)
     time_per_query = (t2 - t1) / num_test
     return idx, time_per_query
 
@@ -582,7 +1944,8 @@ def matching_HNSW_PQ(K, Codewords, embedded_features_test, CW_idx):
     return idx, time_per_query
 
 
-def matching_HNSW_NanoPQ(K, embedded_features, embedded_features_test, dataset, N_books=16, N_words=256, m=4, ef=8, ifgenerate=True):
+def matching_HNSW_NanoPQ(K, embedded_features, embedded_features_test, dataset, N_books=16, N_words=256, m=4, ef=8, ifgenerate=True,
+                         workers=None, ef_search=None, target_recall=None, reorder=False, compress=False, table_bytes=2**23):
     '''
         Inputs: 
             K: number of nearest neighbours
@@ -594,118 +1957,154 @@ def matching_HNSW_NanoPQ(K, embedded_features, embedded_features_test, dataset,
             m: number of established connections
             ef: size of the dynamic candidate list efConstruction
             ifgenerate: if the codewords have been generated
+            workers: number of processes building the graph (None: all cores)
+            ef_search: size of the dynamic candidate list of the search (None: the ef tuned for K, or K)
+            target_recall: tune ef_search for this recall@K if it was not tuned yet (stored in the index)
+            reorder: renumber the graph for memory locality after building it (see HNSW.reorder)
+            compress: save the neighbour lists packed, without edge distances (see pack_adjacency)
+            table_bytes: memory of the codeword distance tables used while building the graph, larger
+                         codebooks only keep the rows of their most frequent codewords (see HNSW._symmetric_table)
         Outputs: 
             idx: the indices of the top-K nearest neighbours
             time_per_query: average mathching time per query
     '''
+    embedded_features = check_features(embedded_features)
     # normalization
-    eftrain_norm = np.linalg.norm(embedded_features, axis=1)
-    eftrain_norm = np.expand_dims(eftrain_norm, axis=1)
-    eftest_norm = np.linalg.norm(embedded_features_test, axis=1)
-    eftest_norm = np.expand_dims(eftest_norm, axis=1)
-    embedded_features = embedded_features / eftrain_norm
-    embedded_features_test = embedded_features_test / eftest_norm
-    embedded_features = embedded_features.astype(np.float32)
-
-    if not os.path.exists('outputs/' + dataset):
-            os.makedirs('outputs/' + dataset)
-
-    PQfile_path = 'outputs/' + dataset + '/' + 'NanoPQ.pkl'
-    if ifgenerate:
-        pq = nanopq.PQ(M=N_books, Ks=N_words, verbose=True)
-        pq.fit(vecs=embedded_features, iter=20, seed=42)
-        # Save PQ object
-        # aPQfile = open(PQfile_path, "wb")
-        with open(PQfile_path, 'wb') as aPQfile:
-            pickle.dump(pq, aPQfile)
-    else:
-        # Load PQ object
-        with open(PQfile_path, 'rb') as pickle_file:
-            pq = pickle.load(pickle_file)
-    
-    CW_idx = pq.encode(vecs=embedded_features)
-    # embedded_recon = pq.decode(codes=CW_idx)
-    Codewords = pq.codewords
-    Codewords = np.transpose(Codewords, (1, 0, 2))
-    Codewords = np.reshape(Codewords, (N_words, -1))
-    
+    embedded_features_test = l2_normalize(as_float32(embedded_features_test))
     num_test, _ = embedded_features_test.shape
-    CW_idx_unique, reverse_idx = np.unique(CW_idx, return_inverse=True, axis=0)
-    num_train, _ = CW_idx_unique.shape
-
-    dicfile_path = 'outputs/' + dataset + '/' + 'dict_recover.pkl'
+    params = {'N_books': N_books, 'N_words': N_words, 'm': m, 'ef': ef}
 
     if ifgenerate:
-        key_list = range(num_train)
-        value_list = [np.where(reverse_idx == t)[0] for t in key_list]
-        dict_recover = dict(zip(key_list, value_list))
-        with open(dicfile_path, 'wb') as adicfile:
-            pickle.dump(dict_recover, adicfile)  
-    else: 
-        with open(dicfile_path, 'rb') as pickle_file:
-            dict_recover = pickle.load(pickle_file)
-
-    file_path = 'outputs/' + dataset + '/' + 'HNSW_NanoPQ.pkl'
+        pq = nanopq.PQ(M=N_books, Ks=N_words, verbose=True)
+        # training needs all vectors at once
+        pq.fit(vecs=l2_normalize(np.asarray(embedded_features)), iter=20, seed=42)
+        CW_idx = pq_encode_chunked(pq, embedded_features)
+        # embedded_recon = pq.decode(codes=CW_idx)
+        Codewords = pq.codewords
+        Codewords = np.transpose(Codewords, (1, 0, 2))
+        Codewords = np.reshape(Codewords, (N_words, -1))
+
+        CW_idx_unique, reverse_idx = np.unique(CW_idx, return_inverse=True, axis=0)
+        reverse_idx = reverse_idx.reshape(-1)
+        num_train, _ = CW_idx_unique.shape
+        # images sharing the code t: group_members[group_offsets[t]:group_offsets[t+1]]
+        group_members = np.argsort(reverse_idx, kind='stable')
+        group_offsets = np.concatenate([[0], np.cumsum(np.bincount(reverse_idx, minlength=num_train))])
 
-    if ifgenerate:
-        hnsw = HNSW('l2', m=m, ef=ef, Codewords=Codewords, N_books=N_books)
-        widgets = ['Progress: ', Percentage(), ' ', Bar('#'), ' ', Timer(), ' ', ETA()]
-        pbar = ProgressBar(widgets=widgets, maxval=num_train).start()
         # Building HNSW graph
         print("==> Building HNSW graph ...")
-        for i in range(num_train):
-            hnsw.add(CW_idx_unique[i])
-            pbar.update(i + 1)
-        pbar.finish()
-        # Save HNSW object
-        # afile = open(file_path, "wb")
-        with open(file_path, 'wb') as afile:
-            pickle.dump(hnsw, afile)   
+        hnsw, timing = build_hnsw(CW_idx_unique, m, ef, workers=workers, distance_type='l2',
+                                  Codewords=Codewords, N_books=N_books, table_bytes=table_bytes)
+        if reorder:
+            hnsw.reorder()
+        # Save the codebooks, the code groups and the HNSW object
+        writer = IndexWriter(dataset, 'HNSW_NanoPQ', params, embedded_features)
+        writer.save_array('codewords', pq.codewords)
+        writer.save_array('group_members', group_members)
+        writer.save_array('group_offsets', group_offsets)
+        save_hnsw(writer, hnsw, compress=compress)
+        ef_search = search_ef(hnsw, min(K, num_train), writer.manifest, ef_search, target_recall, store=writer.manifest.update)
+        writer.commit(build_time=timing)
     else:
-        # Load HNSW object
-        with open(file_path, 'rb') as pickle_file:
-            hnsw = pickle.load(pickle_file)
+        # Load the code groups and the HNSW object, the database does not have to be encoded again
+        index = load_index(dataset, 'HNSW_NanoPQ', params, embedded_features)
+        group_members = index.array('group_members')
+        group_offsets = index.array('group_offsets')
+        hnsw = load_hnsw(index)
+        num_train = len(group_offsets) - 1
+        ef_search = search_ef(hnsw, min(K, num_train), index.manifest, ef_search, target_recall, store=index.update_manifest)
     
     idx = np.zeros((num_test, K), dtype=np.int64)
     t1 = time.time()
+    # K_unique = num_train
+    K_unique = min(K, num_train)
+    ids_unique, _, latency = hnsw.search_batch(embedded_features_test, K_unique, ef=ef_search, return_latency=True)
     for row in range(num_test):
-        query = embedded_features_test[row, :]
-        # K_unique = num_train
-        K_unique = min(K, num_train)
-        idx_unique = np.array(hnsw.search(query, K_unique, ef=K_unique))[:, 0].astype('int')
+        idx_unique = ids_unique[row][ids_unique[row] >= 0]
         if len(idx_unique) < K_unique:
-            idx_miss = np.where(np.in1d(range(K_unique), idx_unique) == False)[0]
-            idx_unique = np.concatenate((idx_unique, idx_miss))
-        idx_recover = np.concatenate([dict_recover[i] for i in idx_unique])
+            # the graph search missed codes, fall back to brute force over the codes
+            idx_unique = [i for i, _ in hnsw.search_exact(embedded_features_test[row], K_unique)]
+        # code ids of the groups
+        idx_unique = hnsw.original_ids(idx_unique)
+        idx_recover = np.concatenate([group_members[group_offsets[i]:group_offsets[i+1]] for i in idx_unique])
         idx[row, :] = idx_recover[:K]
     t2 = time.time()
+    print_latency(latency)
     time_per_query = (t2 - t1) / num_test
     return idx, time_per_query
 
 
 # @jit(nopython=True, parallel=True)
-def matching_L2(K, embedded_features_train, embedded_features_test):
+def matching_L2(K, embedded_features_train, embedded_features_test, chunk_size=65536):
+    '''
+        Inputs:
+            K: number of nearest neighbours
+            embedded_features_train: N x D feature vectors of the dataset images (array or FeatureCatalog)
+            embedded_features_test: feature vectors of the query images
+            chunk_size: number of database rows scored at a time
+        Outputs:
+            idx: the indices of the top-K nearest neighbours
+            time_per_query: average mathching time per query
+    '''
     t1 = time.time()
+    embedded_features_train = check_features(embedded_features_train)
     num_train, feature_len = embedded_features_train.shape
     num_test, _ = embedded_features_test.shape
-    idx = np.zeros((num_test, K), dtype=np.int64)
     # normalization
-    eftrain_norm = np.linalg.norm(embedded_features_train, axis=1)
-    eftrain_norm = np.expand_dims(eftrain_norm, axis=1)
-    eftest_norm = np.linalg.norm(embedded_features_test, axis=1)
-    eftest_norm = np.expand_dims(eftest_norm, axis=1)
-    embedded_features_train = embedded_features_train / eftrain_norm
-    embedded_features_test = embedded_features_test / eftest_norm
-    for row in range(num_test):
-        query = embedded_features_test[row, :]
-        dist = np.linalg.norm(query-embedded_features_train, axis=1)
-        # idx[row, :] = np.argpartition(dist, K-1)[:K]
-        idx[row, :] = np.argsort(dist)[:K]
+    embedded_features_test = l2_normalize(as_float32(embedded_features_test))
+    # scan the database block by block and only keep the K best candidates of every query
+    best_dist = np.empty((num_test, 0), dtype=np.float32)
+    best_idx = np.empty((num_test, 0), dtype=np.int64)
+    for start, block in iter_chunks(embedded_features_train, chunk_size):
+        block = l2_normalize(block)
+        # ||q - x||^2 = 2 - 2 q.x for unit vectors
+        dist = 2 - 2 * (embedded_features_test @ block.T)
+        ids = np.arange(start, start + len(block), dtype=np.int64)
+        best_dist, best_idx = merge_topk(best_dist, best_idx, dist, ids, K)
+    _, idx = sort_topk(best_dist, best_idx)
     t2 = time.time()
     time_per_query = (t2-t1)/num_test
     return idx, time_per_query
 
 
+def matching_quantized(K, embedded_features_train, embedded_features_test, mode='int8', rescore=200, chunk_size=65536):
+    '''
+        Brute-force search on the scalar-quantized copy of the feature stores (see quantize_feature_store)
+        Inputs:
+            K: number of nearest neighbours
+            embedded_features_train: FeatureStore or FeatureCatalog of the dataset images, or a
+                                     FeatureSubset of one (e.g. the representatives of the duplicate groups)
+            embedded_features_test: feature vectors of the query images
+            mode: 'float16' or 'int8'
+            rescore: number of candidates per query re-ranked with the full-precision vectors
+                     read from the feature store (0: rank by the quantized scores only)
+        Outputs:
+            idx: the indices of the top-K nearest neighbours
+            time_per_query: average mathching time per query
+    '''
+    t1 = time.time()
+    num_test, _ = embedded_features_test.shape
+    queries = l2_normalize(as_float32(embedded_features_test))
+    num_cand = max(K, rescore)
+    best_dist = np.empty((num_test, 0), dtype=np.float32)
+    best_idx = np.empty((num_test, 0), dtype=np.int64)
+    for part_ids, qmat in quantized_parts(embedded_features_train, mode):
+        for start, scores in qmat.iter_scores(queries.T, chunk_size):
+            # ||q - x||^2 = 2 - 2 q.x for unit vectors
+            ids = part_ids[start:start + len(scores)]
+            best_dist, best_idx = merge_topk(best_dist, best_idx, 2 - 2 * scores.T, ids, num_cand)
+    if rescore:
+        # exact distances of the candidates, only their rows of features.bin are read
+        database = getattr(embedded_features_train, 'vecs', embedded_features_train)
+        cand = l2_normalize(database[best_idx].reshape(-1, queries.shape[1]))
+        cand = cand.reshape(best_idx.shape + (queries.shape[1],))
+        best_dist = 2 - 2 * np.einsum('qkd,qd->qk', cand, queries)
+    _, idx = sort_topk(best_dist, best_idx)
+    t2 = time.time()
+    time_per_query = (t2 - t1) / num_test
+    return idx[:, :K], time_per_query
+
+
 def matching_fractional_dis(K, embedded_features_train, embedded_features_test):
     t1 = time.time()
     num_train, feature_len = embedded_features_train.shape
@@ -844,7 +2243,79 @@ def Nano_PQ(embedded_features, N_books, N_words):
 
     return embedded_code, Codewords, embedded_recon
 
-def matching_Nano_PQ(K, embedded_features_train, embedded_features_test, dataset, N_books=16, n_bits_perbook=8, ifgenerate=True):
+def pq_from_codewords(codewords):
+    # rebuild a trained nanopq.PQ from its M x Ks x Ds codewords
+    M, Ks, Ds = codewords.shape
+    pq = nanopq.PQ(M=M, Ks=Ks, verbose=False)
+    pq.codewords = np.asarray(codewords, dtype=np.float32)
+    pq.Ds = Ds
+    return pq
+
+def pq_encode_chunked(pq, embedded_features, chunk_size=65536):
+    # encode the normalized database block by block instead of normalizing a full copy
+    codes = [pq.encode(vecs=l2_normalize(block)) for _, block in iter_chunks(embedded_features, chunk_size)]
+    return np.concatenate(codes, axis=0)
+
+def pq_dtables(pq, queries):
+    '''
+        Distance tables of a block of queries in one call, dtables[q] equals pq.dtable(queries[q]).dtable
+        Inputs:
+            pq: trained nanopq.PQ (L2)
+            queries: Q x D float32 queries
+        Outputs:
+            Q x M x Ks float32 squared distances between the sub-vectors of the queries and the codewords
+    '''
+    codewords = pq.codewords
+    sub = queries.reshape(len(queries), pq.M, pq.Ds)
+    # ||q_m - c||^2 = ||q_m||^2 - 2 q_m.c + ||c||^2
+    dtables = -2 * np.einsum('qmd,mkd->qmk', sub, codewords)
+    dtables += np.einsum('mkd,mkd->mk', codewords, codewords)[None]
+    dtables += np.einsum('qmd,qmd->qm', sub, sub)[:, :, None]
+    return np.maximum(dtables, 0, out=dtables)
+
+def _adist_topk(dtables, codes, start, K):
+    # asymmetric distances of a block of queries to a chunk of codes, accumulated code-book by code-book
+    codes = np.asarray(codes)
+    dist = np.take(dtables[:, 0], codes[:, 0], axis=1)
+    for m in range(1, codes.shape[1]):
+        dist += np.take(dtables[:, m], codes[:, m], axis=1)
+    ids = np.arange(start, start + len(codes), dtype=np.int64)
+    return merge_topk(np.empty((len(dist), 0), dtype=np.float32), np.empty((len(dist), 0), dtype=np.int64), dist, ids, K)
+
+def pq_search(pq, codes, queries, K, query_block=64, chunk_size=16384, workers=None):
+    '''
+        Batched asymmetric distance computation (ADC) over PQ codes
+        Inputs:
+            pq: trained nanopq.PQ (L2)
+            codes: N x M PQ codes of the database
+            queries: Q x D float32 queries
+            K: number of nearest neighbours
+            query_block: number of queries whose distance tables are built and scanned together
+            chunk_size: number of codes scored at a time by one thread, query_block x chunk_size
+                        distances should stay in the cache
+            workers: number of threads (None: all cores)
+        Outputs:
+            dist, idx: Q x min(K, N) sorted asymmetric distances and database ids
+    '''
+    num_query = len(queries)
+    num_train = len(codes)
+    best_dist = np.empty((num_query, min(K, num_train)), dtype=np.float32)
+    best_idx = np.empty((num_query, min(K, num_train)), dtype=np.int64)
+    starts = range(0, num_train, chunk_size)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for q0 in range(0, num_query, query_block):
+            dtables = pq_dtables(pq, queries[q0:q0 + query_block])
+            dist = np.empty((len(dtables), 0), dtype=np.float32)
+            idx = np.empty((len(dtables), 0), dtype=np.int64)
+            # the chunks are scored in parallel, the partial top-K are merged in order
+            for chunk_dist, chunk_idx in executor.map(
+                    lambda start: _adist_topk(dtables, codes[start:start + chunk_size], start, K), starts):
+                dist, idx = merge_topk(dist, idx, chunk_dist, chunk_idx, K)
+            best_dist[q0:q0 + query_block], best_idx[q0:q0 + query_block] = sort_topk(dist, idx)
+    return best_dist, best_idx
+
+def matching_Nano_PQ(K, embedded_features_train, embedded_features_test, dataset, N_books=16, n_bits_perbook=8, ifgenerate=True,
+                     workers=None):
     '''
         Inputs: 
             K: number of nearest neighbours
@@ -854,48 +2325,38 @@ def matching_Nano_PQ(K, embedded_features_train, embedded_features_test, dataset
             N_books: number of the sub-vectors/sub-codebooks
             n_bits_perbook: number of bits per sub-codebook
             ifgenerate: if the codewords have been generated
+            workers: number of threads of the search (None: all cores)
         Outputs: 
             idx: the indices of the top-K nearest neighbours
             time_per_query: average mathching time per query
     '''
     # https://nanopq.readthedocs.io/en/latest/source/tutorial.html#basic-of-pq
     N_words = 2**n_bits_perbook
+    embedded_features_train = check_features(embedded_features_train)
     num_train, feature_len = embedded_features_train.shape
     num_test, _ = embedded_features_test.shape
     # normalization
-    eftrain_norm = np.linalg.norm(embedded_features_train, axis=1)
-    eftrain_norm = np.expand_dims(eftrain_norm, axis=1)
-    eftest_norm = np.linalg.norm(embedded_features_test, axis=1)
-    eftest_norm = np.expand_dims(eftest_norm, axis=1)
-    embedded_features_train = embedded_features_train / eftrain_norm
-    embedded_features_test = embedded_features_test / eftest_norm
-    embedded_features_train = embedded_features_train.astype(np.float32)
-    embedded_features_test = embedded_features_test.astype(np.float32)
-
-    if not os.path.exists('outputs/' + dataset):
-        os.makedirs('outputs/' + dataset)
+    embedded_features_test = l2_normalize(as_float32(embedded_features_test))
 
-    PQfile_path = 'outputs/' + dataset + '/' + 'PQ.pkl'
+    params = {'N_books': N_books, 'n_bits_perbook': n_bits_perbook}
     if ifgenerate:
         pq = nanopq.PQ(M=N_books, Ks=N_words, verbose=True)
-        pq.fit(vecs=embedded_features_train, iter=20, seed=42)
-        # Save PQ object
-        aPQfile = open(PQfile_path, "wb")
-        with open(PQfile_path, 'wb') as aPQfile:
-            pickle.dump(pq, aPQfile)
+        # training needs all vectors at once
+        pq.fit(vecs=l2_normalize(np.asarray(embedded_features_train)), iter=20, seed=42)
+        embedded_train_code = pq_encode_chunked(pq, embedded_features_train)
+        # Save the codebooks and the codes
+        writer = IndexWriter(dataset, 'PQ', params, embedded_features_train)
+        writer.save_array('codewords', pq.codewords)
+        writer.save_array('codes', embedded_train_code)
+        writer.commit()
     else:
-        # Load PQ object
-        with open(PQfile_path, 'rb') as pickle_file:
-            pq = pickle.load(pickle_file)
+        # Load the codebooks and the memory-mapped codes
+        index = load_index(dataset, 'PQ', params, embedded_features_train)
+        pq = pq_from_codewords(index.array('codewords', mmap_mode=None))
+        embedded_train_code = index.array('codes')
 
-    embedded_train_code = pq.encode(vecs=embedded_features_train)
     t1 = time.time()
-    idx = np.zeros((num_test, K), dtype=np.int64)
-    for row in range(num_test):
-        query = embedded_features_test[row, :]
-        dist = pq.dtable(query=query).adist(codes=embedded_train_code)
-        # idx[row, :] = np.argpartition(dist, K-1)[:K]
-        idx[row, :] = np.argsort(dist)[:K]
+    _, idx = pq_search(pq, embedded_train_code, embedded_features_test, K, workers=workers)
     t2 = time.time()
     time_per_query = (t2 - t1) / num_test
     return idx, time_per_query
@@ -1027,21 +2488,25 @@ def matching_ANNOY(K, embedded_features_train, embedded_features_test, metric, d
             idx: the indices of the top-K nearest neighbours
             time_per_query: average mathching time per query
     '''
+    embedded_features_train = check_features(embedded_features_train)
+    embedded_features_test = as_float32(embedded_features_test)
     num_train, feature_len = embedded_features_train.shape
     num_test, _ = embedded_features_test.shape
-    
-    if not os.path.exists('outputs/' + dataset):
-            os.makedirs('outputs/' + dataset)
+    params = {'metric': metric, 'n_trees': n_trees}
 
     if ifgenerate:
         t = annoy.AnnoyIndex(feature_len, metric)
-        for n, x in enumerate(embedded_features_train):
-            t.add_item(n, x)
+        for start, block in iter_chunks(embedded_features_train):
+            for n, x in enumerate(block, start):
+                t.add_item(n, x)
         t.build(n_trees)
-        t.save('outputs/' + dataset + '/' + 'test.ann')
+        writer = IndexWriter(dataset, 'ANNOY', params, embedded_features_train)
+        t.save(writer.path('trees.ann'))
+        writer.commit()
     else:
+        # ANNOY memory-maps the trees itself
         t = annoy.AnnoyIndex(feature_len, metric)
-        t.load('outputs/' + dataset + '/' + 'test.ann')
+        t.load(load_index(dataset, 'ANNOY', params, embedded_features_train).path('trees.ann'))
     idx = np.zeros((num_test, K), dtype=np.int64)
     t1 = time.time()
     for i in range(num_test):
@@ -1093,3 +2558,44 @@ def cal_mAP(idx, labels_train, labels_test):
     mAP = AP.mean()
     return mAP
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HNSW index utilities')
+    parser.add_argument('--convert', '-c', metavar='INDEXES', default=None,
+                        help="comma separated index directories (e.g. 'outputs/database/HNSW') whose pickled graph "
+                             "is converted to flat arrays in place")
+    parser.add_argument('--convert-pickle', metavar='PATH', default=None,
+                        help="graph pickled by older versions (e.g. 'outputs/database/HNSW.pkl'), written as the "
+                             "HNSW index of the features of --datasets")
+    parser.add_argument('--reorder', '-r', metavar='INDEXES', default=None,
+                        help="comma separated index directories whose HNSW graph is renumbered in place for "
+                             "memory locality (reverse Cuthill-McKee order of level 0)")
+    parser.add_argument('--compress', metavar='INDEXES', default=None,
+                        help="comma separated index directories whose HNSW neighbour lists are packed in place "
+                             "(delta coded and byte-packed, without edge distances)")
+    parser.add_argument('--datasets', '-d', metavar='DATASETS', default=None,
+                        help="with --convert-pickle: comma separated datasets the graph was built from")
+    parser.add_argument('--network', '-n', metavar='NETWORK', default=None,
+                        help="with --convert-pickle: network the features were extracted with")
+    parser.add_argument('--m', default=16, type=int, help="with --convert-pickle: m the graph was built with (default: 16)")
+    parser.add_argument('--ef', default=100, type=int, help="with --convert-pickle: ef the graph was built with (default: 100)")
+    args = parser.parse_args()
+    if args.convert is not None:
+        for directory in args.convert.split(','):
+            convert_hnsw_index(directory)
+            print('>> {}: converted'.format(directory))
+    if args.reorder is not None:
+        for directory in args.reorder.split(','):
+            reorder_hnsw_index(directory)
+            print('>> {}: reordered'.format(directory))
+    if args.compress is not None:
+        for directory in args.compress.split(','):
+            compress_hnsw_index(directory)
+            print('>> {}: compressed'.format(directory))
+    if args.convert_pickle is not None:
+        from src.utils.featurestore import load_feature_catalog
+        if args.datasets is None:
+            parser.error('--convert-pickle needs --datasets')
+        features = load_feature_catalog(args.datasets.split(','), network=args.network)
+        directory = convert_hnsw_pickle(args.convert_pickle, features, 'database', args.m, args.ef)
+        print('>> {}: converted to {}'.format(args.convert_pickle, directory))
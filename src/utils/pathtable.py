@@ -0,0 +1,134 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the compact table of the image paths of a feature store
+
+The paths are kept as one UTF-8 blob (paths.txt of the feature store, one path per line)
+plus an int64 array of N + 1 offsets into it: path i is blob[offsets[i]:offsets[i+1] - 1]
+(without its newline). Both files are memory-mapped, so a table of millions of paths costs
+no Python objects until a path is looked up, and looking up the K results of a query only
+decodes those K paths. Prefixes such as '/static/' are added where the paths are rendered.
+"""
+
+import os
+import numpy as np
+
+NEWLINE = ord('\n')
+
+
+def _map(path, dtype):
+    # np.memmap can not map an empty file
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def path_offsets(blob, count=None):
+    '''
+        Inputs:
+            blob: uint8 array with newline terminated UTF-8 paths
+            count: number of complete paths to keep (None: all)
+        Outputs:
+            int64 array of count + 1 offsets
+    '''
+    ends = np.flatnonzero(np.asarray(blob) == NEWLINE) + 1
+    if count is not None:
+        assert len(ends) >= count
+        ends = ends[:count]
+    return np.concatenate([[0], ends]).astype(np.int64)
+
+
+class PathTable(object):
+    '''
+        Read-only sequence of paths stored as a UTF-8 blob and an offsets array.
+        table[i] returns a str, table[ids] (slice or array) a list of str.
+    '''
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _decode(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i+1] - 1]).decode('utf-8')
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if key < 0 or key >= len(self):
+                raise IndexError('path id out of range')
+            return self._decode(int(key))
+        if isinstance(key, slice):
+            key = range(*key.indices(len(self)))
+        return [self[int(i)] for i in np.asarray(key).reshape(-1)]
+
+    def __iter__(self):
+        # decode 65536 paths at a time instead of path by path
+        for start in range(0, len(self), 65536):
+            end = min(start + 65536, len(self))
+            text = bytes(self.blob[self.offsets[start]:self.offsets[end]]).decode('utf-8')
+            yield from text.split('\n')[:-1]
+
+    @property
+    def nbytes(self):
+        return self.blob.nbytes + self.offsets.nbytes
+
+
+class ChainedPathTable(object):
+    '''
+        Several path tables presented as one sequence, id i of the first table is followed
+        by the ids of the second one, etc. (the global ids of a FeatureCatalog)
+    '''
+
+    def __init__(self, tables):
+        self.tables = list(tables)
+        self.offsets = np.cumsum([0] + [len(t) for t in self.tables]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if key < 0 or key >= len(self):
+                raise IndexError('path id out of range')
+            t = int(np.searchsorted(self.offsets, key, side='right')) - 1
+            return self.tables[t][int(key - self.offsets[t])]
+        if isinstance(key, slice):
+            key = range(*key.indices(len(self)))
+        return [self[int(i)] for i in np.asarray(key).reshape(-1)]
+
+    def __iter__(self):
+        for t in self.tables:
+            yield from t
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.tables)
+
+
+def load_path_table(blob_path, offsets_path, count):
+    '''
+        Inputs:
+            blob_path: file with the newline terminated paths
+            offsets_path: .npy file with the offsets, computed from the blob if it is missing or short
+            count: number of paths (lines after the first count ones are ignored, None: all lines)
+        Outputs:
+            PathTable
+    '''
+    blob = _map(blob_path, np.uint8)
+    offsets = None
+    if os.path.exists(offsets_path):
+        offsets = np.load(offsets_path, mmap_mode='r')
+        if count is None:
+            # the offsets of all lines end at the end of the blob
+            offsets = offsets if len(offsets) and offsets[-1] == len(blob) else None
+        else:
+            # appending only extends the offsets, so a longer array is valid for the first count paths
+            offsets = offsets[:count + 1] if len(offsets) > count else None
+    if offsets is None:
+        offsets = path_offsets(blob, count)
+    return PathTable(blob, offsets)
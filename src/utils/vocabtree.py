@@ -0,0 +1,301 @@
+"""
+Image Search Engine for Historical Research: A Prototype
+This file contains the hierarchical k-means (vocabulary tree) index
+
+The database is clustered recursively: every node is split into `branching` children by k-means
+on the descriptors of a training sample that fall into it, down to `depth` levels (nodes with too
+few training descriptors stay leaves). The nodes are numbered in depth-first order and the database
+ids are stored grouped by leaf in the same order, so the images below any node are one contiguous
+range of `order`. A query visits the nodes best-bin-first (the closest unvisited node among all
+levels first), gathers the images of the leaves it reaches until it has `candidates` of them and
+rescores these with the exact distances.
+"""
+
+import time
+from heapq import heappop, heappush
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from src.utils.featurestore import iter_chunks
+from src.utils.indexstore import IndexWriter, load_index
+from src.utils.nnsearch import as_float32, check_features, l2_normalize, print_latency
+
+
+def _rows(features, ids):
+    # normalized float32 rows of features
+    return l2_normalize(as_float32(features[np.asarray(ids, dtype=np.int64)]))
+
+
+class VocabularyTree(object):
+    '''
+        Hierarchical k-means tree stored as flat arrays, node 0 is the root
+            child_offsets: (num_nodes + 1) children of node n are children[child_offsets[n]:child_offsets[n+1]]
+            children, centers: child ids and their cluster centers, in the same (CSR) order
+            item_start, item_end: range of order holding the database ids below each node
+            order: database ids grouped by leaf, leaves in depth-first order
+    '''
+
+    def __init__(self, child_offsets, children, centers, item_start, item_end, order, features=None):
+        self.child_offsets = np.asarray(child_offsets, dtype=np.int64)
+        self.children = np.asarray(children, dtype=np.int64)
+        self.centers = np.asarray(centers, dtype=np.float32)
+        self.sqnorms = (self.centers.astype(np.float64) ** 2).sum(axis=1).astype(np.float32)
+        self.item_start = np.asarray(item_start, dtype=np.int64)
+        self.item_end = np.asarray(item_end, dtype=np.int64)
+        self.order = order
+        self.features = features
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def num_nodes(self):
+        return len(self.child_offsets) - 1
+
+    @property
+    def num_leaves(self):
+        return int(np.sum(self.child_offsets[1:] == self.child_offsets[:-1]))
+
+    def _child_distances(self, node, q):
+        # squared L2 distances between the normalized query and the centers of the children of node, up to ||q||^2
+        lo, hi = self.child_offsets[node], self.child_offsets[node + 1]
+        return self.sqnorms[lo:hi] - 2 * (self.centers[lo:hi] @ q), self.children[lo:hi]
+
+    def assign(self, vectors):
+        '''
+            Descend the tree greedily
+            Inputs:
+                vectors: n x D normalized float32 descriptors
+            Outputs:
+                leaf of every descriptor
+        '''
+        nodes = np.zeros(len(vectors), dtype=np.int64)
+        while True:
+            internal = self.child_offsets[nodes + 1] > self.child_offsets[nodes]
+            if not internal.any():
+                return nodes
+            for node in np.unique(nodes[internal]):
+                mask = nodes == node
+                lo, hi = self.child_offsets[node], self.child_offsets[node + 1]
+                dist = self.sqnorms[lo:hi] - 2 * (vectors[mask] @ self.centers[lo:hi].T)
+                nodes[mask] = self.children[lo + np.argmin(dist, axis=1)]
+
+    def candidates(self, q, num_candidates):
+        '''
+            Best-bin-first traversal
+            Inputs:
+                q: normalized float32 query
+                num_candidates: number of database ids to gather, the search stops at the first leaf reaching it
+            Outputs:
+                database ids of the visited leaves
+        '''
+        ranges = []
+        total = 0
+        heap = [(0.0, 0)]
+        while heap and total < num_candidates:
+            _, node = heappop(heap)
+            if self.child_offsets[node + 1] == self.child_offsets[node]:
+                start, end = self.item_start[node], self.item_end[node]
+                if end > start:
+                    ranges.append(self.order[start:end])
+                    total += end - start
+                continue
+            dist, children = self._child_distances(node, q)
+            for d, c in zip(dist.tolist(), children.tolist()):
+                if self.item_end[c] > self.item_start[c]:
+                    heappush(heap, (d, c))
+        if not ranges:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(ranges).astype(np.int64)
+
+    def search(self, q, k, num_candidates):
+        '''
+            Inputs:
+                q: normalized float32 query
+                k: number of results
+                num_candidates: candidate budget, at least k candidates are always gathered
+            Outputs:
+                ids and squared L2 distances of the k nearest gathered candidates (-1/inf padded)
+        '''
+        ids = np.full(k, -1, dtype=np.int64)
+        dists = np.full(k, np.inf, dtype=np.float32)
+        cand = np.sort(self.candidates(q, max(num_candidates, k)))
+        if len(cand) == 0:
+            return ids, dists
+        # exact rescoring, the gathered rows are read in id order
+        d = np.maximum(2 - 2 * (_rows(self.features, cand) @ q), 0)
+        n = min(k, len(cand))
+        top = np.argpartition(d, n - 1)[:n] if n < len(cand) else np.arange(len(cand))
+        top = top[np.argsort(d[top], kind='stable')]
+        ids[:n] = cand[top]
+        dists[:n] = d[top]
+        return ids, dists
+
+    def search_batch(self, queries, k, num_candidates, return_latency=False):
+        queries = l2_normalize(as_float32(queries))
+        num_query = len(queries)
+        ids = np.full((num_query, k), -1, dtype=np.int64)
+        dists = np.full((num_query, k), np.inf, dtype=np.float32)
+        latency = np.zeros(num_query)
+        for row in range(num_query):
+            t1 = time.time()
+            ids[row], dists[row] = self.search(queries[row], k, num_candidates)
+            latency[row] = time.time() - t1
+        if return_latency:
+            return ids, dists, latency
+        return ids, dists
+
+
+def _kmeans(vectors, n_clusters, seed):
+    kmeans = KMeans(n_clusters=n_clusters, n_init=1, max_iter=50, random_state=seed).fit(vectors)
+    return kmeans.cluster_centers_.astype(np.float32), kmeans.labels_
+
+
+def train_vocabulary_tree(sample, branching=16, depth=3, min_train=None, seed=0):
+    '''
+        Inputs:
+            sample: n x D normalized float32 training descriptors
+            branching: number of children of an internal node
+            depth: maximum number of levels below the root
+            min_train: nodes with fewer training descriptors are not split (default: 2 * branching)
+        Outputs:
+            child_offsets, children and centers of the tree (see VocabularyTree), nodes in depth-first order
+    '''
+    if branching < 2 or depth < 1:
+        raise ValueError('A vocabulary tree needs branching >= 2 and depth >= 1, got {} and {}'.format(branching, depth))
+    if min_train is None:
+        min_train = 2 * branching
+    # depth-first construction, children of a node are numbered when the node is expanded
+    child_lists = [[]]
+    node_centers = [np.zeros(sample.shape[1], dtype=np.float32)]
+    stack = [(0, np.arange(len(sample)), 0)]
+    while stack:
+        node, members, level = stack.pop()
+        if level >= depth or len(members) < max(min_train, branching):
+            continue
+        centers, labels = _kmeans(sample[members], branching, seed + node)
+        expanded = []
+        for c in range(branching):
+            child = len(child_lists)
+            child_lists.append([])
+            node_centers.append(centers[c])
+            child_lists[node].append(child)
+            expanded.append((child, members[labels == c], level + 1))
+        stack.extend(reversed(expanded))
+    # renumber the nodes in depth-first order, so that a subtree is a range of node ids
+    num_nodes = len(child_lists)
+    dfs = np.empty(num_nodes, dtype=np.int64)
+    stack = [0]
+    pos = 0
+    while stack:
+        node = stack.pop()
+        dfs[node] = pos
+        pos += 1
+        stack.extend(reversed(child_lists[node]))
+    child_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    for node, kids in enumerate(child_lists):
+        child_offsets[dfs[node] + 1] = len(kids)
+    child_offsets = np.cumsum(child_offsets)
+    children = np.zeros(num_nodes - 1, dtype=np.int64)
+    centers = np.zeros((num_nodes - 1, sample.shape[1]), dtype=np.float32)
+    for node, kids in enumerate(child_lists):
+        if kids:
+            lo = child_offsets[dfs[node]]
+            children[lo:lo + len(kids)] = dfs[kids]
+            centers[lo:lo + len(kids)] = [node_centers[c] for c in kids]
+    return child_offsets, children, centers
+
+
+def subtree_ends(child_offsets, children):
+    # (exclusive) last node id of the subtree of every node, the nodes being in depth-first order
+    num_nodes = len(child_offsets) - 1
+    end = np.arange(1, num_nodes + 1, dtype=np.int64)
+    for node in range(num_nodes - 1, -1, -1):
+        lo, hi = child_offsets[node], child_offsets[node + 1]
+        if hi > lo:
+            end[node] = end[children[hi - 1]]
+    return end
+
+
+def vocabtree_params(branching, depth):
+    return {'branching': branching, 'depth': depth}
+
+
+def build_vocabulary_tree(features, dataset, branching=16, depth=3, n_train=100000, chunk_size=65536):
+    '''
+        Train the tree on a sample of features, assign the database and write the index to
+        outputs/<dataset>/VocabTree
+        Inputs:
+            features: N x D descriptors (array, FeatureStore or FeatureCatalog)
+            branching, depth: shape of the tree, up to branching**depth leaves
+            n_train: number of descriptors the tree is trained on
+        Outputs:
+            directory of the index
+    '''
+    features = check_features(features)
+    num = len(features)
+    t1 = time.time()
+    rng = np.random.default_rng(42)
+    train_ids = np.sort(rng.choice(num, size=min(num, n_train), replace=False))
+    child_offsets, children, centers = train_vocabulary_tree(_rows(features, train_ids), branching=branching, depth=depth)
+    tree = VocabularyTree(child_offsets, children, centers, [], [], None)
+    leaves = np.empty(num, dtype=np.int64)
+    for start, block in iter_chunks(features, chunk_size):
+        leaves[start:start + len(block)] = tree.assign(l2_normalize(as_float32(block)))
+    order = np.argsort(leaves, kind='stable')
+    leaves = leaves[order]
+    # leaves in depth-first order: the database ids below a node are one range of order
+    nodes = np.arange(len(child_offsets) - 1)
+    item_start = np.searchsorted(leaves, nodes, side='left')
+    item_end = np.searchsorted(leaves, subtree_ends(child_offsets, children), side='left')
+
+    writer = IndexWriter(dataset, 'VocabTree', vocabtree_params(branching, depth), features)
+    writer.save_array('child_offsets', child_offsets)
+    writer.save_array('children', children)
+    writer.save_array('centers', centers)
+    writer.save_array('item_start', item_start)
+    writer.save_array('item_end', item_end)
+    writer.save_array('order', order)
+    t2 = time.time()
+    sizes = item_end[child_offsets[1:] == child_offsets[:-1]] - item_start[child_offsets[1:] == child_offsets[:-1]]
+    print('>> Vocabulary tree build: {:.1f}s, {} leaves, largest leaf {}'.format(t2 - t1, len(sizes), sizes.max()))
+    return writer.commit(build_time=t2 - t1)
+
+
+def load_vocabulary_tree(features, dataset, branching=16, depth=3):
+    # open the index built by build_vocabulary_tree with the same parameters from the same features
+    features = check_features(features)
+    index = load_index(dataset, 'VocabTree', vocabtree_params(branching, depth), features)
+    return VocabularyTree(index.array('child_offsets', mmap_mode=None), index.array('children', mmap_mode=None),
+                          index.array('centers', mmap_mode=None), index.array('item_start', mmap_mode=None),
+                          index.array('item_end', mmap_mode=None), index.array('order'), features=features)
+
+
+def matching_VocabTree(K, embedded_features_train, embedded_features_test, dataset, branching=16, depth=3,
+                       candidates=2000, ifgenerate=True, index=None):
+    '''
+        Inputs:
+            K: number of nearest neighbours
+            embedded_features_train: feature vectors of the dataset images
+            embedded_features_test: feature vectors of the query images
+            dataset: name of the dataset
+            branching, depth: shape of the tree
+            candidates: number of database images gathered from the closest leaves and rescored
+            ifgenerate: build the tree (otherwise it is loaded)
+            index: an opened VocabularyTree (e.g. loaded once by online.py), overrides ifgenerate
+        Outputs:
+            idx: the indices of the top-K nearest neighbours
+            time_per_query: average mathching time per query
+    '''
+    num_test = len(embedded_features_test)
+    if index is None:
+        if ifgenerate:
+            build_vocabulary_tree(embedded_features_train, dataset, branching=branching, depth=depth)
+        index = load_vocabulary_tree(embedded_features_train, dataset, branching=branching, depth=depth)
+    t1 = time.time()
+    idx, _, latency = index.search_batch(embedded_features_test, K, candidates, return_latency=True)
+    t2 = time.time()
+    print_latency(latency)
+    time_per_query = (t2 - t1) / num_test
+    return idx, time_per_query
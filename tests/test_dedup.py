@@ -0,0 +1,44 @@
+import numpy as np
+
+from src.utils.dedup import exact_pairs, find_duplicate_groups, range_pairs
+
+
+def with_near_copies(num, copies, dim=32, noise=0.02, seed=0):
+    # num random descriptors followed by noisy copies of some of them
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(num, dim)).astype(np.float32)
+    base /= np.linalg.norm(base, axis=1, keepdims=True)
+    src = rng.integers(0, num, copies)
+    near = base[src] + rng.normal(scale=noise / np.sqrt(dim), size=(copies, dim)).astype(np.float32)
+    return np.concatenate([base, near])
+
+
+def test_bucket_pairs_match_exact_pairs():
+    features = with_near_copies(3000, 600)
+    for threshold in (0.0, 0.05, 0.3):
+        exact = exact_pairs(features, threshold)
+        found = range_pairs(features, threshold, exact_max=0, N_words=64)
+        assert np.array_equal(found[0], exact[0]) and np.array_equal(found[1], exact[1])
+    assert len(exact_pairs(features, 0.05)[0]) >= 600
+
+
+def test_groups_and_expand():
+    features = with_near_copies(500, 100)
+    groups = find_duplicate_groups(features, threshold=0.05, exact_max=0, N_words=16)
+    assert groups.num_images == len(features)
+    assert len(groups) <= 500
+    # every copy is in the group of an image within the threshold
+    member_group = np.repeat(np.arange(len(groups)), np.diff(groups.group_offsets))
+    group_of = np.empty(len(features), dtype=np.int64)
+    group_of[groups.group_members] = member_group
+    rep = groups.representatives[group_of]
+    unit = features / np.linalg.norm(features, axis=1, keepdims=True)
+    assert np.all(np.linalg.norm(unit - unit[rep], axis=1) <= 0.05 + 1e-6)
+    g = group_of[520]
+    out = groups.expand(np.array([[g, -1]]), 50)[0]
+    assert out[out >= 0].tolist() == groups.members(g).tolist()
+
+
+def test_single_image():
+    groups = find_duplicate_groups(np.ones((1, 8), dtype=np.float32), threshold=0.1)
+    assert len(groups) == 1 and groups.members(0).tolist() == [0]
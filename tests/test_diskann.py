@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from src.utils.diskann import build_diskann, load_diskann, matching_DiskANN
+from src.utils.nnsearch import matching_L2
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the indexes are written below outputs/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def clustered(num, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)) * 2
+    return (centers[rng.integers(0, clusters, num)] + rng.normal(size=(num, dim))).astype(np.float32)
+
+
+def overlap(found, truth):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found.tolist(), truth.tolist())])
+
+
+PARAMS = dict(R=32, L=50, alpha=1.2, N_books=16, N_words=64)
+
+
+def test_diskann_recall_against_exact_search():
+    data = clustered(2000)
+    queries = clustered(50, seed=1)
+    truth, _ = matching_L2(10, data, queries)
+    ids, _ = matching_DiskANN(10, data, queries, 'set', **PARAMS)
+    assert overlap(ids, truth) >= 0.9
+    index = load_diskann(data, 'set', beam_width=2, cache_nodes=100, **PARAMS)
+    try:
+        assert len(index.cache) == 100
+        ids, dists = index.search_batch(queries, 10, L=100)
+        assert overlap(ids, truth) >= 0.95
+        # the distances are exact, between normalized vectors
+        unit = data / np.linalg.norm(data, axis=1, keepdims=True)
+        q = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        assert np.allclose(dists, ((unit[ids] - q[:, None]) ** 2).sum(axis=2), atol=1e-4)
+        assert np.array_equal(index.read_nodes([5])[0][0], unit[5])
+    finally:
+        index.close()
+
+
+def test_diskann_refuses_other_features():
+    data = clustered(500)
+    build_diskann(data, 'set', **PARAMS)
+    with pytest.raises(ValueError):
+        load_diskann(data[::-1], 'set', **PARAMS)
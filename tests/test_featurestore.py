@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+
+from src.utils.featurestore import FINGERPRINT_DTYPE, FeatureStore, FeatureStoreWriter, FeatureSubset, feature_store_dir, \
+    load_feature_catalog, load_feature_store, quantize_feature_store, read_manifest, save_feature_store, \
+    update_feature_store, write_manifest
+from src.utils.nnsearch import check_features, matching_L2, matching_quantized
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the stores and indexes are written below outputs/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def random_rows(num, dim=32, seed=0):
+    return np.random.default_rng(seed).normal(size=(num, dim)).astype(np.float32)
+
+
+def save_datasets(sizes, dim=32):
+    names = []
+    for i, num in enumerate(sizes):
+        name = 'set{}'.format(i)
+        save_feature_store(name, random_rows(num, dim, seed=i).T, ['{}/{}.jpg'.format(name, j) for j in range(num)])
+        names.append(name)
+    return names
+
+
+def test_feature_store_round_trip():
+    rows = random_rows(250)
+    paths = ['set/{}.jpg'.format(j) for j in range(248)] + ['set/ä ö.jpg', 'set/with space.png']
+    # extract_vectors returns D x N, the store keeps N x D rows
+    save_feature_store('set', rows.T.astype(np.float64), paths, network='resnet', chunk_size=64)
+    store = load_feature_store('set')
+    assert store.shape == (250, 32) and store.vecs.dtype == np.float32
+    assert isinstance(store.vecs, np.memmap)
+    assert np.array_equal(store.vecs, rows)
+    assert list(store.paths) == paths and store.paths[-2] == 'set/ä ö.jpg'
+    assert store.manifest['network'] == 'resnet'
+    # the checksum only depends on the content
+    save_feature_store('copy', rows.T, paths, chunk_size=1000)
+    assert load_feature_store('copy').checksum == store.checksum
+    save_feature_store('other', rows.T, paths[::-1])
+    assert load_feature_store('other').checksum != store.checksum
+
+
+def test_descriptors_stay_float32():
+    rows = random_rows(50)
+    checked = check_features(rows[:, :16].astype(np.float64))
+    assert checked.dtype == np.float32 and checked.flags.c_contiguous
+    assert check_features(rows) is rows
+    save_feature_store('set', rows.T, paths_of('set', 0, 50))
+    store = load_feature_store('set')
+    assert check_features(store) is store
+    assert matching_L2(5, store, rows[:3])[0][:, 0].tolist() == [0, 1, 2]
+    # stores of other dtypes are refused when they are opened
+    manifest = read_manifest(store.directory)
+    write_manifest(store.directory, dict(manifest, dtype='float64'))
+    with pytest.raises(ValueError):
+        load_feature_store('set')
+    with pytest.raises(TypeError):
+        check_features(FeatureSubset(rows.astype(np.float16), np.arange(10)))
+
+
+def test_catalog_is_the_concatenation_of_its_stores():
+    names = save_datasets([300, 1, 200])
+    whole = np.concatenate([random_rows(num, seed=i) for i, num in enumerate([300, 1, 200])])
+    vecs = load_feature_catalog(names)
+    assert vecs.shape == (501, 32) and np.array_equal(np.asarray(vecs), whole)
+    gids = np.array([[0, 300], [301, 500]])
+    assert np.array_equal(vecs[gids], whole[gids]) and np.array_equal(vecs[-1], whole[-1])
+    assert np.array_equal(vecs[295:305], whole[295:305])
+    store_idx, local = vecs.locate([299, 300, 301])
+    assert store_idx.tolist() == [0, 1, 2] and local.tolist() == [299, 0, 0]
+    assert vecs.global_id('set2', local[2]) == 301
+    assert np.flatnonzero(vecs.collection_mask(['set1', 'set2'])).tolist() == list(range(300, 501))
+    # the chunks never cross a store
+    assert [(start, len(block)) for start, block in vecs.iter_chunks(128)] == \
+        [(0, 128), (128, 128), (256, 44), (300, 1), (301, 128), (429, 72)]
+    q = random_rows(3, seed=9).T
+    assert np.allclose(vecs.dot(q), whole @ q, atol=1e-5)
+    assert vecs.path(300) == 'set1/0.jpg' and list(vecs.paths)[-1] == 'set2/199.jpg'
+    queries = random_rows(20, seed=9)
+    assert np.array_equal(matching_L2(10, vecs, queries, chunk_size=128)[0], matching_L2(10, whole, queries)[0])
+
+
+@pytest.mark.parametrize('mode', ['float16', 'int8'])
+def test_quantize_after_loading_catalog(mode):
+    names = save_datasets([300, 200])
+    vecs = load_feature_catalog(names)
+    for name in names:
+        quantize_feature_store(name, mode)
+    queries = random_rows(20, seed=9)
+    exact, _ = matching_L2(10, vecs, queries)
+    found, _ = matching_quantized(10, vecs, queries, mode=mode, rescore=100)
+    assert np.array_equal(found, exact)
+
+
+def test_quantized_search_on_subset():
+    names = save_datasets([300, 200])
+    vecs = load_feature_catalog(names)
+    for name in names:
+        quantize_feature_store(name, 'int8')
+    subset = FeatureSubset(vecs, np.arange(1, 500, 3))
+    queries = random_rows(20, seed=9)
+    exact, _ = matching_L2(10, np.asarray(subset), queries)
+    found, _ = matching_quantized(10, subset, queries, mode='int8', rescore=100)
+    assert np.array_equal(found, exact)
+    # a subset of a subset maps the ids through both
+    nested = FeatureSubset(subset, np.arange(len(subset))[::-2])
+    exact, _ = matching_L2(10, np.asarray(nested), queries)
+    found, _ = matching_quantized(10, nested, queries, mode='int8', rescore=100)
+    assert np.array_equal(found, exact)
+
+
+def paths_of(name, start, end):
+    return ['{}/{}.jpg'.format(name, j) for j in range(start, end)]
+
+
+def test_append_after_interrupted_append():
+    rows = random_rows(500)
+    save_feature_store('set', rows[:300].T, paths_of('set', 0, 300))
+    directory = feature_store_dir('set')
+    # an append that dies before close() leaves rows and paths after the committed ones
+    writer = FeatureStoreWriter(directory, 32, append=True)
+    writer.write(random_rows(50, seed=5), paths_of('stale', 0, 50))
+    writer._f_vecs.flush()
+    writer._f_paths.flush()
+    del writer
+    fingerprints = np.zeros(500, dtype=FINGERPRINT_DTYPE)
+    update_feature_store(directory, np.arange(300), rows[300:].T, paths_of('set', 300, 500), fingerprints)
+    store = load_feature_store('set')
+    assert store.count == 500
+    assert np.array_equal(store.vecs, rows)
+    assert list(store.paths) == paths_of('set', 0, 500)
+    save_feature_store('whole', rows.T, paths_of('set', 0, 500))
+    assert store.checksum == load_feature_store('whole').checksum
+
+
+def test_resume_after_checkpoint():
+    rows = random_rows(400)
+    directory = feature_store_dir('set')
+    writer = FeatureStoreWriter(directory, 32)
+    writer.write(rows[:250], paths_of('set', 0, 250))
+    writer.checkpoint()
+    writer.write(rows[250:300], paths_of('set', 250, 300))
+    writer._f_vecs.flush()
+    writer._f_paths.flush()
+    del writer
+    writer = FeatureStoreWriter(directory, 32, resume=True)
+    assert writer.count == 250
+    writer.write(rows[250:], paths_of('set', 250, 400))
+    writer.close()
+    store = FeatureStore(directory)
+    assert np.array_equal(store.vecs, rows)
+    assert list(store.paths) == paths_of('set', 0, 400)
+    save_feature_store('whole', rows.T, paths_of('set', 0, 400))
+    assert store.checksum == load_feature_store('whole').checksum
@@ -0,0 +1,328 @@
+import numpy as np
+import pytest
+
+from src.utils.indexstore import IndexReader, IndexWriter
+from src.utils.nnsearch import HNSW, PackedAdjacency, build_hnsw, hnsw_arrays, load_hnsw, matching_L2, pack_adjacency, \
+    save_hnsw, tune_ef
+
+
+def clustered(num, dim=16, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)) * 2
+    return (centers[rng.integers(0, clusters, num)] + rng.normal(size=(num, dim))).astype(np.float32)
+
+
+def normalized(num, dim=16, seed=0):
+    # the descriptors are L2-normalized, matching_L2 normalizes its inputs as well
+    data = clustered(num, dim, seed=seed)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+
+def overlap(found, truth):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found.tolist(), truth.tolist())])
+
+
+def recall(hnsw, data, queries, k=10, ef=50):
+    truth = np.argsort(((queries[:, None] - data[None]) ** 2).sum(axis=2), axis=1)[:, :k]
+    ids, _ = hnsw.search_batch(queries, k, ef=ef, workers=1)
+    return np.mean([len(set(a) & set(b)) / k for a, b in zip(ids.tolist(), truth.tolist())])
+
+
+def test_graph_search_recall_against_exact_search():
+    data = normalized(1000)
+    queries = normalized(50, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    truth, _ = matching_L2(10, data, queries)
+    ids, dists = hnsw.search_batch(queries, 10, ef=100, workers=1)
+    assert overlap(ids, truth) >= 0.95
+    assert np.all(np.diff(dists, axis=1) >= 0)
+    exact = np.array([[idx for idx, _ in hnsw.search_exact(q, 10)] for q in queries])
+    assert np.array_equal(exact, truth)
+
+
+@pytest.mark.parametrize('metric', ['ip', 'cosine'])
+def test_angular_metrics_rank_like_exact_search(metric):
+    data = normalized(1000)
+    queries = normalized(50, seed=1)
+    # cosine does not need normalized vectors
+    scales = np.random.default_rng(0).uniform(0.5, 2, (1000, 1)).astype(np.float32) if metric == 'cosine' else 1
+    hnsw = HNSW(metric, m=8, ef=40)
+    for vec in data * scales:
+        hnsw.add(vec)
+    truth, _ = matching_L2(10, data, queries)
+    ids, dists = hnsw.search_batch(queries, 10, ef=100, workers=1)
+    assert overlap(ids, truth) >= 0.95
+    expected = 1 - np.einsum('qkd,qd->qk', data[ids], queries)
+    assert np.allclose(dists, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('storage', ['float16', 'external'])
+def test_vector_storage_recall(storage):
+    data = normalized(1000)
+    queries = normalized(50, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40, storage=storage, vectors=data if storage == 'external' else None)
+    for vec in data:
+        hnsw.add(vec)
+    if storage == 'float16':
+        assert hnsw.data.dtype == np.float16
+    else:
+        assert np.shares_memory(hnsw.data, data)
+    truth, _ = matching_L2(10, data, queries)
+    ids, _ = hnsw.search_batch(queries, 10, ef=100, workers=1)
+    assert overlap(ids, truth) >= 0.95
+
+
+def test_reorder_keeps_the_results():
+    data = normalized(800)
+    queries = normalized(30, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    expected, expected_dists = hnsw.search_batch(queries, 10, ef=50, workers=1)
+    order = hnsw.reorder()
+    assert np.array_equal(np.sort(order), np.arange(800))
+    assert np.array_equal(hnsw.original_ids(np.arange(800)), order)
+    ids, dists = hnsw.search_batch(queries, 10, ef=50, workers=1)
+    assert np.array_equal(hnsw.original_ids(ids), expected)
+    assert np.allclose(dists, expected_dists)
+    # neighbours get close ids: the mean id distance of the level 0 edges shrinks
+    edges = hnsw._neighbors[0][hnsw._neighbors[0] >= 0]
+    heads = np.nonzero(hnsw._neighbors[0] >= 0)[0]
+    before = np.abs(order[edges] - order[heads]).mean()
+    assert np.abs(edges - heads).mean() < 0.6 * before
+
+
+def test_tuned_ef_reaches_the_target_recall():
+    data = normalized(1000)
+    queries = normalized(50, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    for target in (0.8, 0.99):
+        tuned = tune_ef(hnsw, 10, target_recall=target, queries=queries)
+        assert tuned['recall'] >= target and tuned['ef'] >= 10
+        ids, _ = hnsw.search_batch(queries, 10, ef=tuned['ef'], workers=1)
+        assert overlap(ids, matching_L2(10, data, queries)[0]) >= target
+    assert tune_ef(hnsw, 10, target_recall=0.8)['ef'] <= tuned['ef']
+    # by default elements of the graph are the queries, each one left out of its own results
+    assert tune_ef(hnsw, 10, target_recall=0.95, num_queries=50)['recall'] >= 0.95
+
+
+def test_partitioned_build_recall_matches_single_build():
+    data = clustered(3000)
+    queries = clustered(300, seed=1)
+    single, _ = build_hnsw(data, 8, 40, workers=1)
+    partitioned, timing = build_hnsw(data, 8, 40, workers=4, min_partition=500)
+    assert 'refine' in timing
+    assert recall(partitioned, data, queries) >= recall(single, data, queries) - 0.02
+
+
+def test_filtered_search_only_returns_allowed_ids():
+    data = normalized(1000)
+    queries = normalized(20, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    rng = np.random.default_rng(0)
+    # a large filter is searched in the graph, a small one is scored directly
+    for fraction in (0.5, 0.02):
+        allowed = rng.random(1000) < fraction
+        ids, _ = hnsw.search_batch(queries, 10, ef=100, workers=1, allowed=allowed)
+        assert allowed[ids[ids >= 0]].all()
+        truth = np.flatnonzero(allowed)[matching_L2(10, data[allowed], queries)[0]]
+        assert overlap(ids, truth) >= 0.9
+    # one mask per query, fewer allowed elements than k pad with -1
+    per_query = np.zeros((len(queries), 1000), dtype=bool)
+    per_query[np.arange(len(queries)), rng.integers(0, 1000, len(queries))] = True
+    ids, dists = hnsw.search_batch(queries, 3, workers=1, allowed=per_query)
+    assert np.array_equal(ids[:, 0], np.flatnonzero(per_query) % 1000)
+    assert (ids[:, 1:] == -1).all() and np.isinf(dists[:, 1:]).all()
+    # the tombstones are a filter as well, also when few elements are left
+    hnsw.delete(np.arange(990))
+    ids, _ = hnsw.search_batch(queries, 5, workers=1)
+    assert ((ids >= 990) & (ids < 1000)).all()
+
+
+def test_deleted_elements_are_not_returned_and_replace_moves_an_element():
+    data = normalized(800)
+    queries = normalized(40, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    deleted = np.arange(0, 800, 2)
+    hnsw.delete(deleted)
+    live = np.setdiff1d(np.arange(800), deleted)
+    truth, _ = matching_L2(10, data[live], queries)
+    ids, _ = hnsw.search_batch(queries, 10, ef=100, workers=1)
+    assert not np.isin(ids, deleted).any()
+    assert overlap(ids, live[truth]) >= 0.9
+    # a replaced element is found at its new place, a deleted one is restored
+    for idx, q in zip([1, 2], queries[:2]):
+        hnsw.replace(idx, q)
+        assert hnsw.search(q, 1, ef=50)[0][0] == idx
+    assert hnsw.repair() > 0
+    ids, _ = hnsw.search_batch(queries, 10, ef=100, workers=1)
+    assert not np.isin(ids, deleted[deleted != 2]).any()
+
+
+def save_and_load(hnsw, data, **kwargs):
+    writer = IndexWriter('set', 'HNSW', {}, data)
+    save_hnsw(writer, hnsw, **kwargs)
+    return load_hnsw(IndexReader(writer.commit()), vectors=data)
+
+
+def test_save_load_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = normalized(600)
+    queries = normalized(20, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    hnsw.delete(np.arange(0, 600, 7))
+    loaded = save_and_load(hnsw, data)
+    meta, arrays = hnsw_arrays(hnsw)
+    loaded_meta, loaded_arrays = hnsw_arrays(loaded)
+    assert loaded_meta == meta and arrays.keys() == loaded_arrays.keys()
+    for name, array in arrays.items():
+        assert np.array_equal(loaded_arrays[name], array), name
+    expected = hnsw.search_batch(queries, 10, ef=50, workers=1)
+    found = loaded.search_batch(queries, 10, ef=50, workers=1)
+    assert np.array_equal(found[0], expected[0]) and np.array_equal(found[1], expected[1])
+    # the loaded arrays are copy-on-write, the graph can still change
+    loaded.add(queries[0])
+    assert loaded.search(queries[0], 1)[0][0] == 600
+
+
+def test_packed_adjacency_round_trip():
+    # deltas of every byte width, empty and full rows
+    rng = np.random.default_rng(0)
+    M, rows = 6, 200
+    row_ids = np.sort(rng.choice(2**26, rows, replace=False))
+    counts = rng.integers(0, M + 1, rows)
+    counts[:2] = 0, M
+    neighbors = np.full((rows, M), -1, dtype=np.int64)
+    for row, n in enumerate(counts):
+        scale = 2 ** (8 * (row % 4) + 4)
+        neighbors[row, :n] = np.sort(rng.choice(min(scale, 2**31 - 1), n, replace=False))
+    offsets, data = pack_adjacency(neighbors, counts, row_ids)
+    unpacked, unpacked_counts = PackedAdjacency(offsets, data).unpack(row_ids, M)
+    assert np.array_equal(unpacked_counts, counts)
+    assert np.array_equal(unpacked, neighbors)
+
+
+def test_compressed_index_searches_like_the_graph(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = normalized(600)
+    queries = normalized(20, seed=1)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    loaded = save_and_load(hnsw, data, compress=True)
+    assert all(isinstance(level, PackedAdjacency) for level in loaded._neighbors)
+    expected = hnsw.search_batch(queries, 10, ef=50, workers=1)
+    found = loaded.search_batch(queries, 10, ef=50, workers=1)
+    assert np.array_equal(found[0], expected[0]) and np.allclose(found[1], expected[1])
+    # the methods changing the graph unpack it, the edge distances are computed again
+    loaded.decompress()
+    assert np.array_equal(np.sort(loaded._neighbors[0], axis=1), np.sort(hnsw._neighbors[0][:600], axis=1))
+    assert np.allclose(np.sort(loaded._ndists[0], axis=1), np.sort(hnsw._ndists[0][:600], axis=1))
+    loaded.add(queries[0])
+    assert loaded.search(queries[0], 1)[0][0] == 600
+
+
+def test_add_after_compact_gets_unused_original_ids():
+    data = clustered(600)
+    extra = clustered(20, seed=2)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    hnsw.delete(np.arange(0, 600, 3))
+    hnsw.compact()
+    for vec in extra:
+        hnsw.add(vec)
+    ids = hnsw.original_ids(np.arange(len(hnsw)))
+    assert len(np.unique(ids)) == len(ids)
+    assert ids[-len(extra):].tolist() == list(range(600, 620))
+    assert hnsw_arrays(hnsw)[0]['next_id'] == 620
+    found, _ = hnsw.search_batch(extra, 1, ef=50, workers=1)
+    assert hnsw.original_ids(found[:, 0]).tolist() == list(range(600, 620))
+
+
+def test_pq_tables_cover_large_codebooks():
+    # offline.py builds PQ_HNSW with 16 books of 2**13 words, the full tables would need 4 GB
+    books, words = 16, 2**13
+    rng = np.random.default_rng(0)
+    codewords = rng.normal(size=(words, books * 2)).astype(np.float32)
+    codes = (np.minimum(rng.zipf(1.5, size=(2000, books)), 64) - 1).astype(np.uint16)
+    hnsw, _ = build_hnsw(codes, 8, 40, workers=1, Codewords=codewords, N_books=books, table_bytes=2**24)
+    assert hnsw._sym_table.shape == (books, 2**24 // (books * words * 4), words)
+    subs = hnsw.reshaped_C[codes, np.arange(books)]
+    for q in codes[:20]:
+        hot = hnsw._sym_slot[np.arange(books), q] >= 0
+        assert hot.any()
+        expected = ((subs - hnsw.reshaped_C[q, np.arange(books)]) ** 2).sum(axis=(1, 2))
+        assert np.allclose(hnsw._scorer(q)(np.arange(len(codes))), expected, rtol=1e-4, atol=1e-3)
+
+
+def test_external_graph_grows_after_compact():
+    vectors = clustered(700)
+    hnsw = HNSW('l2', m=8, ef=40, storage='external', vectors=vectors)
+    for vec in vectors[:600]:
+        hnsw.add(vec)
+    hnsw.delete(np.arange(0, 600, 4))
+    hnsw.compact()
+    # the next elements are the next rows of the external vectors
+    for vec in vectors[600:]:
+        hnsw.add(vec)
+    found, _ = hnsw.search_batch(vectors[600:], 1, ef=50, workers=1)
+    assert hnsw.original_ids(found[:, 0]).tolist() == list(range(600, 700))
+    with pytest.raises(ValueError):
+        hnsw.add(vectors[0])
+
+
+def test_maintain_repairs_past_the_tombstone_ratio():
+    data = clustered(500)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    hnsw.delete(np.arange(20))
+    assert not hnsw.maintain(max_ratio=0.1)
+    hnsw.delete(np.arange(20, 60))
+    assert hnsw.stats()['dangling_edges'] > 0
+    assert hnsw.maintain(max_ratio=0.1)
+    assert hnsw.stats()['dangling_edges'] == 0
+    assert not hnsw.maintain(max_ratio=0.1)
+    assert hnsw.maintain(max_ratio=0.1, compact=True)
+    assert len(hnsw) == 440 and hnsw.stats()['deleted'] == 0
+
+
+def test_search_batch_reuses_its_processes():
+    data = clustered(800)
+    queries = clustered(40, seed=3)
+    hnsw = HNSW('l2', m=8, ef=40)
+    for vec in data:
+        hnsw.add(vec)
+    hnsw.min_batch = 4
+
+    def sequential(k=5, allowed=None):
+        return [[idx for idx, _ in hnsw.search(q, k, ef=50, allowed=allowed)] for q in queries]
+
+    try:
+        ids, _ = hnsw.search_batch(queries, 5, ef=50, workers=2)
+        assert ids.tolist() == sequential()
+        pool = hnsw._pool[0]
+        allowed = np.arange(len(data)) % 2 == 0
+        ids, _ = hnsw.search_batch(queries, 5, ef=50, workers=2, allowed=allowed)
+        assert hnsw._pool[0] is pool
+        assert ids.tolist() == sequential(allowed=allowed)
+        # a change of the graph forks the processes again
+        hnsw.add(queries[0])
+        ids, _ = hnsw.search_batch(queries, 5, ef=50, workers=2)
+        assert hnsw._pool[0] is not pool
+        assert ids[0, 0] == len(data)
+        assert ids.tolist() == sequential()
+    finally:
+        hnsw.close_pool()
+    assert hnsw._pool is None
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.utils.featurestore import load_feature_store, save_feature_store
+from src.utils.imagelist import build_image_list, image_list_matches, load_image_list, parse_extensions
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the image lists are written below outputs/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+
+def test_parse_extensions():
+    assert parse_extensions('.jpg, PNG,.Tif,') == ('.jpg', '.png', '.tif')
+    with pytest.raises(ValueError):
+        parse_extensions(' , ')
+
+
+def test_image_list_is_written_and_read_back(workdir):
+    root = str(workdir / 'data')
+    for name in ('a/1.jpg', 'a/b/2.PNG', 'a/b/3.txt', 'a/c/4.jpg'):
+        touch(os.path.join(root, name))
+    listed = build_image_list('set', os.path.join(root, 'a'), start=root, extensions=parse_extensions('.jpg, png'))
+    assert list(listed) == ['a/1.jpg', 'a/b/2.PNG', 'a/c/4.jpg']
+    assert list(load_image_list('set')) == list(listed)
+    # a second scan reuses the cached listings and replaces the list
+    touch(os.path.join(root, 'a/b/5.jpg'))
+    listed = build_image_list('set', os.path.join(root, 'a'), start=root, extensions=('.jpg',))
+    assert list(load_image_list('set')) == ['a/1.jpg', 'a/b/5.jpg', 'a/c/4.jpg']
+    assert load_image_list('other') is None
+
+
+def test_image_list_matches_feature_store(workdir):
+    root = str(workdir / 'data')
+    for name in ('a/1.jpg', 'a/2.jpg', 'a/3.jpg'):
+        touch(os.path.join(root, name))
+    listed = list(build_image_list('set', os.path.join(root, 'a'), start=root))
+    vecs = np.zeros((4, 3), dtype=np.float32)
+    save_feature_store('set', vecs, listed)
+    assert image_list_matches('set', load_feature_store('set').paths)
+    # an incremental run keeps the order of the store
+    save_feature_store('set', vecs, listed[::-1])
+    assert image_list_matches('set', load_feature_store('set').paths)
+    save_feature_store('set', vecs[:, :2], listed[:2])
+    assert not image_list_matches('set', load_feature_store('set').paths)
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.utils.featurestore import load_feature_store, save_feature_store
+from src.utils.indexstore import IndexReader, IndexWriter, index_dir, load_index
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the indexes are written below outputs/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def random_rows(num, dim=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(num, dim)).astype(np.float32)
+
+
+def write_index(features, params, levels):
+    writer = IndexWriter('set', 'HNSW', params, features)
+    writer.save_array('levels', levels)
+    writer.save_object('meta', {'entry': 3})
+    with open(writer.path('tree.ann'), 'w') as f:
+        f.write('payload')
+    return writer.commit(ef_search={'10': 40})
+
+
+def test_index_round_trip_and_validation():
+    features = random_rows(100)
+    params = {'m': 8, 'ef': (40, 80)}
+    levels = np.arange(100, dtype=np.uint8)
+    directory = write_index(features, params, levels)
+    assert directory == index_dir('set', 'HNSW') and not os.path.exists(directory + '.tmp')
+    index = load_index('set', 'HNSW', params, features)
+    assert isinstance(index.array('levels'), np.memmap)
+    assert np.array_equal(index.array('levels'), levels)
+    assert index.object('meta') == {'entry': 3}
+    assert open(index.path('tree.ann')).read() == 'payload'
+    assert index.manifest['ef_search'] == {'10': 40}
+    index.update_manifest(ef_search={'10': 50})
+    assert IndexReader(directory).manifest['ef_search'] == {'10': 50}
+    for kwargs in ({'method': 'PQ'}, {'params': {'m': 16, 'ef': (40, 80)}}, {'features': features[::-1]},
+                   {'features': features[:99]}):
+        args = dict({'method': 'HNSW', 'params': params, 'features': features}, **kwargs)
+        with pytest.raises(ValueError):
+            load_index('set', args['method'], args['params'], args['features'])
+
+
+def test_index_of_a_feature_store():
+    features = random_rows(100)
+    save_feature_store('set', features.T, ['{}.jpg'.format(i) for i in range(100)])
+    write_index(load_feature_store('set'), {'m': 8}, np.zeros(100, dtype=np.uint8))
+    load_index('set', 'HNSW', {'m': 8}, load_feature_store('set'))
+    # the checksum of a store covers the image paths as well
+    save_feature_store('set', features.T, ['renamed/{}.jpg'.format(i) for i in range(100)])
+    with pytest.raises(ValueError):
+        load_index('set', 'HNSW', {'m': 8}, load_feature_store('set'))
+
+
+def test_rebuild_replaces_the_index():
+    features = random_rows(100)
+    write_index(features, {'m': 8}, np.zeros(100, dtype=np.uint8))
+    # an interrupted build leaves a temporary directory, the next build starts over
+    os.makedirs(index_dir('set', 'HNSW') + '.tmp/stale')
+    directory = write_index(features, {'m': 16}, np.ones(100, dtype=np.uint8))
+    assert sorted(os.listdir(os.path.dirname(directory))) == ['HNSW']
+    assert not os.path.exists(os.path.join(directory, 'stale'))
+    assert np.array_equal(load_index('set', 'HNSW', {'m': 16}, features).array('levels'), np.ones(100))
+    with pytest.raises(ValueError):
+        load_index('set', 'HNSW', {'m': 8}, features)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from src.utils.pathtable import ChainedPathTable, load_path_table, path_offsets
+
+
+def write_table(directory, paths, offsets=True):
+    blob_path, offsets_path = str(directory / 'paths.txt'), str(directory / 'paths.offsets.npy')
+    blob = ''.join(path + '\n' for path in paths).encode('utf-8')
+    with open(blob_path, 'wb') as f:
+        f.write(blob)
+    if offsets:
+        np.save(offsets_path, path_offsets(np.frombuffer(blob, dtype=np.uint8)))
+    return blob_path, offsets_path
+
+
+def test_path_table_lookups(tmp_path):
+    paths = ['a/{}.jpg'.format(i) for i in range(10)] + ['b/é.jpg']
+    table = load_path_table(*write_table(tmp_path, paths), count=None)
+    assert len(table) == 11 and list(table) == paths
+    assert table[3] == 'a/3.jpg' and table[-1] == 'b/é.jpg'
+    assert table[2:5] == paths[2:5] and table[np.array([10, 0])] == ['b/é.jpg', 'a/0.jpg']
+    with pytest.raises(IndexError):
+        table[11]
+    # without the offsets file they are computed from the blob, lines after count are ignored
+    short = load_path_table(*write_table(tmp_path, paths, offsets=False), count=4)
+    assert list(short) == paths[:4]
+    chained = ChainedPathTable([table, short])
+    assert len(chained) == 15 and chained[11] == 'a/0.jpg' and chained[-1] == 'a/3.jpg'
+    assert list(chained) == paths + paths[:4]
+    assert chained.nbytes == table.nbytes + short.nbytes
+
+
+def test_offsets_of_a_longer_table_serve_its_prefix(tmp_path):
+    # an interrupted append leaves the offsets and lines of rows that were never committed
+    paths = ['{}.jpg'.format(i) for i in range(20)]
+    blob_path, offsets_path = write_table(tmp_path, paths)
+    table = load_path_table(blob_path, offsets_path, count=12)
+    assert len(table) == 12 and list(table) == paths[:12]
+    assert len(load_path_table(*write_table(tmp_path, []), count=0)) == 0
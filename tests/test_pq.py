@@ -0,0 +1,47 @@
+import nanopq
+import numpy as np
+import pytest
+
+from src.utils.nnsearch import l2_normalize, matching_L2, matching_Nano_PQ, pq_dtables, pq_search
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the codes are written below outputs/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def clustered(num, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)) * 2
+    return l2_normalize((centers[rng.integers(0, clusters, num)] + rng.normal(size=(num, dim))).astype(np.float32))
+
+
+def test_batched_adc_matches_nanopq():
+    data = clustered(3000)
+    queries = clustered(70, seed=1)
+    pq = nanopq.PQ(M=8, Ks=64, verbose=False)
+    pq.fit(vecs=data, iter=10, seed=42)
+    codes = pq.encode(vecs=data)
+    dtables = pq_dtables(pq, queries)
+    for row in (0, 69):
+        assert np.allclose(dtables[row], pq.dtable(queries[row]).dtable, atol=1e-5)
+    # several query blocks and code chunks, scored on two threads
+    dist, idx = pq_search(pq, codes, queries, 10, query_block=32, chunk_size=500, workers=2)
+    adist = np.stack([pq.dtable(q).adist(codes) for q in queries])
+    assert np.array_equal(idx, np.argsort(adist, axis=1, kind='stable')[:, :10])
+    assert np.allclose(dist, np.sort(adist, axis=1)[:, :10], atol=1e-5)
+    # fewer codes than K
+    dist, idx = pq_search(pq, codes[:5], queries, 10)
+    assert idx.shape == (70, 5) and np.array_equal(np.sort(idx, axis=1), np.tile(np.arange(5), (70, 1)))
+
+
+def test_nano_pq_recall_and_stored_codes():
+    data = clustered(3000)
+    queries = clustered(50, seed=1)
+    truth, _ = matching_L2(10, data, queries)
+    built, _ = matching_Nano_PQ(10, data, queries, 'set', N_books=16, n_bits_perbook=6)
+    loaded, _ = matching_Nano_PQ(10, data, queries, 'set', N_books=16, n_bits_perbook=6, ifgenerate=False)
+    assert np.array_equal(built, loaded)
+    assert np.mean([len(set(a) & set(b)) / 10 for a, b in zip(built.tolist(), truth.tolist())]) >= 0.5
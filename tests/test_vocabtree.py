@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from src.utils.nnsearch import matching_L2
+from src.utils.vocabtree import load_vocabulary_tree, matching_VocabTree
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the indexes are written below outputs/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def clustered(num, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)) * 2
+    return (centers[rng.integers(0, clusters, num)] + rng.normal(size=(num, dim))).astype(np.float32)
+
+
+def overlap(found, truth):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found.tolist(), truth.tolist())])
+
+
+def test_vocabulary_tree_recall_against_exact_search():
+    data = clustered(3000)
+    queries = clustered(50, seed=1)
+    truth, _ = matching_L2(10, data, queries)
+    ids, _ = matching_VocabTree(10, data, queries, 'set', branching=4, depth=3, candidates=600)
+    assert overlap(ids, truth) >= 0.9
+    tree = load_vocabulary_tree(data, 'set', branching=4, depth=3)
+    assert tree.num_leaves > 16
+    # the leaves partition the database, the ids below a node are one range of order
+    assert np.array_equal(np.sort(tree.order), np.arange(3000))
+    leaves = tree.child_offsets[1:] == tree.child_offsets[:-1]
+    assert (tree.item_end[leaves] - tree.item_start[leaves]).sum() == 3000
+    assert tree.item_start[0] == 0 and tree.item_end[0] == 3000
+    # with every image as a candidate the search is exact
+    ids, _ = tree.search_batch(queries, 10, 3000)
+    assert np.array_equal(ids, truth)